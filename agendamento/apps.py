@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AgendamentoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'agendamento'
+
+    def ready(self):
+        # Registra os signals de atualização do índice de horários
+        from . import signals  # noqa: F401
@@ -0,0 +1,41 @@
+"""
+Comando para reconstruir ou verificar o índice materializado de horários
+
+Uso:
+    python manage.py indexar_agenda              # sincroniza o horizonte
+    python manage.py indexar_agenda --verificar  # apenas relata divergências
+    python manage.py indexar_agenda --medico 3
+
+Rode diariamente (ex: cron) para estender o horizonte móvel.
+"""
+from django.core.management.base import BaseCommand
+
+from agendamento.services.slot_index import SlotIndexService, get_slot_index_setting
+
+
+class Command(BaseCommand):
+    help = 'Reconstrói ou verifica o índice de horários (SlotAgenda) a partir de HorarioTrabalho e dos agendamentos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verificar', action='store_true', help='Apenas compara o índice com o esperado, sem alterar')
+        parser.add_argument('--medico', type=int, action='append', help='Restringe ao médico (id); pode repetir')
+
+    def handle(self, *args, **options):
+        resultado = SlotIndexService().rebuild(
+            medico_ids=options['medico'],
+            dry_run=options['verificar'],
+        )
+
+        if not options['verificar']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Índice sincronizado ({get_slot_index_setting('HORIZONTE_DIAS')} dias): "
+                f"{resultado['criados']} criados, {resultado['removidos']} removidos, "
+                f"{resultado['corrigidos']} corrigidos"
+            ))
+        elif any(resultado.values()):
+            self.stdout.write(self.style.WARNING(
+                f"Índice divergente: {resultado['criados']} faltando, {resultado['removidos']} sobrando, "
+                f"{resultado['corrigidos']} com status incorreto"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS("Índice consistente"))
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agendamento', '0002_delete_agendamento'),
+        ('clinica', '0002_clinicainfo_numero_whatsapp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Agendamento',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('paciente_nome', models.CharField(max_length=255)),
+                ('paciente_telefone', models.CharField(max_length=20)),
+                ('data_hora_inicio', models.DateTimeField()),
+                ('data_hora_fim', models.DateTimeField()),
+                ('status', models.CharField(choices=[('Pendente', 'Pendente'), ('Confirmado', 'Confirmado'), ('Cancelado', 'Cancelado'), ('Realizado', 'Realizado')], default='Pendente', max_length=20)),
+                ('google_event_id', models.CharField(blank=True, max_length=255, null=True, unique=True)),
+                ('criado_em', models.DateTimeField(auto_now_add=True)),
+                ('atualizado_em', models.DateTimeField(auto_now=True)),
+                ('medico', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='clinica.medico')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['medico', 'data_hora_inicio'], name='agend_medico_inicio_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agendamento', '0003_restaurar_agendamento'),
+        ('clinica', '0002_clinicainfo_numero_whatsapp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotAgenda',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('inicio', models.DateTimeField()),
+                ('fim', models.DateTimeField()),
+                ('status', models.CharField(choices=[('livre', 'Livre'), ('reservado', 'Reservado')], default='livre', max_length=20)),
+                ('atualizado_em', models.DateTimeField(auto_now=True)),
+                ('medico', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slots', to='clinica.medico')),
+            ],
+            options={
+                'ordering': ['inicio'],
+                'indexes': [models.Index(fields=['status', 'inicio'], name='slot_status_inicio_idx'), models.Index(fields=['medico', 'status', 'inicio'], name='slot_medico_status_idx')],
+                'constraints': [models.UniqueConstraint(fields=('medico', 'inicio'), name='slot_medico_inicio_uniq')],
+            },
+        ),
+    ]
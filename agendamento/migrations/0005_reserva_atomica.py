@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agendamento', '0004_slotagenda'),
+        ('clinica', '0002_clinicainfo_numero_whatsapp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slotagenda',
+            name='retido_ate',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='slotagenda',
+            name='retido_por',
+            field=models.CharField(blank=True, default='', help_text='Telefone do paciente que reteve o horário', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='slotagenda',
+            name='status',
+            field=models.CharField(choices=[('livre', 'Livre'), ('retido', 'Retido'), ('reservado', 'Reservado')], default='livre', max_length=20),
+        ),
+        migrations.AddConstraint(
+            model_name='agendamento',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['Pendente', 'Confirmado'])), fields=('medico', 'data_hora_inicio'), name='agend_medico_inicio_ativo_uniq'),
+        ),
+    ]
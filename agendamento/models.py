@@ -0,0 +1,75 @@
+from django.db import models
+from django.utils import timezone
+
+from clinica.models import Medico
+
+
+class Agendamento(models.Model):
+    STATUS_CHOICES = [
+        ('Pendente', 'Pendente'),
+        ('Confirmado', 'Confirmado'),
+        ('Cancelado', 'Cancelado'),
+        ('Realizado', 'Realizado'),
+    ]
+
+    paciente_nome = models.CharField(max_length=255)
+    paciente_telefone = models.CharField(max_length=20)
+    medico = models.ForeignKey(Medico, on_delete=models.PROTECT)
+    data_hora_inicio = models.DateTimeField()
+    data_hora_fim = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='Pendente')
+    google_event_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    criado_em = models.DateTimeField(auto_now_add=True)
+    atualizado_em = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # Última barreira contra agendamento duplo: dois agendamentos
+            # ativos não podem começar no mesmo horário do mesmo médico
+            models.UniqueConstraint(
+                fields=['medico', 'data_hora_inicio'],
+                condition=models.Q(status__in=['Pendente', 'Confirmado']),
+                name='agend_medico_inicio_ativo_uniq',
+            ),
+        ]
+        indexes = [
+            # Consulta de disponibilidade: agendamentos do médico em um intervalo
+            models.Index(fields=['medico', 'data_hora_inicio'], name='agend_medico_inicio_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.paciente_nome} - {self.medico.nome} ({timezone.localtime(self.data_hora_inicio):%d/%m/%Y %H:%M})"
+
+
+class SlotAgenda(models.Model):
+    """
+    Índice materializado da agenda: um registro por slot de cada médico
+    dentro do horizonte (gerado a partir de HorarioTrabalho)
+    """
+    STATUS_CHOICES = [
+        ('livre', 'Livre'),
+        ('retido', 'Retido'),        # Reserva temporária enquanto o bot coleta os dados
+        ('reservado', 'Reservado'),
+    ]
+
+    medico = models.ForeignKey(Medico, on_delete=models.CASCADE, related_name='slots')
+    inicio = models.DateTimeField()
+    fim = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='livre')
+    retido_ate = models.DateTimeField(null=True, blank=True)
+    retido_por = models.CharField(max_length=20, blank=True, default='', help_text="Telefone do paciente que reteve o horário")
+    atualizado_em = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['inicio']
+        constraints = [
+            models.UniqueConstraint(fields=['medico', 'inicio'], name='slot_medico_inicio_uniq'),
+        ]
+        indexes = [
+            # Primeiro horário livre (geral ou por médico)
+            models.Index(fields=['status', 'inicio'], name='slot_status_inicio_idx'),
+            models.Index(fields=['medico', 'status', 'inicio'], name='slot_medico_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.medico.nome} - {timezone.localtime(self.inicio):%d/%m/%Y %H:%M} ({self.status})"
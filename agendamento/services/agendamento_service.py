@@ -1,14 +1,20 @@
 """
 Serviço responsável pelo gerenciamento de agendamentos
 """
-from datetime import datetime, timedelta
+import heapq
+from collections import defaultdict
+from datetime import date, datetime, timedelta
 from typing import Any, Dict, List, Optional
 
+from django.db import IntegrityError, transaction
 from django.utils import timezone
 
 from clinica.models import HorarioTrabalho, Medico
 
-from ..models import Agendamento
+from ..models import Agendamento, SlotAgenda
+from ..signals import agendamento_alterado
+from .availability import STATUS_ATIVOS, AvailabilityEngine
+from .slot_index import SlotIndexService, get_slot_index_setting
 
 
 class AgendamentoService:
@@ -16,7 +22,8 @@ class AgendamentoService:
     
     def __init__(self):
         # Futuramente: self.google_calendar_service = GoogleCalendarService()
-        pass
+        self.availability = AvailabilityEngine()
+        self.slot_index = SlotIndexService(self.availability)
     
     def get_available_slots(self, medico: Medico, data: datetime) -> List[Dict[str, Any]]:
         """
@@ -29,38 +36,134 @@ class AgendamentoService:
         Returns:
             Lista de horários disponíveis
         """
-        # Busca horários de trabalho do médico para o dia da semana
-        dia_semana = data.strftime('%A').lower()
-        horarios_trabalho = HorarioTrabalho.objects.filter(
-            medico=medico,
-            dia_da_semana=dia_semana
-        ).first()
+        dia = data.date() if isinstance(data, datetime) else data
+        return self.get_available_slots_range(medico, dia, dia).get(dia, [])
+    
+    def get_available_slots_range(self, medico: Medico, data_inicio: date, data_fim: date) -> Dict[date, List[Dict[str, Any]]]:
+        """
+        Retorna horários disponíveis de um médico em um período (ex.: a semana)
+        
+        Usa sempre duas consultas (blocos de trabalho e agendamentos),
+        independente do tamanho do período.
+        
+        Args:
+            medico: Médico para consultar
+            data_inicio: Primeira data do período
+            data_fim: Última data do período (inclusive)
+            
+        Returns:
+            Dicionário {data: lista de horários disponíveis}
+        """
+        slots = self._indexed_free_slots(medico, data_inicio, data_fim)
+        if slots is None:
+            slots = self.availability.free_slots(data_inicio, data_fim, medico_ids=[medico.id]).get(medico.id, [])
         
-        if not horarios_trabalho:
-            return []
+        por_dia = defaultdict(list)
+        for slot_datetime in slots:
+            slot_local = timezone.localtime(slot_datetime)
+            por_dia[slot_local.date()].append({
+                'hora': slot_local.strftime('%H:%M'),
+                'datetime': slot_datetime,
+                'disponivel': True
+            })
         
-        # Gera slots de 30 minutos entre início e fim do horário de trabalho
-        slots = []
-        hora_atual = horarios_trabalho.hora_inicio
-        hora_fim = horarios_trabalho.hora_fim
+        return dict(por_dia)
+    
+    def _indexed_free_slots(self, medico: Medico, data_inicio: date, data_fim: date) -> Optional[List[datetime]]:
+        """
+        Horários livres lidos do índice materializado (uma consulta)
+        
+        Returns:
+            Lista de inícios livres ou None se o período não está indexado
+        """
+        if not get_slot_index_setting('ENABLED'):
+            return None
+        
+        # O índice cobre de hoje até o fim do horizonte
+        if data_inicio < timezone.localdate() or data_fim > self.slot_index.horizon_end():
+            return None
+        
+        slots = self.slot_index.slots_in_range(
+            medico.id,
+            timezone.make_aware(datetime.combine(data_inicio, datetime.min.time())),
+            timezone.make_aware(datetime.combine(data_fim + timedelta(days=1), datetime.min.time())),
+        )
+        if not slots:
+            # Índice ainda não gerado (ou médico sem expediente): usa o motor
+            return None
         
-        while hora_atual < hora_fim:
-            # Cria datetime completo para o slot
-            slot_datetime = datetime.combine(data.date(), hora_atual)
+        return [inicio for inicio, livre in slots if livre]
+    
+    def is_slot_free(self, medico: Medico, slot_datetime: datetime) -> bool:
+        """
+        Verifica se um horário está livre consultando o índice de horários
+        
+        Args:
+            medico: Médico para verificar
+            slot_datetime: Início do slot
             
-            # Verifica se o slot está disponível
-            if self._is_slot_available(medico, slot_datetime):
-                slots.append({
-                    'hora': hora_atual.strftime('%H:%M'),
-                    'datetime': slot_datetime,
-                    'disponivel': True
-                })
+        Returns:
+            True se disponível, False caso contrário
+        """
+        return self.slot_index.is_slot_free(medico.id, slot_datetime)
+    
+    def get_first_free_slot(self, medico: Medico = None, especialidade: str = None) -> Optional[SlotAgenda]:
+        """
+        Retorna o primeiro horário livre (de um médico ou de uma especialidade)
+        
+        Args:
+            medico: Médico para consultar (opcional)
+            especialidade: Nome da especialidade (opcional)
+            
+        Returns:
+            SlotAgenda mais próximo ou None
+        """
+        return self.slot_index.first_free_slot(
+            medico_id=medico.id if medico else None,
+            especialidade=especialidade,
+        )
+    
+    def get_next_free_slots(self, especialidade: str, quantidade: int = 5,
+                            a_partir: datetime = None, dias: int = 14) -> List[Dict[str, Any]]:
+        """
+        Retorna os próximos horários livres entre todos os médicos de uma especialidade
+        
+        Args:
+            especialidade: Nome da especialidade (ex: Pneumologia)
+            quantidade: Quantidade máxima de horários retornados
+            a_partir: Instante inicial da busca (padrão: agora)
+            dias: Quantos dias à frente considerar
             
-            # Avança 30 minutos
-            hora_atual = (datetime.combine(datetime.min, hora_atual) + 
-                         timedelta(minutes=30)).time()
+        Returns:
+            Lista ordenada por horário com médico, data e hora de cada slot
+        """
+        a_partir = a_partir or timezone.now()
+        data_inicio = timezone.localtime(a_partir).date()
+        
+        slots_por_medico = self.availability.free_slots(
+            data_inicio,
+            data_inicio + timedelta(days=dias),
+            especialidade=especialidade,
+            a_partir=a_partir,
+        )
+        
+        proximos = heapq.nsmallest(
+            quantidade,
+            ((slot, medico_id) for medico_id, slots in slots_por_medico.items() for slot in slots),
+        )
+        medicos = Medico.objects.in_bulk({medico_id for _, medico_id in proximos})
         
-        return slots
+        resultado = []
+        for slot_datetime, medico_id in proximos:
+            slot_local = timezone.localtime(slot_datetime)
+            resultado.append({
+                'medico': medicos[medico_id],
+                'data': slot_local.date(),
+                'hora': slot_local.strftime('%H:%M'),
+                'datetime': slot_datetime,
+            })
+        
+        return resultado
     
     def _is_slot_available(self, medico: Medico, slot_datetime: datetime) -> bool:
         """
@@ -80,7 +183,7 @@ class AgendamentoService:
             medico=medico,
             data_hora_inicio__lt=slot_fim,
             data_hora_fim__gt=slot_datetime,
-            status__in=['Pendente', 'Confirmado']
+            status__in=STATUS_ATIVOS
         ).exists()
         
         return not existing_booking
@@ -107,25 +210,72 @@ class AgendamentoService:
         # Calcula hora de fim (30 minutos após início)
         data_hora_fim = data_hora_inicio + timedelta(minutes=30)
         
-        # Verifica se o slot ainda está disponível
-        if not self._is_slot_available(medico, data_hora_inicio):
+        try:
+            with transaction.atomic():
+                # A reserva do slot é um UPDATE condicional: a disputa é por
+                # slot e só um paciente vence. Fora do índice (ou com ele
+                # desligado), vale a verificação direta + a constraint única
+                if not self._reserve_slot(medico, data_hora_inicio, paciente_telefone):
+                    raise ValueError("Horário não está mais disponível")
+                
+                # Cria o agendamento
+                agendamento = Agendamento.objects.create(
+                    paciente_nome=paciente_nome,
+                    paciente_telefone=paciente_telefone,
+                    medico=medico,
+                    data_hora_inicio=data_hora_inicio,
+                    data_hora_fim=data_hora_fim,
+                    **kwargs
+                )
+        except IntegrityError:
+            # Outro agendamento ativo no mesmo horário foi gravado antes
             raise ValueError("Horário não está mais disponível")
         
-        # Cria o agendamento
-        agendamento = Agendamento.objects.create(
-            paciente_nome=paciente_nome,
-            paciente_telefone=paciente_telefone,
-            medico=medico,
-            data_hora_inicio=data_hora_inicio,
-            data_hora_fim=data_hora_fim,
-            **kwargs
-        )
+        agendamento_alterado.send(sender=self.__class__, agendamento=agendamento, acao='criado')
         
         # Futuramente: Integrar com Google Calendar
         # self.google_calendar_service.create_event(agendamento)
         
         return agendamento
     
+    def _reserve_slot(self, medico: Medico, data_hora_inicio: datetime, paciente_telefone: str) -> bool:
+        """
+        Reserva o slot no índice ou, se ele não estiver indexado, verifica a agenda
+        
+        Returns:
+            True se o horário pode ser agendado por este paciente
+        """
+        if get_slot_index_setting('ENABLED'):
+            if self.slot_index.reserve(medico.id, data_hora_inicio, paciente_telefone):
+                return True
+            if self.slot_index.is_indexed(medico.id, data_hora_inicio):
+                return False
+        
+        return self._is_slot_available(medico, data_hora_inicio)
+    
+    def hold_slot(self, medico: Medico, data_hora_inicio: datetime, paciente_telefone: str) -> bool:
+        """
+        Retém um horário por alguns minutos enquanto o paciente informa os dados
+        
+        Args:
+            medico: Médico escolhido
+            data_hora_inicio: Início do slot
+            paciente_telefone: Telefone/WhatsApp do paciente
+            
+        Returns:
+            True se o horário ficou retido para o paciente
+        """
+        return self.slot_index.hold(medico.id, data_hora_inicio, paciente_telefone)
+    
+    def release_slot(self, medico: Medico, data_hora_inicio: datetime, paciente_telefone: str) -> bool:
+        """
+        Libera um horário retido pelo paciente
+        
+        Returns:
+            True se havia uma retenção do paciente
+        """
+        return self.slot_index.release_hold(medico.id, data_hora_inicio, paciente_telefone)
+    
     def cancel_agendamento(self, agendamento_id: int, motivo: str = None) -> bool:
         """
         Cancela um agendamento existente
@@ -145,6 +295,8 @@ class AgendamentoService:
                 pass
             agendamento.save()
             
+            agendamento_alterado.send(sender=self.__class__, agendamento=agendamento, acao='cancelado')
+            
             # Futuramente: Atualizar Google Calendar
             # self.google_calendar_service.update_event(agendamento)
             
@@ -202,6 +354,7 @@ class AgendamentoService:
             if agendamento.status == 'Pendente':
                 agendamento.status = 'Confirmado'
                 agendamento.save()
+                agendamento_alterado.send(sender=self.__class__, agendamento=agendamento, acao='confirmado')
                 return True
             return False
             
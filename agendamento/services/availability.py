@@ -0,0 +1,197 @@
+"""
+Motor de disponibilidade de agenda
+
+Calcula os horários livres por subtração de intervalos: os blocos de
+trabalho (HorarioTrabalho) e os agendamentos ativos de todo o período são
+carregados em duas consultas, e a grade de slots é filtrada em memória.
+O custo em consultas é constante, independente do tamanho do período.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.utils import timezone
+
+from clinica.models import HorarioTrabalho
+
+from ..models import Agendamento
+
+SLOT_MINUTOS = 30
+
+# Status que ocupam o horário na agenda
+STATUS_ATIVOS = ['Pendente', 'Confirmado']
+
+Intervalo = Tuple[datetime, datetime]
+
+
+def merge_intervals(intervalos: Iterable[Intervalo]) -> List[Intervalo]:
+    """
+    Une intervalos sobrepostos ou encostados
+
+    Args:
+        intervalos: Intervalos (inicio, fim) em qualquer ordem
+
+    Returns:
+        Intervalos disjuntos, ordenados pelo início
+    """
+    resultado = []
+    for inicio, fim in sorted(intervalos):
+        if resultado and inicio <= resultado[-1][1]:
+            if fim > resultado[-1][1]:
+                resultado[-1] = (resultado[-1][0], fim)
+        else:
+            resultado.append((inicio, fim))
+    return resultado
+
+
+def subtract_intervals(blocos: Iterable[Intervalo], ocupados: Iterable[Intervalo]) -> List[Intervalo]:
+    """
+    Subtrai os intervalos ocupados dos blocos de trabalho (varredura linear)
+
+    Args:
+        blocos: Intervalos de trabalho
+        ocupados: Intervalos já agendados
+
+    Returns:
+        Intervalos livres, disjuntos e ordenados
+    """
+    ocupados = merge_intervals(ocupados)
+    livres = []
+    indice = 0
+
+    for inicio, fim in merge_intervals(blocos):
+        # Agendamentos que terminam antes do bloco não afetam os seguintes
+        while indice < len(ocupados) and ocupados[indice][1] <= inicio:
+            indice += 1
+
+        cursor = inicio
+        j = indice
+        while j < len(ocupados) and ocupados[j][0] < fim:
+            ocupado_inicio, ocupado_fim = ocupados[j]
+            if ocupado_inicio > cursor:
+                livres.append((cursor, ocupado_inicio))
+            cursor = max(cursor, ocupado_fim)
+            j += 1
+
+        if cursor < fim:
+            livres.append((cursor, fim))
+
+    return livres
+
+
+class AvailabilityEngine:
+    """
+    Calcula horários livres de um ou mais médicos em um período
+
+    Os slots seguem a grade de SLOT_MINUTOS a partir do início de cada bloco
+    de trabalho; um slot está livre se couber inteiro em um intervalo livre.
+    """
+
+    def __init__(self, duracao_slot: int = SLOT_MINUTOS):
+        self.duracao = timedelta(minutes=duracao_slot)
+
+    def free_slots(self,
+                   data_inicio: date,
+                   data_fim: date,
+                   medico_ids: Optional[Iterable[int]] = None,
+                   especialidade: Optional[str] = None,
+                   a_partir: Optional[datetime] = None) -> Dict[int, List[datetime]]:
+        """
+        Horários livres por médico entre duas datas (inclusive)
+
+        Args:
+            data_inicio: Primeira data do período
+            data_fim: Última data do período
+            medico_ids: Restringe a estes médicos
+            especialidade: Restringe aos médicos desta especialidade
+            a_partir: Ignora slots que começam antes deste instante
+
+        Returns:
+            Dicionário {medico_id: [início de cada slot livre, em ordem]}
+        """
+        blocos_por_medico = self.load_working_blocks(data_inicio, data_fim, medico_ids, especialidade)
+        ocupados_por_medico = self.load_bookings(blocos_por_medico)
+
+        resultado = {}
+        for medico_id, blocos in blocos_por_medico.items():
+            livres = subtract_intervals(blocos, ocupados_por_medico.get(medico_id, []))
+            resultado[medico_id] = self.slots_in(blocos, livres, a_partir)
+        return resultado
+
+    def load_working_blocks(self, data_inicio: date, data_fim: date,
+                            medico_ids: Optional[Iterable[int]] = None,
+                            especialidade: Optional[str] = None) -> Dict[int, List[Intervalo]]:
+        """Consulta 1: blocos de trabalho, expandidos para datas concretas"""
+        horarios = HorarioTrabalho.objects.all()
+        if medico_ids is not None:
+            horarios = horarios.filter(medico_id__in=list(medico_ids))
+        if especialidade:
+            horarios = horarios.filter(medico__especialidades__nome__iexact=especialidade)
+
+        por_dia_semana = defaultdict(list)
+        for medico_id, dia_da_semana, hora_inicio, hora_fim in horarios.values_list(
+            'medico_id', 'dia_da_semana', 'hora_inicio', 'hora_fim'
+        ).distinct():
+            if hora_fim > hora_inicio:
+                por_dia_semana[dia_da_semana].append((medico_id, hora_inicio, hora_fim))
+
+        blocos = defaultdict(list)
+        dia = data_inicio
+        while dia <= data_fim:
+            # dia_da_semana usa 1 = segunda ... 7 = domingo, como isoweekday()
+            for medico_id, hora_inicio, hora_fim in por_dia_semana.get(dia.isoweekday(), []):
+                blocos[medico_id].append((self._aware(dia, hora_inicio), self._aware(dia, hora_fim)))
+            dia += timedelta(days=1)
+
+        return blocos
+
+    def load_bookings(self, blocos_por_medico: Dict[int, List[Intervalo]]) -> Dict[int, List[Intervalo]]:
+        """Consulta 2: agendamentos ativos que se sobrepõem aos blocos"""
+        if not blocos_por_medico:
+            return {}
+
+        inicio = min(bloco_inicio for blocos in blocos_por_medico.values() for bloco_inicio, _ in blocos)
+        fim = max(bloco_fim for blocos in blocos_por_medico.values() for _, bloco_fim in blocos)
+
+        ocupados = defaultdict(list)
+        agendamentos = Agendamento.objects.filter(
+            medico_id__in=list(blocos_por_medico),
+            data_hora_inicio__lt=fim,
+            data_hora_fim__gt=inicio,
+            status__in=STATUS_ATIVOS,
+        ).values_list('medico_id', 'data_hora_inicio', 'data_hora_fim')
+
+        for medico_id, ag_inicio, ag_fim in agendamentos:
+            ocupados[medico_id].append((ag_inicio, ag_fim))
+        return ocupados
+
+    def grid_slots(self, blocos: List[Intervalo]) -> List[datetime]:
+        """Todos os slots da grade dos blocos de trabalho, livres ou não"""
+        slots = set()
+        for bloco_inicio, bloco_fim in blocos:
+            slot = bloco_inicio
+            while slot + self.duracao <= bloco_fim:
+                slots.add(slot)
+                slot += self.duracao
+        return sorted(slots)
+
+    def slots_in(self, blocos: List[Intervalo], livres: List[Intervalo], a_partir: Optional[datetime] = None) -> List[datetime]:
+        """Slots da grade de cada bloco que cabem inteiros em um intervalo livre"""
+        fins_livres = [fim for _, fim in livres]
+        slots = []
+
+        for slot in self.grid_slots(blocos):
+            if a_partir is not None and slot < a_partir:
+                continue
+            # Único intervalo livre que pode conter o slot: o primeiro que
+            # termina no fim do slot ou depois
+            indice = bisect_left(fins_livres, slot + self.duracao)
+            if indice < len(livres) and livres[indice][0] <= slot:
+                slots.append(slot)
+
+        return slots
+
+    def _aware(self, dia: date, hora: time) -> datetime:
+        """Combina data e hora no fuso da clínica"""
+        return timezone.make_aware(datetime.combine(dia, hora))
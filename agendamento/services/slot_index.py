@@ -0,0 +1,296 @@
+"""
+Índice materializado de horários (SlotAgenda)
+
+Mantém um registro por slot de cada médico para um horizonte móvel (ex.:
+60 dias), de modo que "este horário está livre?" e "primeiro horário
+livre" sejam consultas únicas e indexadas. O índice é atualizado de forma
+incremental pelos sinais de agendamento.signals e reconstruído/verificado
+pelo comando `indexar_agenda`.
+"""
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from ..models import Agendamento, SlotAgenda
+from .availability import STATUS_ATIVOS, AvailabilityEngine, subtract_intervals
+
+DEFAULT_SLOT_INDEX_SETTINGS = {
+    'ENABLED': True,
+    'HORIZONTE_DIAS': 60,
+    'RETENCAO_SEGUNDOS': 300,
+}
+
+
+def get_slot_index_setting(name: str):
+    """Lê uma configuração do índice (settings.AGENDA_SLOT_INDEX) com valor padrão"""
+    return getattr(settings, 'AGENDA_SLOT_INDEX', {}).get(name, DEFAULT_SLOT_INDEX_SETTINGS[name])
+
+
+def free_q(now: datetime) -> Q:
+    """Filtro de slots livres: status livre ou retenção já expirada"""
+    return Q(status='livre') | Q(status='retido', retido_ate__lte=now)
+
+
+class SlotIndexService:
+    """Serviço para manter e consultar o índice materializado de horários"""
+
+    def __init__(self, engine: AvailabilityEngine = None):
+        self.engine = engine or AvailabilityEngine()
+
+    # ------------------------------------------------------------------
+    # Consultas
+    # ------------------------------------------------------------------
+
+    def is_slot_free(self, medico_id: int, inicio: datetime) -> bool:
+        """Verifica se o slot está livre (busca pela chave única medico+inicio)"""
+        return SlotAgenda.objects.filter(free_q(timezone.now()), medico_id=medico_id, inicio=inicio).exists()
+
+    def first_free_slot(self,
+                        medico_id: Optional[int] = None,
+                        especialidade: Optional[str] = None,
+                        a_partir: Optional[datetime] = None) -> Optional[SlotAgenda]:
+        """
+        Primeiro horário livre a partir de um instante
+
+        Args:
+            medico_id: Restringe a um médico
+            especialidade: Restringe aos médicos desta especialidade
+            a_partir: Instante inicial (padrão: agora)
+
+        Returns:
+            SlotAgenda livre mais próximo ou None
+        """
+        now = timezone.now()
+        slots = SlotAgenda.objects.filter(free_q(now), inicio__gte=a_partir or now)
+        if medico_id is not None:
+            slots = slots.filter(medico_id=medico_id)
+        if especialidade:
+            slots = slots.filter(medico__especialidades__nome__iexact=especialidade)
+        return slots.select_related('medico').order_by('inicio').first()
+
+    def slots_in_range(self, medico_id: int, inicio: datetime, fim: datetime) -> List[tuple]:
+        """
+        Slots indexados de um médico no período
+
+        Returns:
+            Lista de (inicio, livre) em ordem; vazia se o período não foi indexado
+        """
+        now = timezone.now()
+        slots = (
+            SlotAgenda.objects
+            .filter(medico_id=medico_id, inicio__gte=inicio, inicio__lt=fim)
+            .order_by('inicio')
+            .values_list('inicio', 'status', 'retido_ate')
+        )
+        return [
+            (slot_inicio, status == 'livre' or (status == 'retido' and retido_ate <= now))
+            for slot_inicio, status, retido_ate in slots
+        ]
+
+    def horizon_end(self) -> date:
+        """Última data coberta pelo índice"""
+        return timezone.localdate() + timedelta(days=get_slot_index_setting('HORIZONTE_DIAS'))
+
+    # ------------------------------------------------------------------
+    # Reserva (operações atômicas por slot)
+    # ------------------------------------------------------------------
+
+    def hold(self, medico_id: int, inicio: datetime, telefone: str, segundos: int = None) -> bool:
+        """
+        Retém um slot por alguns minutos enquanto o bot coleta os dados do paciente
+
+        A retenção é um único UPDATE condicional: só um paciente vence a
+        disputa pelo mesmo slot, sem lock global. O mesmo paciente pode
+        renovar a própria retenção.
+
+        Args:
+            medico_id: Médico do slot
+            inicio: Início do slot
+            telefone: Telefone de quem retém
+            segundos: Duração da retenção (padrão: RETENCAO_SEGUNDOS)
+
+        Returns:
+            True se o slot ficou retido para este paciente
+        """
+        now = timezone.now()
+        segundos = segundos or get_slot_index_setting('RETENCAO_SEGUNDOS')
+
+        return bool(
+            SlotAgenda.objects
+            .filter(free_q(now) | Q(status='retido', retido_por=telefone), medico_id=medico_id, inicio=inicio)
+            .update(status='retido', retido_ate=now + timedelta(seconds=segundos), retido_por=telefone, atualizado_em=now)
+        )
+
+    def release_hold(self, medico_id: int, inicio: datetime, telefone: str) -> bool:
+        """Libera a retenção do paciente (desistiu ou escolheu outro horário)"""
+        return bool(
+            SlotAgenda.objects
+            .filter(medico_id=medico_id, inicio=inicio, status='retido', retido_por=telefone)
+            .update(status='livre', retido_ate=None, retido_por='', atualizado_em=timezone.now())
+        )
+
+    def reserve(self, medico_id: int, inicio: datetime, telefone: str) -> bool:
+        """
+        Marca o slot como reservado com um UPDATE condicional
+
+        Sucede se o slot estiver livre, com retenção expirada ou retido pelo
+        próprio paciente. Deve rodar na mesma transação que cria o
+        agendamento, para ser desfeito se a criação falhar.
+
+        Returns:
+            True se este paciente ficou com o slot
+        """
+        now = timezone.now()
+
+        return bool(
+            SlotAgenda.objects
+            .filter(free_q(now) | Q(status='retido', retido_por=telefone), medico_id=medico_id, inicio=inicio)
+            .update(status='reservado', retido_ate=None, retido_por='', atualizado_em=now)
+        )
+
+    def is_indexed(self, medico_id: int, inicio: datetime) -> bool:
+        """Verifica se o slot existe no índice (qualquer status)"""
+        return SlotAgenda.objects.filter(medico_id=medico_id, inicio=inicio).exists()
+
+    # ------------------------------------------------------------------
+    # Atualização
+    # ------------------------------------------------------------------
+
+    def refresh_range(self, medico_id: int, inicio: datetime, fim: datetime) -> int:
+        """
+        Atualiza o status dos slots de um médico que se sobrepõem a um período
+        (usado após criar, cancelar ou confirmar um agendamento)
+
+        Returns:
+            Quantidade de slots examinados
+        """
+        with transaction.atomic():
+            slots = list(
+                SlotAgenda.objects
+                .filter(medico_id=medico_id, inicio__lt=fim, fim__gt=inicio)
+                .values_list('id', 'inicio', 'fim')
+            )
+            if not slots:
+                return 0
+
+            ocupados = list(
+                Agendamento.objects.filter(
+                    medico_id=medico_id,
+                    data_hora_inicio__lt=max(slot_fim for _, _, slot_fim in slots),
+                    data_hora_fim__gt=min(slot_inicio for _, slot_inicio, _ in slots),
+                    status__in=STATUS_ATIVOS,
+                ).values_list('data_hora_inicio', 'data_hora_fim')
+            )
+
+            reservados = {
+                slot_id
+                for slot_id, slot_inicio, slot_fim in slots
+                if any(ag_inicio < slot_fim and ag_fim > slot_inicio for ag_inicio, ag_fim in ocupados)
+            }
+            livres = [slot_id for slot_id, _, _ in slots if slot_id not in reservados]
+
+            now = timezone.now()
+            if reservados:
+                SlotAgenda.objects.filter(id__in=reservados).exclude(status='reservado').update(
+                    status='reservado', retido_ate=None, retido_por='', atualizado_em=now
+                )
+            if livres:
+                # Retenções ativas são mantidas: o slot continua com o paciente
+                SlotAgenda.objects.filter(id__in=livres, status='reservado').update(
+                    status='livre', atualizado_em=now
+                )
+
+        return len(slots)
+
+    def rebuild(self, medico_ids: Optional[Iterable[int]] = None, dry_run: bool = False) -> Dict[str, int]:
+        """
+        Sincroniza o índice com HorarioTrabalho e os agendamentos
+
+        Gera os slots esperados do horizonte (a partir de hoje), compara com
+        o que está gravado e aplica apenas as diferenças. Slots anteriores a
+        hoje são removidos.
+
+        Args:
+            medico_ids: Restringe a estes médicos (padrão: todos)
+            dry_run: Apenas calcula as diferenças (verificação)
+
+        Returns:
+            Contagem de slots criados, removidos e com status corrigido
+        """
+        hoje = timezone.localdate()
+        inicio_horizonte = timezone.make_aware(datetime.combine(hoje, datetime.min.time()))
+        if medico_ids is not None:
+            medico_ids = list(medico_ids)
+
+        blocos_por_medico = self.engine.load_working_blocks(hoje, self.horizon_end(), medico_ids)
+        ocupados_por_medico = self.engine.load_bookings(blocos_por_medico)
+
+        esperados = {}
+        for medico_id, blocos in blocos_por_medico.items():
+            livres = set(self.engine.slots_in(
+                blocos,
+                subtract_intervals(blocos, ocupados_por_medico.get(medico_id, [])),
+            ))
+            for slot in self.engine.grid_slots(blocos):
+                esperados[(medico_id, slot)] = 'livre' if slot in livres else 'reservado'
+
+        existentes = SlotAgenda.objects.filter(inicio__gte=inicio_horizonte)
+        antigos = SlotAgenda.objects.filter(inicio__lt=inicio_horizonte)
+        if medico_ids is not None:
+            existentes = existentes.filter(medico_id__in=medico_ids)
+            antigos = antigos.filter(medico_id__in=medico_ids)
+
+        now = timezone.now()
+        atuais = {}
+        for slot_id, medico_id, inicio, status, retido_ate in existentes.values_list(
+            'id', 'medico_id', 'inicio', 'status', 'retido_ate'
+        ):
+            if status == 'retido':
+                # Retenção expirada conta como livre; a ativa é preservada
+                # (não é divergência quando o esperado é livre)
+                status = 'livre' if retido_ate <= now else 'retido'
+            atuais[(medico_id, inicio)] = (slot_id, status)
+
+        remover = [slot_id for chave, (slot_id, _) in atuais.items() if chave not in esperados]
+        criar = [chave for chave in esperados if chave not in atuais]
+        corrigir = {'livre': [], 'reservado': []}
+        for chave, (slot_id, atual) in atuais.items():
+            esperado = esperados.get(chave)
+            if esperado is not None and esperado != atual and not (atual == 'retido' and esperado == 'livre'):
+                corrigir[esperado].append(slot_id)
+
+        resultado = {
+            'criados': len(criar),
+            'removidos': len(remover),
+            'corrigidos': sum(len(ids) for ids in corrigir.values()),
+        }
+        if dry_run:
+            return resultado
+
+        with transaction.atomic():
+            antigos.delete()
+            if remover:
+                SlotAgenda.objects.filter(id__in=remover).delete()
+            SlotAgenda.objects.bulk_create(
+                [
+                    SlotAgenda(
+                        medico_id=medico_id,
+                        inicio=inicio,
+                        fim=inicio + self.engine.duracao,
+                        status=esperados[(medico_id, inicio)],
+                    )
+                    for medico_id, inicio in criar
+                ],
+                batch_size=1000,
+            )
+            for status, ids in corrigir.items():
+                if ids:
+                    SlotAgenda.objects.filter(id__in=ids).update(
+                        status=status, retido_ate=None, retido_por='', atualizado_em=now
+                    )
+
+        return resultado
@@ -0,0 +1,35 @@
+"""
+Signals que mantêm o índice materializado de horários (SlotAgenda) atualizado
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from clinica.models import HorarioTrabalho
+
+from .services.slot_index import SlotIndexService, get_slot_index_setting
+
+# Enviado pelo AgendamentoService ao criar, cancelar ou confirmar um
+# agendamento. Argumentos: agendamento, acao ('criado', 'cancelado', 'confirmado')
+agendamento_alterado = Signal()
+
+
+@receiver(agendamento_alterado)
+def atualizar_slots_do_agendamento(sender, agendamento, acao, **kwargs):
+    if not get_slot_index_setting('ENABLED'):
+        return
+
+    medico_id = agendamento.medico_id
+    inicio, fim = agendamento.data_hora_inicio, agendamento.data_hora_fim
+    # Após o commit, para refletir apenas agendamentos efetivamente gravados
+    transaction.on_commit(lambda: SlotIndexService().refresh_range(medico_id, inicio, fim))
+
+
+@receiver(post_save, sender=HorarioTrabalho)
+@receiver(post_delete, sender=HorarioTrabalho)
+def horario_trabalho_changed(sender, instance, **kwargs):
+    if not get_slot_index_setting('ENABLED'):
+        return
+
+    medico_id = instance.medico_id
+    transaction.on_commit(lambda: SlotIndexService().rebuild(medico_ids=[medico_id]))
@@ -1,3 +1,293 @@
-from django.test import TestCase
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from clinica.models import HorarioTrabalho, Medico
+
+from .models import Agendamento, SlotAgenda
+from .services.agendamento_service import AgendamentoService
+from .services.availability import AvailabilityEngine, merge_intervals, subtract_intervals
+
+INDICE_DESLIGADO = {'ENABLED': False}
+
+
+def at(dia: date, hora: str) -> datetime:
+    """Instante no fuso da clínica, ex.: at(dia, '09:30')"""
+    return timezone.make_aware(datetime.combine(dia, time.fromisoformat(hora)))
+
+
+def proxima_segunda(dias: int = 7) -> date:
+    """Segunda-feira pelo menos `dias` à frente (dentro do horizonte do índice)"""
+    dia = timezone.localdate() + timedelta(days=dias)
+    return dia + timedelta(days=(7 - dia.weekday()) % 7)
+
+
+def create_medico(nome: str = 'Dr. Gleiton Souza') -> Medico:
+    return Medico.objects.create(
+        nome=nome, bio='-', convenios='Particular', preco_particular=Decimal('300.00'), formas_pagamento='Pix'
+    )
+
+
+class IntervalTests(SimpleTestCase):
+    """Aritmética de intervalos do motor de disponibilidade"""
+
+    DIA = date(2026, 10, 19)
+
+    def test_merge_intervals(self):
+        d = self.DIA
+        self.assertEqual(
+            merge_intervals([
+                (at(d, '10:00'), at(d, '10:30')),
+                (at(d, '08:00'), at(d, '09:00')),
+                (at(d, '08:30'), at(d, '09:30')),   # sobreposto
+                (at(d, '09:30'), at(d, '10:00')),   # encostado
+                (at(d, '08:15'), at(d, '08:45')),   # contido
+                (at(d, '14:00'), at(d, '15:00')),
+            ]),
+            [(at(d, '08:00'), at(d, '10:30')), (at(d, '14:00'), at(d, '15:00'))],
+        )
+        self.assertEqual(merge_intervals([]), [])
+
+    def test_subtract_adjacent_and_overlapping_bookings(self):
+        d = self.DIA
+        blocos = [(at(d, '08:00'), at(d, '12:00'))]
+        ocupados = [
+            (at(d, '08:00'), at(d, '08:30')),
+            (at(d, '08:30'), at(d, '09:00')),   # encostado ao anterior
+            (at(d, '10:00'), at(d, '10:45')),
+            (at(d, '10:30'), at(d, '11:00')),   # sobreposto ao anterior
+            (at(d, '11:30'), at(d, '12:30')),   # passa do fim do bloco
+        ]
+        self.assertEqual(
+            subtract_intervals(blocos, ocupados),
+            [(at(d, '09:00'), at(d, '10:00')), (at(d, '11:00'), at(d, '11:30'))],
+        )
+
+    def test_subtract_multiple_blocks_per_day(self):
+        d = self.DIA
+        blocos = [(at(d, '14:00'), at(d, '18:00')), (at(d, '08:00'), at(d, '12:00'))]
+        ocupados = [
+            (at(d, '07:00'), at(d, '07:30')),   # antes de todos os blocos
+            (at(d, '11:30'), at(d, '14:30')),   # atravessa o intervalo de almoço
+            (at(d, '16:00'), at(d, '16:30')),
+        ]
+        self.assertEqual(
+            subtract_intervals(blocos, ocupados),
+            [
+                (at(d, '08:00'), at(d, '11:30')),
+                (at(d, '14:30'), at(d, '16:00')),
+                (at(d, '16:30'), at(d, '18:00')),
+            ],
+        )
+        self.assertEqual(subtract_intervals(blocos, []), merge_intervals(blocos))
+
+    def test_slots_in(self):
+        d = self.DIA
+        engine = AvailabilityEngine()
+        # Grade de 30 min a partir do início de cada bloco (o da tarde começa às 13:15)
+        blocos = [(at(d, '08:00'), at(d, '10:00')), (at(d, '13:15'), at(d, '14:30'))]
+        livres = subtract_intervals(blocos, [
+            (at(d, '08:30'), at(d, '09:00')),
+            (at(d, '09:00'), at(d, '09:15')),   # ocupa parte do slot das 09:00
+            (at(d, '13:45'), at(d, '14:15')),
+        ])
+        self.assertEqual(engine.slots_in(blocos, livres), [at(d, '08:00'), at(d, '09:30'), at(d, '13:15')])
+        self.assertEqual(engine.slots_in(blocos, livres, a_partir=at(d, '08:01')), [at(d, '09:30'), at(d, '13:15')])
+        self.assertEqual(
+            engine.slots_in(blocos, blocos),
+            [at(d, h) for h in ('08:00', '08:30', '09:00', '09:30', '13:15', '13:45')],
+        )
+
+
+@override_settings(AGENDA_SLOT_INDEX=INDICE_DESLIGADO)
+class AvailabilityEngineTests(TestCase):
+    """Disponibilidade calculada a partir de HorarioTrabalho e dos agendamentos"""
+
+    def setUp(self):
+        self.service = AgendamentoService()
+        self.medico = create_medico()
+        self.segunda = proxima_segunda()
+        for dia_da_semana in range(1, 6):
+            HorarioTrabalho.objects.create(medico=self.medico, dia_da_semana=dia_da_semana,
+                                           hora_inicio=time(8), hora_fim=time(10))
+            HorarioTrabalho.objects.create(medico=self.medico, dia_da_semana=dia_da_semana,
+                                           hora_inicio=time(14), hora_fim=time(15))
+
+    def book(self, inicio: datetime, status: str = 'Confirmado') -> Agendamento:
+        return Agendamento.objects.create(
+            paciente_nome='Maria', paciente_telefone='5511999990000', medico=self.medico,
+            data_hora_inicio=inicio, data_hora_fim=inicio + timedelta(minutes=30), status=status,
+        )
+
+    def test_available_slots_of_a_day(self):
+        self.book(at(self.segunda, '08:30'))
+        self.book(at(self.segunda, '09:00'), status='Cancelado')
+
+        horas = [slot['hora'] for slot in self.service.get_available_slots(self.medico, self.segunda)]
+
+        self.assertEqual(horas, ['08:00', '09:00', '09:30', '14:00', '14:30'])
+        self.assertEqual(self.service.get_available_slots(self.medico, self.segunda + timedelta(days=5)), [])
+
+    def test_week_costs_the_same_queries_as_a_day(self):
+        self.book(at(self.segunda + timedelta(days=2), '14:00'))
+
+        with self.assertNumQueries(2):
+            dia = self.service.get_available_slots_range(self.medico, self.segunda, self.segunda)
+        with self.assertNumQueries(2):
+            semana = self.service.get_available_slots_range(self.medico, self.segunda, self.segunda + timedelta(days=6))
+
+        self.assertEqual(list(dia), [self.segunda])
+        self.assertEqual(sorted(semana), [self.segunda + timedelta(days=n) for n in range(5)])
+        self.assertEqual(len(semana[self.segunda + timedelta(days=2)]), 5)
+
+
+class SlotIndexTests(TestCase):
+    """Índice materializado de horários mantido pelos sinais"""
+
+    def setUp(self):
+        self.service = AgendamentoService()
+        self.medico = create_medico()
+        self.segunda = proxima_segunda()
+        with self.captureOnCommitCallbacks(execute=True):
+            HorarioTrabalho.objects.create(medico=self.medico, dia_da_semana=1, hora_inicio=time(8), hora_fim=time(10))
+
+    def indexar_agenda(self, *args) -> str:
+        saida = StringIO()
+        call_command('indexar_agenda', *args, stdout=saida)
+        return saida.getvalue()
+
+    def test_index_built_from_working_hours(self):
+        slots = SlotAgenda.objects.filter(medico=self.medico, inicio__date=self.segunda)
+        self.assertEqual(
+            [timezone.localtime(slot.inicio).strftime('%H:%M') for slot in slots],
+            ['08:00', '08:30', '09:00', '09:30'],
+        )
+        self.assertIn('Índice consistente', self.indexar_agenda('--verificar'))
+
+    def test_no_drift_after_incremental_updates(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            primeiro = self.service.create_agendamento('Maria', '5511999990001', self.medico, at(self.segunda, '08:00'))
+            segundo = self.service.create_agendamento('João', '5511999990002', self.medico, at(self.segunda, '09:00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service.confirm_agendamento(primeiro.id)
+            self.service.cancel_agendamento(segundo.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            HorarioTrabalho.objects.create(medico=self.medico, dia_da_semana=3, hora_inicio=time(14), hora_fim=time(15))
+
+        self.assertFalse(self.service.is_slot_free(self.medico, at(self.segunda, '08:00')))
+        self.assertTrue(self.service.is_slot_free(self.medico, at(self.segunda, '09:00')))
+        self.assertTrue(self.service.is_slot_free(self.medico, at(self.segunda + timedelta(days=2), '14:30')))
+        self.assertIn('Índice consistente', self.indexar_agenda('--verificar'))
+
+    def test_verify_reports_drift_without_fixing(self):
+        # Agendamento gravado sem passar pelo serviço (sem sinal)
+        Agendamento.objects.create(
+            paciente_nome='Maria', paciente_telefone='5511999990001', medico=self.medico,
+            data_hora_inicio=at(self.segunda, '08:30'), data_hora_fim=at(self.segunda, '09:00'),
+        )
+        SlotAgenda.objects.filter(medico=self.medico, inicio=at(self.segunda, '09:30')).delete()
+
+        self.assertIn('1 faltando, 0 sobrando, 1 com status incorreto', self.indexar_agenda('--verificar'))
+        self.assertTrue(self.service.is_slot_free(self.medico, at(self.segunda, '08:30')))
+
+        self.indexar_agenda()
+        self.assertIn('Índice consistente', self.indexar_agenda('--verificar'))
+        self.assertFalse(self.service.is_slot_free(self.medico, at(self.segunda, '08:30')))
+
+    def test_range_read_from_index_in_one_query(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.service.create_agendamento('Maria', '5511999990001', self.medico, at(self.segunda, '08:30'))
+
+        with self.assertNumQueries(1):
+            semana = self.service.get_available_slots_range(self.medico, self.segunda, self.segunda + timedelta(days=6))
+
+        self.assertEqual([slot['hora'] for slot in semana[self.segunda]], ['08:00', '09:00', '09:30'])
+
+
+class SlotReservationTests(TestCase):
+    """Disputa por um mesmo horário: retenção, reserva e criação do agendamento"""
+
+    def setUp(self):
+        self.service = AgendamentoService()
+        self.slot_index = self.service.slot_index
+        self.medico = create_medico()
+        self.inicio = at(proxima_segunda(), '08:00')
+        with self.captureOnCommitCallbacks(execute=True):
+            HorarioTrabalho.objects.create(medico=self.medico, dia_da_semana=1, hora_inicio=time(8), hora_fim=time(10))
+
+    def slot(self) -> SlotAgenda:
+        return SlotAgenda.objects.get(medico=self.medico, inicio=self.inicio)
+
+    def test_second_phone_loses_hold(self):
+        self.assertTrue(self.service.hold_slot(self.medico, self.inicio, '5511999990001'))
+        self.assertFalse(self.service.hold_slot(self.medico, self.inicio, '5511999990002'))
+        self.assertFalse(self.slot_index.reserve(self.medico.id, self.inicio, '5511999990002'))
+        self.assertFalse(self.service.is_slot_free(self.medico, self.inicio))
+        self.assertEqual(self.slot().retido_por, '5511999990001')
+
+    def test_same_phone_renews_hold(self):
+        self.assertTrue(self.slot_index.hold(self.medico.id, self.inicio, '5511999990001', segundos=60))
+        primeira = self.slot().retido_ate
+
+        self.assertTrue(self.slot_index.hold(self.medico.id, self.inicio, '5511999990001', segundos=600))
+        self.assertGreater(self.slot().retido_ate, primeira)
+        self.assertTrue(self.slot_index.reserve(self.medico.id, self.inicio, '5511999990001'))
+        self.assertEqual(self.slot().status, 'reservado')
+
+    def test_expired_hold_is_reclaimable(self):
+        self.assertTrue(self.service.hold_slot(self.medico, self.inicio, '5511999990001'))
+        SlotAgenda.objects.filter(pk=self.slot().pk).update(retido_ate=timezone.now() - timedelta(seconds=1))
+
+        self.assertTrue(self.service.is_slot_free(self.medico, self.inicio))
+        self.assertTrue(self.service.hold_slot(self.medico, self.inicio, '5511999990002'))
+        self.assertEqual(self.slot().retido_por, '5511999990002')
+        # Quem perdeu a retenção não consegue mais reservar nem liberar
+        self.assertFalse(self.slot_index.reserve(self.medico.id, self.inicio, '5511999990001'))
+        self.assertFalse(self.service.release_slot(self.medico, self.inicio, '5511999990001'))
+
+    def test_reserved_slot_cannot_be_held(self):
+        self.assertTrue(self.slot_index.reserve(self.medico.id, self.inicio, '5511999990001'))
+        self.assertFalse(self.slot_index.reserve(self.medico.id, self.inicio, '5511999990002'))
+        self.assertFalse(self.service.hold_slot(self.medico, self.inicio, '5511999990002'))
+
+    def test_duplicate_booking_with_index(self):
+        self.service.create_agendamento('Maria', '5511999990001', self.medico, self.inicio)
+
+        with self.assertRaisesMessage(ValueError, 'Horário não está mais disponível'):
+            self.service.create_agendamento('João', '5511999990002', self.medico, self.inicio)
+        self.assertEqual(Agendamento.objects.filter(medico=self.medico, data_hora_inicio=self.inicio).count(), 1)
+
+    def test_failed_booking_releases_reservation(self):
+        # A reserva do slot é desfeita junto com a criação que falhou
+        with mock.patch.object(Agendamento.objects, 'create', side_effect=ValueError('falha')):
+            with self.assertRaises(ValueError):
+                self.service.create_agendamento('Maria', '5511999990001', self.medico, self.inicio)
+
+        self.assertEqual(self.slot().status, 'livre')
+
+    @override_settings(AGENDA_SLOT_INDEX=INDICE_DESLIGADO)
+    def test_duplicate_booking_without_index(self):
+        self.service.create_agendamento('Maria', '5511999990001', self.medico, self.inicio)
+
+        with self.assertRaisesMessage(ValueError, 'Horário não está mais disponível'):
+            self.service.create_agendamento('João', '5511999990002', self.medico, self.inicio)
+
+        # Mesmo que a verificação prévia perca a corrida, a constraint única barra
+        with mock.patch.object(AgendamentoService, '_is_slot_available', return_value=True):
+            with self.assertRaisesMessage(ValueError, 'Horário não está mais disponível'):
+                self.service.create_agendamento('João', '5511999990002', self.medico, self.inicio)
+
+        self.assertEqual(Agendamento.objects.filter(medico=self.medico, data_hora_inicio=self.inicio).count(), 1)
+
+    @override_settings(AGENDA_SLOT_INDEX=INDICE_DESLIGADO)
+    def test_cancelled_slot_can_be_booked_again(self):
+        agendamento = self.service.create_agendamento('Maria', '5511999990001', self.medico, self.inicio)
+        self.service.cancel_agendamento(agendamento.id)
+
+        novo = self.service.create_agendamento('João', '5511999990002', self.medico, self.inicio)
+        self.assertEqual(novo.status, 'Pendente')
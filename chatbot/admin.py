@@ -1,7 +1,9 @@
 # chatbot/admin.py
 
 from django.contrib import admin
-from .models import Conversa, Direcionamento
+from django.utils import timezone
+
+from .models import Conversa, Direcionamento, MensagemEntrada
 
 @admin.register(Conversa)
 class ConversaAdmin(admin.ModelAdmin):
@@ -16,3 +18,22 @@ class DirecionamentoAdmin(admin.ModelAdmin):
     list_filter = ('status', 'paciente', 'tipo_solicitacao')
     search_fields = ('paciente__nome_completo', 'paciente__telefone_whatsapp')
     list_per_page = 20
+
+@admin.register(MensagemEntrada)
+class MensagemEntradaAdmin(admin.ModelAdmin):
+    list_display = ('telefone_whatsapp', 'status', 'tentativas', 'recebida_em', 'processada_em')
+    list_filter = ('status',)
+    search_fields = ('telefone_whatsapp', 'whatsapp_message_id')
+    readonly_fields = ('recebida_em', 'processada_em', 'bloqueada_em', 'bloqueada_por')
+    actions = ['reprocessar']
+    list_per_page = 20
+
+    @admin.action(description='Reprocessar mensagens selecionadas')
+    def reprocessar(self, request, queryset):
+        total = queryset.exclude(status='processando').update(
+            status='pendente',
+            tentativas=0,
+            disponivel_em=timezone.now(),
+            ultimo_erro=None,
+        )
+        self.message_user(request, f"{total} mensagem(ns) devolvida(s) para a fila.")
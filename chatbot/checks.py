@@ -0,0 +1,58 @@
+"""
+System checks do chatbot (rodam no início de runserver, migrate, processar_fila...)
+"""
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+# Caches que não são compartilhados entre processos
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def estimate_worst_turn_seconds() -> float:
+    """
+    Pior duração estimada de um turno: a cadeia de modelos mais lenta
+    esgotando os timeouts em cada rodada de ferramentas e na reescrita
+    """
+    from .services.ai_service import get_max_tool_turns
+    from .services.model_router import get_model_router_setting
+
+    timeouts = get_model_router_setting('TIMEOUTS_SEGUNDOS')
+    padrao = get_model_router_setting('TIMEOUT_PADRAO_SEGUNDOS')
+    cadeia = max(
+        sum(timeouts.get(model, padrao) for model in chain)
+        for chain in get_model_router_setting('CADEIAS').values()
+    )
+    return cadeia * (get_max_tool_turns() + 1)
+
+
+@register()
+def check_patient_lock(app_configs, **kwargs):
+    """O lock por paciente precisa valer entre processos e durar mais que um turno"""
+    from .services.patient_lock import LOCK_BACKENDS, get_lock_backend, get_lock_setting
+
+    errors = []
+    backend = get_lock_backend()
+    if backend not in LOCK_BACKENDS:
+        errors.append(Error(
+            f"CHATBOT_PATIENT_LOCK['BACKEND'] inválido: {backend!r}",
+            hint=f"Use 'auto' ou um de {', '.join(LOCK_BACKENDS)}.",
+            id='chatbot.E001',
+        ))
+    elif backend == 'cache' and settings.CACHES['default']['BACKEND'] in PROCESS_LOCAL_CACHES:
+        errors.append(Error(
+            "O lock por paciente em cache exige um cache compartilhado entre processos",
+            hint="Configure Redis/Memcached em CACHES['default'] ou use BACKEND 'auto'/'banco'.",
+            id='chatbot.E002',
+        ))
+
+    pior_turno = estimate_worst_turn_seconds()
+    if get_lock_setting('TTL_SEGUNDOS') <= pior_turno:
+        errors.append(Warning(
+            f"CHATBOT_PATIENT_LOCK['TTL_SEGUNDOS'] não passa do pior turno estimado ({pior_turno:.0f}s)",
+            hint="Um turno lento perderia o lock no meio; aumente o TTL.",
+            id='chatbot.W001',
+        ))
+    return errors
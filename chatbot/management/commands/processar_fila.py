@@ -0,0 +1,75 @@
+"""
+Comando para iniciar o pool de workers que consome a fila de mensagens recebidas
+
+Uso:
+    python manage.py processar_fila --workers 4
+"""
+import os
+import socket
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chatbot.services.registry import get_inbound_queue_service, warm_up
+
+
+class Command(BaseCommand):
+    help = 'Processa a fila de mensagens recebidas do WhatsApp com um pool de workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Quantidade de workers (threads)')
+        parser.add_argument('--intervalo', type=float, default=1.0, help='Espera (s) quando a fila está vazia')
+        parser.add_argument('--once', action='store_true', help='Esvazia a fila uma vez e encerra')
+
+    def handle(self, *args, **options):
+        self.stop_event = threading.Event()
+        self.intervalo = options['intervalo']
+        self.once = options['once']
+
+        # Clientes do Gemini e do WhatsApp criados antes do primeiro item
+        warm_up()
+
+        prefixo = f"{socket.gethostname()}:{os.getpid()}"
+        threads = []
+
+        for numero in range(options['workers']):
+            worker_id = f"{prefixo}:{numero}"
+            thread = threading.Thread(target=self._worker_loop, args=(worker_id,), name=worker_id)
+            thread.start()
+            threads.append(thread)
+
+        self.stdout.write(f"{len(threads)} workers iniciados ({prefixo})")
+
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            self.stdout.write("Encerrando workers...")
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
+
+    def _worker_loop(self, worker_id: str):
+        """Loop de um worker: reserva, processa e repete"""
+        queue_service = get_inbound_queue_service()
+
+        while not self.stop_event.is_set():
+            close_old_connections()
+
+            try:
+                processed = queue_service.run_once(worker_id)
+                if not processed:
+                    # Fila vazia: aproveita para recuperar itens de workers que morreram
+                    queue_service.requeue_stale()
+            except Exception as e:
+                print(f"[{worker_id}] Erro no worker: {e}")
+                processed = False
+
+            if not processed:
+                if self.once:
+                    break
+                self.stop_event.wait(self.intervalo)
+
+        close_old_connections()
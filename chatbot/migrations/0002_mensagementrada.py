@@ -0,0 +1,35 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:03
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MensagemEntrada',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('telefone_whatsapp', models.CharField(max_length=20)),
+                ('whatsapp_message_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('payload', models.JSONField()),
+                ('status', models.CharField(choices=[('pendente', 'Pendente'), ('processando', 'Processando'), ('concluida', 'Concluída'), ('dead_letter', 'Falhou Definitivamente')], default='pendente', max_length=20)),
+                ('tentativas', models.PositiveIntegerField(default=0)),
+                ('disponivel_em', models.DateTimeField(default=django.utils.timezone.now)),
+                ('bloqueada_em', models.DateTimeField(blank=True, null=True)),
+                ('bloqueada_por', models.CharField(blank=True, max_length=100, null=True)),
+                ('ultimo_erro', models.TextField(blank=True, null=True)),
+                ('recebida_em', models.DateTimeField(auto_now_add=True)),
+                ('processada_em', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['status', 'disponivel_em'], name='entrada_status_disp_idx'), models.Index(fields=['telefone_whatsapp', 'status'], name='entrada_telefone_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0002_mensagementrada'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversa',
+            name='resumo_historico',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='conversa',
+            name='ultima_mensagem_resumida_id',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.5 on 2026-10-18 09:10
+
+from django.db import migrations
+
+
+def marcar_mensagens_processadas(apps, schema_editor):
+    # As mensagens anteriores ao processamento em lote já foram respondidas;
+    # a partir daqui "processada=False" indica mensagem aguardando resposta
+    MensagemConversa = apps.get_model('chatbot', 'MensagemConversa')
+    MensagemConversa.objects.filter(processada=False).update(processada=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0003_conversa_resumo_historico'),
+    ]
+
+    operations = [
+        migrations.RunPython(marcar_mensagens_processadas, migrations.RunPython.noop),
+    ]
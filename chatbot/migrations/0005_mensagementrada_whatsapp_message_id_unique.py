@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0004_marcar_mensagens_processadas'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mensagementrada',
+            name='whatsapp_message_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
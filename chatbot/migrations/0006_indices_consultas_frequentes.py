@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0005_mensagementrada_whatsapp_message_id_unique'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mensagemconversa',
+            index=models.Index(condition=models.Q(('processada', False), ('remetente', 'user')), fields=['conversa', 'timestamp'], name='mensagem_pendente_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:42
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0006_indices_consultas_frequentes'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='mensagemconversa',
+            options={'ordering': ['timestamp', 'id']},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0007_ordenar_mensagens_por_timestamp_e_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mensagementrada',
+            name='respondida_em',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='mensagementrada',
+            name='resposta',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0008_mensagementrada_resposta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mensagemconversa',
+            name='whatsapp_message_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
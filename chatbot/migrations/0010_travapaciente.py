@@ -0,0 +1,22 @@
+# Generated by Django 5.2.5 on 2026-10-18 09:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0009_mensagemconversa_whatsapp_message_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TravaPaciente',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('telefone_whatsapp', models.CharField(max_length=20, unique=True)),
+                ('token', models.CharField(max_length=32)),
+                ('expira_em', models.DateTimeField()),
+            ],
+        ),
+    ]
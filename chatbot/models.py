@@ -1,6 +1,7 @@
 # chatbot/models.py
 
 from django.db import models
+from django.utils import timezone
 
 
 class Conversa(models.Model):
@@ -15,6 +16,9 @@ class Conversa(models.Model):
     finalizada_em = models.DateTimeField(blank=True, null=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='ativa')
     resumo = models.TextField(blank=True, null=True)
+    # Resumo incremental das mensagens que já saíram da janela de histórico enviada à IA
+    resumo_historico = models.TextField(blank=True, default='')
+    ultima_mensagem_resumida_id = models.BigIntegerField(default=0)
     
     class Meta:
         # CONSTRAINT: Apenas 1 conversa ativa por paciente
@@ -45,9 +49,25 @@ class MensagemConversa(models.Model):
     conteudo = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     processada = models.BooleanField(default=False)
+    # Id da mensagem na Meta (mensagens do usuário): identifica a mesma
+    # mensagem numa nova tentativa da fila, mesmo com texto repetido
+    whatsapp_message_id = models.CharField(max_length=255, blank=True, null=True, unique=True)
     
     class Meta:
-        ordering = ['timestamp']
+        # Mensagens gravadas no mesmo lote podem ter o mesmo timestamp: o id
+        # mantém a ordem em que foram adicionadas
+        ordering = ['timestamp', 'id']
+        # A janela do histórico (conversa, -id) usa o índice da FK: no
+        # SQLite ele já inclui o id de cada linha
+        indexes = [
+            # Mensagens do usuário ainda não respondidas (pequena fração da
+            # tabela): pendências do paciente e ids já registrados no turno
+            models.Index(
+                fields=['conversa', 'timestamp'],
+                condition=models.Q(remetente='user', processada=False),
+                name='mensagem_pendente_idx'
+            ),
+        ]
     
     def __str__(self):
         return f"{self.remetente}: {self.conteudo[:50]}..."
@@ -87,4 +107,61 @@ class Direcionamento(models.Model):
         ]
     
     def __str__(self):
-        return f"Direcionamento: {self.paciente.telefone_whatsapp} - {self.tipo_solicitacao}"
\ No newline at end of file
+        return f"Direcionamento: {self.paciente.telefone_whatsapp} - {self.tipo_solicitacao}"
+
+class MensagemEntrada(models.Model):
+    """
+    Fila persistente de mensagens recebidas pelo webhook.
+    O webhook apenas grava o payload bruto; os workers (comando processar_fila)
+    consomem a fila e executam o fluxo de conversa.
+    """
+    STATUS_CHOICES = [
+        ('pendente', 'Pendente'),
+        ('processando', 'Processando'),
+        ('concluida', 'Concluída'),
+        ('dead_letter', 'Falhou Definitivamente'),
+    ]
+    
+    telefone_whatsapp = models.CharField(max_length=20)
+    # Id da mensagem na Meta (messages[].id), usado para descartar reentregas
+    whatsapp_message_id = models.CharField(max_length=255, blank=True, null=True, unique=True)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pendente')
+    tentativas = models.PositiveIntegerField(default=0)
+    disponivel_em = models.DateTimeField(default=timezone.now)
+    bloqueada_em = models.DateTimeField(blank=True, null=True)
+    bloqueada_por = models.CharField(max_length=100, blank=True, null=True)
+    ultimo_erro = models.TextField(blank=True, null=True)
+    # Turno da conversa salvo (fase 3) e texto que ainda precisa ser enviado
+    # ao paciente: uma nova tentativa só reenvia a resposta, sem chamar a IA
+    respondida_em = models.DateTimeField(blank=True, null=True)
+    resposta = models.TextField(blank=True, null=True)
+    recebida_em = models.DateTimeField(auto_now_add=True)
+    processada_em = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # Busca da próxima mensagem disponível de cada remetente
+            models.Index(fields=['status', 'disponivel_em'], name='entrada_status_disp_idx'),
+            models.Index(fields=['telefone_whatsapp', 'status'], name='entrada_telefone_status_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Entrada de {self.telefone_whatsapp} - {self.status} ({self.tentativas} tentativas)"
+
+
+class TravaPaciente(models.Model):
+    """
+    Lock por paciente no banco (PatientLock com backend 'banco')
+
+    Uma linha por telefone: detém o lock quem gravou seu token com
+    `expira_em` no futuro. A trava de um processo que caiu vence e pode ser
+    tomada por outro.
+    """
+    telefone_whatsapp = models.CharField(max_length=20, unique=True)
+    token = models.CharField(max_length=32)
+    expira_em = models.DateTimeField()
+    
+    def __str__(self):
+        return f"Trava de {self.telefone_whatsapp} até {self.expira_em}"
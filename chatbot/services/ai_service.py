@@ -2,87 +2,193 @@
 Serviço responsável pela integração com IA (Gemini)
 """
 import os
+import threading
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
 from google import genai
 from google.genai import types as genai_types
 
-from clinica.models import ClinicaInfo, Exame, HorarioTrabalho, Medico
+from clinica.knowledge_base import (KB_CACHE_TIMEOUT,
+                                    get_knowledge_base_snapshot,
+                                    get_knowledge_base_version)
+
+from .context_cache import GeminiContextCache, is_context_cache_error
+from .knowledge_retrieval import (format_catalogo, format_clinica,
+                                  format_exame, format_horario, format_medico,
+                                  get_retrieval_setting, retrieve_context)
+from .model_router import classify_turn, get_model_router
+
+SYSTEM_PROMPT_CACHE_KEY = 'chatbot:system_prompt:{mode}:{version}'
+
+AI_ERROR_MESSAGE = "Desculpe, estou com um problema para processar sua solicitação no momento. Tente novamente mais tarde."
+
+RETRIEVAL_NOTE = (
+    "<nota>Os detalhes de médicos, horários, exames e especialidades relevantes para cada "
+    "mensagem chegam junto com a mensagem do usuário, também dentro de <knowledge_base>.</nota>\n"
+)
+
+TOOL_LIMIT_MESSAGE = "Desculpe, não consegui concluir sua solicitação. Pode repetir, por favor?"
+
+# 'comandos': a IA emite comandos em texto ([CONSULTAR_AGENDA: ...]);
+# 'ferramentas': a IA usa function calling do Gemini
+AI_MODES = ('comandos', 'ferramentas')
+DEFAULT_AI_MODE = 'comandos'
+DEFAULT_MAX_TOOL_TURNS = 4
+
+SCHEDULING_RULES = {
+    'comandos': """- **PASSO C (Sinalização para o Sistema):** Após o usuário fornecer o dia, sua resposta para o sistema deve ser **APENAS** um comando especial formatado. Este comando será lido pelo nosso sistema para consultar a agenda real. O formato é:
+            `[CONSULTAR_AGENDA: medico='Nome do Médico', dia='Data Informada pelo Usuário']`
+            **Exemplos de como você deve responder nesta etapa:**
+            - Se o usuário pediu Dr. Gustavo para amanhã: `[CONSULTAR_AGENDA: medico='Dr. Gustavo Magno', dia='amanhã']`
+            - Se o usuário pediu Dr. Gleyton para 25/08/2025: `[CONSULTAR_AGENDA: medico='O Dr. Gleyton Porto', dia='25/08/2025']`
+            **NÃO adicione nenhum outro texto, apenas o comando.**
+
+            - **PASSO D (Apresentação e Confirmação):** O sistema irá processar o comando, consultar a agenda real e apresentar os horários disponíveis ao usuário. Uma vez que o usuário confirme um horário, você pedirá o nome completo dele para finalizar.
+
+            - **PASSO E (Sinalização de Criação):** Após o usuário confirmar o horário e fornecer o nome, sua resposta para o sistema será outro comando especial:
+            `[CRIAR_AGENDAMENTO: medico='Nome do Médico', dia='Data Confirmada', horario='Horário Confirmado', nome_paciente='Nome Completo do Paciente']`""",
+    'ferramentas': """- **PASSO C (Consulta da Agenda):** Após o usuário fornecer o dia, chame a ferramenta `consultar_agenda` com o médico e o dia informados pelo usuário (ex: "amanhã", "25/08/2025"). Nunca invente horários: use apenas os retornados pela ferramenta.
+
+            - **PASSO D (Apresentação e Confirmação):** Apresente os horários retornados pela ferramenta de forma amigável e pergunte qual o usuário prefere. Uma vez que o usuário confirme um horário, você pedirá o nome completo dele para finalizar.
+
+            - **PASSO E (Criação):** Após o usuário confirmar o horário e fornecer o nome, chame a ferramenta `criar_agendamento` e informe ao usuário o resultado retornado por ela.
+
+            - **ENCAMINHAMENTO:** Se não conseguir ajudar ou o usuário pedir atendimento humano, chame a ferramenta `direcionar_secretaria`.""",
+}
+
+SCHEDULING_TOOLS = genai_types.Tool(function_declarations=[
+    genai_types.FunctionDeclaration(
+        name='consultar_agenda',
+        description='Consulta os horários livres de um médico da clínica em um dia.',
+        parameters=genai_types.Schema(
+            type=genai_types.Type.OBJECT,
+            properties={
+                'medico': genai_types.Schema(type=genai_types.Type.STRING, description='Nome do médico'),
+                'dia': genai_types.Schema(type=genai_types.Type.STRING, description='Dia como informado pelo usuário (ex: amanhã, 25/08/2025)'),
+            },
+            required=['medico', 'dia'],
+        ),
+    ),
+    genai_types.FunctionDeclaration(
+        name='criar_agendamento',
+        description='Reserva a consulta no horário confirmado pelo usuário.',
+        parameters=genai_types.Schema(
+            type=genai_types.Type.OBJECT,
+            properties={
+                'medico': genai_types.Schema(type=genai_types.Type.STRING, description='Nome do médico'),
+                'dia': genai_types.Schema(type=genai_types.Type.STRING, description='Dia confirmado'),
+                'horario': genai_types.Schema(type=genai_types.Type.STRING, description='Horário confirmado (ex: 10:00)'),
+                'nome_paciente': genai_types.Schema(type=genai_types.Type.STRING, description='Nome completo do paciente'),
+            },
+            required=['medico', 'dia', 'horario', 'nome_paciente'],
+        ),
+    ),
+    genai_types.FunctionDeclaration(
+        name='direcionar_secretaria',
+        description='Encaminha o atendimento para a secretária humana.',
+        parameters=genai_types.Schema(
+            type=genai_types.Type.OBJECT,
+            properties={
+                'motivo': genai_types.Schema(type=genai_types.Type.STRING, description='Resumo do motivo do encaminhamento'),
+            },
+        ),
+    ),
+])
+
+_local_lock = threading.Lock()
+_local_system_prompt = ((None, None), None)  # ((versão da base, variante), prompt)
+
+
+def get_ai_mode() -> str:
+    """Modo da IA configurado em settings.CHATBOT_AI_MODE"""
+    mode = getattr(settings, 'CHATBOT_AI_MODE', DEFAULT_AI_MODE)
+    return mode if mode in AI_MODES else DEFAULT_AI_MODE
+
+
+def get_prompt_variant(mode: str) -> str:
+    """Variante do prompt do sistema (chave dos caches): modo da IA e uso de recuperação"""
+    return f"{mode}:recuperacao" if get_retrieval_setting('ENABLED') else mode
+
+
+def get_max_tool_turns() -> int:
+    """Limite de rodadas de ferramentas por mensagem (settings.CHATBOT_MAX_TURNOS_FERRAMENTAS)"""
+    return getattr(settings, 'CHATBOT_MAX_TURNOS_FERRAMENTAS', DEFAULT_MAX_TOOL_TURNS)
 
 
 class AIService:
-    """Serviço para gerenciar interações com IA"""
-    
-    def __init__(self):
-        self.api_key = os.environ.get("GEMINI_API_KEY")
-        if not self.api_key:
-            raise ValueError("GEMINI_API_KEY não configurada")
-        
-        self.client = genai.Client(api_key=self.api_key)
-    
-    def _build_knowledge_base(self):
-        """Constrói a base de conhecimento estruturada"""
-        clinica = ClinicaInfo.objects.first()
-        medicos = Medico.objects.all()
-        exames = Exame.objects.all()
-        horarios_trabalho = HorarioTrabalho.objects.all()
-        
-        knowledge_base = "<knowledge_base>\n"
-        
-        # Informações da Clínica
-        knowledge_base += f"<clinica>\n"
-        knowledge_base += f"  <nome>{clinica.nome}</nome>\n"
-        knowledge_base += f"  <objetivo>{clinica.objetivo_geral}</objetivo>\n"
-        knowledge_base += f"  <secretaria>O agendamento é feito exclusivamente pela secretária {clinica.secretaria_nome}.</secretaria>\n"
-        knowledge_base += f"  <contato_telefonico>{clinica.telefone_contato}</contato_telefonico>\n"
-        knowledge_base += f"  <endereco>{clinica.endereco}</endereco>\n"
-        knowledge_base += f"  <referencia>{clinica.referencia_localizacao}</referencia>\n"
-        knowledge_base += f"  <politica_atendimento>{clinica.politica_agendamento}</politica_atendimento>\n"
-        knowledge_base += "</clinica>\n"
+    """
+    Serviço para gerenciar interações com IA
+
+    O modelo de cada chamada é escolhido pelo ModelRouter (modelo rápido
+    para turnos simples, mais forte para agendamento, com timeouts,
+    hedging e circuit breaker).
+    """
+    
+    def __init__(self, client=None):
+        """
+        Args:
+            client: Cliente genai já construído (opcional, ex: cliente falso em testes)
+        """
+        if client is None:
+            self.api_key = os.environ.get("GEMINI_API_KEY")
+            if not self.api_key:
+                raise ValueError("GEMINI_API_KEY não configurada")
+            
+            client = genai.Client(api_key=self.api_key)
+        
+        self.client = client
+        self.model_router = get_model_router()
+        self._context_caches = {}
+    
+    def get_context_cache(self, model):
+        """Cache de contexto do modelo (o conteúdo em cache vale só para o modelo que o criou)"""
+        context_cache = self._context_caches.get(model)
+        if context_cache is None:
+            context_cache = self._context_caches.setdefault(model, GeminiContextCache(self.client, model))
+        return context_cache
+    
+    def _build_knowledge_base(self, snapshot):
+        """
+        Constrói a base de conhecimento estruturada
+
+        Com a recuperação habilitada (settings.CHATBOT_RETRIEVAL), o prompt
+        do sistema leva apenas os dados gerais da clínica e o catálogo de
+        nomes; os detalhes relevantes vão junto de cada mensagem.
+        """
+        parts = ["<knowledge_base>\n", format_clinica(snapshot['clinica'])]
+        
+        if get_retrieval_setting('ENABLED'):
+            parts.append(format_catalogo(snapshot))
+            parts.append(RETRIEVAL_NOTE)
+            parts.append("</knowledge_base>")
+            return "".join(parts)
         
         # Informações dos Médicos
-        knowledge_base += "<corpo_clinico>\n"
-        for medico in medicos:
-            knowledge_base += f"<medico>\n"
-            knowledge_base += f"  <nome>{medico.nome}</nome>\n"
-            knowledge_base += f"  <especialidades>{medico.get_especialidades_display()}</especialidades>\n"
-            knowledge_base += f"  <bio>{medico.bio}</bio>\n"
-            knowledge_base += f"  <convenios>{medico.convenios}</convenios>\n"
-            knowledge_base += f"  <preco_particular>R$ {medico.preco_particular:.2f}</preco_particular>\n"
-            knowledge_base += f"  <formas_pagamento>{medico.formas_pagamento}</formas_pagamento>\n"
-            knowledge_base += f"  <retorno>{medico.retorno_info}</retorno>\n"
-            knowledge_base += "</medico>\n"
-        knowledge_base += "</corpo_clinico>\n"
+        parts.append("<corpo_clinico>\n")
+        parts.extend(format_medico(medico) for medico in snapshot['medicos'])
+        parts.append("</corpo_clinico>\n")
         
         # Informações dos Horários de Trabalho
-        knowledge_base += "<horarios_trabalho>\n"
-        for horario in horarios_trabalho:
-            knowledge_base += f"<horario>\n"
-            knowledge_base += f"  <medico>{horario.medico.nome}</medico>\n"
-            knowledge_base += f"  <dia>{horario.get_dia_da_semana_display()}</dia>\n"
-            knowledge_base += f"  <horario_inicio>{horario.hora_inicio}</horario_inicio>\n"
-            knowledge_base += f"  <horario_fim>{horario.hora_fim}</horario_fim>\n"
-            knowledge_base += "</horario>\n"
-        knowledge_base += "</horarios_trabalho>\n"
+        parts.append("<horarios_trabalho>\n")
+        parts.extend(format_horario(horario) for horario in snapshot['horarios'])
+        parts.append("</horarios_trabalho>\n")
         
         # Informações dos Exames
-        knowledge_base += "<exames_realizados>\n"
-        for exame in exames:
-            knowledge_base += f"<exame>\n"
-            knowledge_base += f"  <nome>{exame.nome}</nome>\n"
-            knowledge_base += f"  <preco>R$ {exame.preco:.2f}</preco>\n"
-            knowledge_base += f"  <o_que_e>{exame.o_que_e}</o_que_e>\n"
-            knowledge_base += f"  <como_funciona>{exame.como_funciona}</como_funciona>\n"
-            knowledge_base += f"  <preparacao>{exame.preparacao or 'Nenhuma preparação específica necessária.'}</preparacao>\n"
-            knowledge_base += f"  <vantagem>{exame.vantagem or ''}</vantagem>\n"
-            knowledge_base += "</exame>\n"
-        knowledge_base += "</exames_realizados>\n"
-        
-        knowledge_base += "</knowledge_base>"
-        return knowledge_base
-    
-    def _build_system_prompt(self, clinica):
-        """Constrói o prompt do sistema"""
-        knowledge_base = self._build_knowledge_base()
+        parts.append("<exames_realizados>\n")
+        parts.extend(format_exame(exame) for exame in snapshot['exames'])
+        parts.append("</exames_realizados>\n")
+        
+        parts.append("</knowledge_base>")
+        return "".join(parts)
+    
+    def _build_system_prompt(self, snapshot, mode=DEFAULT_AI_MODE):
+        """Constrói o prompt do sistema para o modo da IA (comandos ou ferramentas)"""
+        clinica = snapshot['clinica']
+        knowledge_base = self._build_knowledge_base(snapshot)
+        
+        scheduling_rules = SCHEDULING_RULES[mode]
         
         return f"""
             ### PERSONA ###
@@ -100,7 +206,7 @@ class AIService:
             - **Formas de comunicação**: Utilizar linguagem amigável e informal. Poucos emojis. Não utilizar formatos como mardown
 
             ### REGRAS DE AÇÃO ###
-            1.  **FONTE DA VERDADE:** Suas respostas devem se basear EXCLUSIVAMENTE nas informações dentro de `<knowledge_base>`. NUNCA invente informações. Se a informação não estiver lá, diga que não possui o detalhe e ofereça encaminhar para a secretária {clinica.secretaria_nome}.
+            1.  **FONTE DA VERDADE:** Suas respostas devem se basear EXCLUSIVAMENTE nas informações dentro de `<knowledge_base>`. NUNCA invente informações. Se a informação não estiver lá, diga que não possui o detalhe e ofereça encaminhar para a secretária {clinica['secretaria_nome']}.
             2.  **NÃO DÊ CONSELHOS MÉDICOS:** Se o usuário descrever sintomas, siga o GUIA DE CONTEÚDO, explique brevemente a relação com a especialidade e IMEDIATAMENTE recomende o agendamento de uma consulta.
             3.  **FLUXO DE AGENDAMENTO DE CONSULTA (NOVO E MAIS IMPORTANTE):**
             Sua principal função é guiar o usuário pelo processo de agendamento. Siga estes passos de forma estrita:
@@ -109,50 +215,442 @@ class AIService:
 
             - **PASSO B (Coleta do Dia):** Após o usuário escolher o médico, sua segunda ação é perguntar para qual DIA ele gostaria de verificar a disponibilidade. Peça por uma data específica (ex: "para hoje", "amanhã", "dia 25 de agosto").
 
-            - **PASSO C (Sinalização para o Sistema):** Após o usuário fornecer o dia, sua resposta para o sistema deve ser **APENAS** um comando especial formatado. Este comando será lido pelo nosso sistema para consultar a agenda real. O formato é:
-            `[CONSULTAR_AGENDA: medico='Nome do Médico', dia='Data Informada pelo Usuário']`
-            **Exemplos de como você deve responder nesta etapa:**
-            - Se o usuário pediu Dr. Gustavo para amanhã: `[CONSULTAR_AGENDA: medico='Dr. Gustavo Magno', dia='amanhã']`
-            - Se o usuário pediu Dr. Gleyton para 25/08/2025: `[CONSULTAR_AGENDA: medico='O Dr. Gleyton Porto', dia='25/08/2025']`
-            **NÃO adicione nenhum outro texto, apenas o comando.**
-
-            - **PASSO D (Apresentação e Confirmação):** O sistema irá processar o comando e te fornecerá os horários disponíveis. Sua tarefa será apresentar esses horários de forma amigável ao usuário e perguntar qual ele prefere. Uma vez que o usuário confirme um horário, você pedirá o nome completo dele para finalizar.
-
-            - **PASSO E (Sinalização de Criação):** Após o usuário confirmar o horário e fornecer o nome, sua resposta para o sistema será outro comando especial:
-            `[CRIAR_AGENDAMENTO: medico='Nome do Médico', dia='Data Confirmada', horario='Horário Confirmado', nome_paciente='Nome Completo do Paciente']`
+            {scheduling_rules}
 
             4.  **SEJA PROATIVO:** Sempre termine suas respostas com uma pergunta para guiar a conversa.
             """
     
+    def get_system_prompt(self):
+        """Retorna o prompt do sistema para a versão atual da base de conhecimento"""
+        return self._get_versioned_system_prompt()[1]
+    
+    def _get_versioned_system_prompt(self, mode=None):
+        """
+        Retorna (versão da base, prompt do sistema)
+
+        O prompt fica em cache no processo e no cache do Django, com a versão
+        da base de conhecimento e a variante do prompt na chave. Em regime normal não
+        há consulta ao banco nem montagem de string por mensagem.
+        """
+        global _local_system_prompt
+
+        mode = mode or get_ai_mode()
+        variant = get_prompt_variant(mode)
+        key = (get_knowledge_base_version(), variant)
+
+        entry = _local_system_prompt
+        if entry[0] == key:
+            return key[0], entry[1]
+
+        with _local_lock:
+            entry = _local_system_prompt
+            if entry[0] == key:
+                return key[0], entry[1]
+
+            cache_key = SYSTEM_PROMPT_CACHE_KEY.format(mode=variant, version=key[0])
+            prompt = cache.get(cache_key)
+            if prompt is None:
+                prompt = self._build_system_prompt(get_knowledge_base_snapshot(), mode)
+                cache.set(cache_key, prompt, KB_CACHE_TIMEOUT)
+
+            _local_system_prompt = (key, prompt)
+
+        return key[0], prompt
+    
     def generate_response(self, chat_history):
         """Gera resposta da IA baseada no histórico da conversa"""
         try:
-            clinica = ClinicaInfo.objects.first()
-            system_prompt = self._build_system_prompt(clinica)
-            
             if not chat_history:
                 return "Erro: Histórico de conversa vazio."
             
-            def to_parts(parts_list):
-                return [genai_types.Part.from_text(text=p) for p in parts_list]
+            prepared = self._prepare_prompt()
+            task = classify_turn(chat_history, prepared['mode'])
+            response = self._generate_content(self._build_contents(chat_history), prepared, task)
             
-            contents = []
-            for item in chat_history:
-                role = item.get('role', 'user')
-                parts = item.get('parts', [])
-                contents.append(genai_types.Content(role=role, parts=to_parts(parts)))
+            return response.text or ""
             
-            response = self.client.models.generate_content(
-                model="gemini-2.0-flash-exp",
-                contents=contents,
-                config=genai_types.GenerateContentConfig(
-                    system_instruction=system_prompt,
-                    thinking_config=genai_types.ThinkingConfig(thinking_budget=0)
-                )
-            )
+        except Exception as e:
+            print(f"Erro ao chamar a API do Gemini: {e}")
+            return AI_ERROR_MESSAGE
+    
+    async def generate_response_async(self, chat_history):
+        """
+        Versão assíncrona de generate_response, usando client.aio
+
+        A preparação do prompt e dos trechos recuperados pode consultar o
+        banco (quando a base de conhecimento muda), por isso roda via
+        sync_to_async. A chamada ao
+        Gemini não ocupa thread enquanto aguarda a resposta.
+        """
+        try:
+            if not chat_history:
+                return "Erro: Histórico de conversa vazio."
+            
+            prepared = await sync_to_async(self._prepare_prompt)()
+            task = classify_turn(chat_history, prepared['mode'])
+            contents = await sync_to_async(self._build_contents)(chat_history)
+            response = await self._generate_content_async(contents, prepared, task)
             
             return response.text or ""
             
         except Exception as e:
             print(f"Erro ao chamar a API do Gemini: {e}")
-            return "Desculpe, estou com um problema para processar sua solicitação no momento. Tente novamente mais tarde."
+            return AI_ERROR_MESSAGE
+    
+    def generate_response_with_tools(self, chat_history, tool_executor, max_turns=None):
+        """
+        Gera resposta no modo de ferramentas (function calling)
+
+        A cada rodada, as chamadas de ferramenta do modelo (podem vir várias
+        em paralelo) são executadas localmente por `tool_executor` e os
+        resultados voltam ao modelo, até ele responder em texto ou o limite
+        de rodadas ser atingido.
+
+        Args:
+            chat_history: Histórico no formato role/parts
+            tool_executor: Função (nome, argumentos) -> dicionário de resultado
+            max_turns: Limite de rodadas de ferramentas (padrão: settings)
+
+        Returns:
+            Texto final da IA
+        """
+        try:
+            if not chat_history:
+                return "Erro: Histórico de conversa vazio."
+            
+            prepared = self._prepare_prompt('ferramentas')
+            contents = self._build_contents(chat_history)
+            
+            for _ in range(max_turns or get_max_tool_turns()):
+                response = self._generate_content(contents, prepared, 'agendamento')
+                function_calls = response.function_calls or []
+                if not function_calls:
+                    return response.text or ""
+                
+                results = [
+                    self._run_tool(tool_executor, call.name, dict(call.args or {}))
+                    for call in function_calls
+                ]
+                self._append_tool_turn(contents, response, function_calls, results)
+            
+            print("Limite de rodadas de ferramentas atingido")
+            return TOOL_LIMIT_MESSAGE
+            
+        except Exception as e:
+            print(f"Erro ao chamar a API do Gemini: {e}")
+            return AI_ERROR_MESSAGE
+    
+    async def generate_response_with_tools_async(self, chat_history, tool_executor, max_turns=None):
+        """
+        Versão assíncrona de generate_response_with_tools
+
+        `tool_executor` é síncrono (acessa o banco) e roda via sync_to_async.
+        """
+        try:
+            if not chat_history:
+                return "Erro: Histórico de conversa vazio."
+            
+            prepared = await sync_to_async(self._prepare_prompt)('ferramentas')
+            contents = await sync_to_async(self._build_contents)(chat_history)
+            
+            for _ in range(max_turns or get_max_tool_turns()):
+                response = await self._generate_content_async(contents, prepared, 'agendamento')
+                function_calls = response.function_calls or []
+                if not function_calls:
+                    return response.text or ""
+                
+                results = [
+                    await sync_to_async(self._run_tool)(tool_executor, call.name, dict(call.args or {}))
+                    for call in function_calls
+                ]
+                self._append_tool_turn(contents, response, function_calls, results)
+            
+            print("Limite de rodadas de ferramentas atingido")
+            return TOOL_LIMIT_MESSAGE
+            
+        except Exception as e:
+            print(f"Erro ao chamar a API do Gemini: {e}")
+            return AI_ERROR_MESSAGE
+    
+    def generate_response_stream(self, chat_history):
+        """
+        Gera a resposta em streaming (generate_content_stream)
+
+        Usado apenas no modo 'comandos': no modo de ferramentas a resposta
+        depende das chamadas de ferramenta e é gerada por inteiro.
+
+        Args:
+            chat_history: Histórico no formato role/parts
+
+        Yields:
+            Pedaços do texto da resposta, na ordem em que chegam
+        """
+        if not chat_history:
+            yield "Erro: Histórico de conversa vazio."
+            return
+        
+        produced = False
+        try:
+            prepared = self._prepare_prompt(DEFAULT_AI_MODE)
+            task = classify_turn(chat_history, DEFAULT_AI_MODE)
+            for chunk in self._generate_content_stream(self._build_contents(chat_history), prepared, task):
+                if chunk.text:
+                    produced = True
+                    yield chunk.text
+        except Exception as e:
+            print(f"Erro ao chamar a API do Gemini: {e}")
+            # Se parte da resposta já saiu, ela fica como está
+            if not produced:
+                yield AI_ERROR_MESSAGE
+    
+    async def generate_response_stream_async(self, chat_history):
+        """Versão assíncrona de generate_response_stream (client.aio)"""
+        if not chat_history:
+            yield "Erro: Histórico de conversa vazio."
+            return
+        
+        produced = False
+        try:
+            prepared = await sync_to_async(self._prepare_prompt)(DEFAULT_AI_MODE)
+            task = classify_turn(chat_history, DEFAULT_AI_MODE)
+            contents = await sync_to_async(self._build_contents)(chat_history)
+            async for chunk in self._generate_content_stream_async(contents, prepared, task):
+                if chunk.text:
+                    produced = True
+                    yield chunk.text
+        except Exception as e:
+            print(f"Erro ao chamar a API do Gemini: {e}")
+            if not produced:
+                yield AI_ERROR_MESSAGE
+    
+    def _run_tool(self, tool_executor, name, args):
+        """Executa uma ferramenta; erros voltam ao modelo como resultado"""
+        print(f"FERRAMENTA CHAMADA: {name} {args}")
+        try:
+            return tool_executor(name, args)
+        except Exception as e:
+            print(f"Erro ao executar a ferramenta {name}: {e}")
+            return {'erro': 'Não foi possível executar a ação no momento.'}
+    
+    def _append_tool_turn(self, contents, response, function_calls, results):
+        """Acrescenta a rodada (chamadas do modelo + resultados) ao histórico da chamada"""
+        contents.append(response.candidates[0].content)
+        contents.append(genai_types.Content(role='user', parts=[
+            genai_types.Part.from_function_response(name=call.name, response=result)
+            for call, result in zip(function_calls, results)
+        ]))
+    
+    def _generate_content(self, contents, prepared, task):
+        """
+        Chama o Gemini pelo roteador de modelos: cadeia do tipo de turno,
+        com timeout por modelo, hedging e circuit breaker
+        """
+        contents = list(contents)  # chamadas de hedge podem terminar depois da próxima rodada
+        return self.model_router.call(
+            task, lambda model, timeout: self._request_content(contents, prepared, model, timeout)
+        )
+    
+    async def _generate_content_async(self, contents, prepared, task):
+        """Versão assíncrona de _generate_content"""
+        contents = list(contents)
+        return await self.model_router.call_async(
+            task, lambda model, timeout: self._request_content_async(contents, prepared, model, timeout)
+        )
+    
+    def _generate_content_stream(self, contents, prepared, task):
+        """Versão em streaming de _generate_content (fallback só antes do primeiro pedaço)"""
+        yield from self.model_router.stream(
+            task, lambda model, timeout: self._request_content_stream(contents, prepared, model, timeout)
+        )
+    
+    async def _generate_content_stream_async(self, contents, prepared, task):
+        """Versão assíncrona de _generate_content_stream"""
+        stream = self.model_router.stream_async(
+            task, lambda model, timeout: self._request_content_stream_async(contents, prepared, model, timeout)
+        )
+        async for chunk in stream:
+            yield chunk
+    
+    def _request_content(self, contents, prepared, model, timeout):
+        """
+        Chama um modelo usando o cache de contexto quando disponível; se o
+        cache não existir mais (expirado/removido), invalida e reenvia o
+        prompt inline. Demais falhas (timeout, 429, 5xx) vão para o roteador,
+        sem gastar um segundo timeout nem descartar o cache
+        """
+        context_cache = self.get_context_cache(model)
+        cached_content = context_cache.get_cached_content(
+            prepared['version'], prepared['system_prompt'], prepared['variant'], prepared['tools']
+        )
+        if cached_content:
+            try:
+                return self.client.models.generate_content(
+                    model=model,
+                    contents=contents,
+                    config=self._build_config(cached_content=cached_content, timeout=timeout)
+                )
+            except Exception as e:
+                if not is_context_cache_error(e):
+                    raise
+                print(f"Falha usando cache de contexto ({cached_content}): {e}. Reenviando prompt inline.")
+                context_cache.invalidate(prepared['version'], prepared['variant'])
+        
+        return self.client.models.generate_content(
+            model=model,
+            contents=contents,
+            config=self._build_config(system_instruction=prepared['system_prompt'], tools=prepared['tools'], timeout=timeout)
+        )
+    
+    async def _request_content_async(self, contents, prepared, model, timeout):
+        """Versão assíncrona de _request_content"""
+        context_cache = self.get_context_cache(model)
+        cached_content = await sync_to_async(context_cache.get_cached_content)(
+            prepared['version'], prepared['system_prompt'], prepared['variant'], prepared['tools']
+        )
+        if cached_content:
+            try:
+                return await self.client.aio.models.generate_content(
+                    model=model,
+                    contents=contents,
+                    config=self._build_config(cached_content=cached_content, timeout=timeout)
+                )
+            except Exception as e:
+                if not is_context_cache_error(e):
+                    raise
+                print(f"Falha usando cache de contexto ({cached_content}): {e}. Reenviando prompt inline.")
+                await sync_to_async(context_cache.invalidate)(prepared['version'], prepared['variant'])
+        
+        return await self.client.aio.models.generate_content(
+            model=model,
+            contents=contents,
+            config=self._build_config(system_instruction=prepared['system_prompt'], tools=prepared['tools'], timeout=timeout)
+        )
+    
+    def _request_content_stream(self, contents, prepared, model, timeout):
+        """
+        Versão em streaming de _request_content
+
+        O streaming só começa no primeiro pedaço, então uma falha do cache de
+        contexto aparece antes de qualquer texto e ainda permite reenviar o
+        prompt inline.
+        """
+        context_cache = self.get_context_cache(model)
+        cached_content = context_cache.get_cached_content(
+            prepared['version'], prepared['system_prompt'], prepared['variant'], prepared['tools']
+        )
+        if cached_content:
+            try:
+                stream = self.client.models.generate_content_stream(
+                    model=model,
+                    contents=contents,
+                    config=self._build_config(cached_content=cached_content, timeout=timeout)
+                )
+                first = next(stream, None)
+            except Exception as e:
+                if not is_context_cache_error(e):
+                    raise
+                print(f"Falha usando cache de contexto ({cached_content}): {e}. Reenviando prompt inline.")
+                context_cache.invalidate(prepared['version'], prepared['variant'])
+            else:
+                if first is not None:
+                    yield first
+                yield from stream
+                return
+        
+        yield from self.client.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=self._build_config(system_instruction=prepared['system_prompt'], tools=prepared['tools'], timeout=timeout)
+        )
+    
+    async def _request_content_stream_async(self, contents, prepared, model, timeout):
+        """Versão assíncrona de _request_content_stream"""
+        context_cache = self.get_context_cache(model)
+        cached_content = await sync_to_async(context_cache.get_cached_content)(
+            prepared['version'], prepared['system_prompt'], prepared['variant'], prepared['tools']
+        )
+        if cached_content:
+            try:
+                stream = await self.client.aio.models.generate_content_stream(
+                    model=model,
+                    contents=contents,
+                    config=self._build_config(cached_content=cached_content, timeout=timeout)
+                )
+                first = await anext(stream, None)
+            except Exception as e:
+                if not is_context_cache_error(e):
+                    raise
+                print(f"Falha usando cache de contexto ({cached_content}): {e}. Reenviando prompt inline.")
+                await sync_to_async(context_cache.invalidate)(prepared['version'], prepared['variant'])
+            else:
+                if first is not None:
+                    yield first
+                async for chunk in stream:
+                    yield chunk
+                return
+        
+        stream = await self.client.aio.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=self._build_config(system_instruction=prepared['system_prompt'], tools=prepared['tools'], timeout=timeout)
+        )
+        async for chunk in stream:
+            yield chunk
+    
+    def _prepare_prompt(self, mode=None):
+        """
+        Retorna o modo, a versão da base, a variante, o prompt do sistema e
+        as ferramentas do modo (o cache de contexto é resolvido por modelo)
+        """
+        mode = mode or get_ai_mode()
+        tools = [SCHEDULING_TOOLS] if mode == 'ferramentas' else None
+        version, system_prompt = self._get_versioned_system_prompt(mode)
+        
+        variant = get_prompt_variant(mode)
+        
+        return {
+            'mode': mode,
+            'version': version,
+            'variant': variant,
+            'system_prompt': system_prompt,
+            'tools': tools,
+        }
+    
+    def _build_contents(self, chat_history):
+        """
+        Converte o histórico (role/parts) para o formato do Gemini
+
+        Com a recuperação habilitada, os trechos da base de conhecimento
+        relevantes para as mensagens recentes entram antes da última
+        mensagem do usuário. Pode consultar o banco quando a base muda.
+        """
+        def to_parts(parts_list):
+            return [genai_types.Part.from_text(text=p) for p in parts_list]
+        
+        contents = []
+        for item in chat_history:
+            role = item.get('role', 'user')
+            parts = item.get('parts', [])
+            contents.append(genai_types.Content(role=role, parts=to_parts(parts)))
+        
+        if get_retrieval_setting('ENABLED') and chat_history and chat_history[-1].get('role', 'user') == 'user':
+            recentes = chat_history[-get_retrieval_setting('MENSAGENS_CONSULTA'):]
+            context = retrieve_context(' '.join(part for item in recentes for part in item.get('parts', [])))
+            if context:
+                contents[-1].parts.insert(0, genai_types.Part.from_text(text=context))
+        
+        return contents
+    
+    def _build_config(self, system_instruction=None, cached_content=None, tools=None, timeout=None):
+        """
+        Monta a configuração da chamada: prompt inline (com as ferramentas do
+        modo) ou referência ao cache, que já contém prompt e ferramentas, e o
+        timeout do modelo (em segundos)
+        """
+        return genai_types.GenerateContentConfig(
+            system_instruction=system_instruction,
+            cached_content=cached_content,
+            tools=tools,
+            thinking_config=genai_types.ThinkingConfig(thinking_budget=0),
+            http_options=genai_types.HttpOptions(timeout=int(timeout * 1000)) if timeout else None
+        )
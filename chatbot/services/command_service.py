@@ -0,0 +1,309 @@
+"""
+Serviço responsável por executar os comandos que a IA envia ao sistema
+([CONSULTAR_AGENDA], [CRIAR_AGENDAMENTO] e [DIRECIONAR_SECRETARIA]), seja
+como texto na resposta ou como chamada de ferramenta (function calling)
+
+Os argumentos são interpretados (médico por aproximação de nome, datas
+relativas em português, horário) e o comando é despachado para o
+AgendamentoService. O resultado vira uma resposta pronta (template), sem
+nova chamada à IA.
+"""
+import threading
+from datetime import date, datetime, timedelta
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from agendamento.services.agendamento_service import AgendamentoService
+from clinica.knowledge_base import get_knowledge_base_snapshot, get_knowledge_base_version
+from clinica.models import Medico
+
+from ..utils.command_parser import normalize_text, resolve_date, resolve_time
+from ..utils.formatters import format_list
+
+DEFAULT_COMMAND_SETTINGS = {
+    'FRASEAR_COM_IA': False,
+    'MAX_HORARIOS_LISTADOS': 8,
+    'DIAS_ALTERNATIVOS': 14,
+    'SIMILARIDADE_MINIMA_MEDICO': 0.75,
+}
+
+# Ferramentas declaradas ao Gemini -> comandos equivalentes
+TOOL_COMMANDS = {
+    'consultar_agenda': 'CONSULTAR_AGENDA',
+    'criar_agendamento': 'CRIAR_AGENDAMENTO',
+    'direcionar_secretaria': 'DIRECIONAR_SECRETARIA',
+}
+
+DIAS_SEMANA = ['segunda-feira', 'terça-feira', 'quarta-feira', 'quinta-feira', 'sexta-feira', 'sábado', 'domingo']
+
+# Palavras ignoradas ao comparar nomes de médicos
+PALAVRAS_IGNORADAS = {'o', 'a', 'dr', 'dra', 'doutor', 'doutora', 'de', 'da', 'do', 'das', 'dos', 'e'}
+
+_doctor_index: Tuple[Optional[int], List[Dict]] = (None, [])
+_doctor_index_lock = threading.Lock()
+
+
+def get_command_setting(name: str):
+    """Lê uma configuração dos comandos (settings.CHATBOT_COMMANDS) com valor padrão"""
+    return getattr(settings, 'CHATBOT_COMMANDS', {}).get(name, DEFAULT_COMMAND_SETTINGS[name])
+
+
+def _name_tokens(nome: str) -> List[str]:
+    """Tokens significativos de um nome (sem títulos e preposições)"""
+    return [token for token in normalize_text(nome).replace('.', ' ').split() if token not in PALAVRAS_IGNORADAS]
+
+
+def get_doctor_index() -> List[Dict]:
+    """
+    Índice de médicos para busca por nome, montado a partir do snapshot da
+    base de conhecimento e reconstruído apenas quando a versão muda
+    """
+    global _doctor_index
+
+    version = get_knowledge_base_version()
+    index_version, index = _doctor_index
+    if index_version == version:
+        return index
+
+    with _doctor_index_lock:
+        index_version, index = _doctor_index
+        if index_version != version:
+            index = [
+                {'id': medico['id'], 'nome': medico['nome'], 'tokens': _name_tokens(medico['nome'])}
+                for medico in get_knowledge_base_snapshot()['medicos']
+            ]
+            _doctor_index = (version, index)
+
+    return index
+
+
+def resolve_medico(nome: str) -> Optional[Dict]:
+    """
+    Encontra o médico pelo nome informado, tolerando títulos, acentos,
+    nomes parciais e pequenos erros de digitação
+
+    Args:
+        nome: Nome como escrito pela IA/paciente (ex: "O Dr. Gleiton")
+
+    Returns:
+        Dicionário com id e nome do médico ou None se não houver candidato claro
+    """
+    tokens = _name_tokens(nome)
+    if not tokens:
+        return None
+
+    melhor, melhor_score = None, 0.0
+    for medico in get_doctor_index():
+        if not medico['tokens']:
+            continue
+        # Para cada palavra informada, a palavra mais parecida do nome do médico
+        score = sum(
+            max(SequenceMatcher(None, token, token_medico).ratio() for token_medico in medico['tokens'])
+            for token in tokens
+        ) / len(tokens)
+        if score > melhor_score:
+            melhor, melhor_score = medico, score
+
+    if melhor_score < get_command_setting('SIMILARIDADE_MINIMA_MEDICO'):
+        return None
+    return {'id': melhor['id'], 'nome': melhor['nome']}
+
+
+def format_dia(dia: date) -> str:
+    """Data por extenso curta: 25/08 (segunda-feira)"""
+    return f"{dia:%d/%m} ({DIAS_SEMANA[dia.isoweekday() - 1]})"
+
+
+class CommandResult:
+    """Resultado da execução de um comando"""
+
+    def __init__(self, resposta: str, contexto: str = '', direcionamento: str = None, medico: Medico = None):
+        self.resposta = resposta                # Texto pronto para o paciente
+        self.contexto = contexto                # Fatos usados se a resposta for reescrita pela IA
+        self.direcionamento = direcionamento    # Tipo de direcionamento a criar (se houver)
+        self.medico = medico
+
+
+class CommandService:
+    """Serviço para executar comandos da IA com dados reais da agenda"""
+
+    def __init__(self, agendamento_service: AgendamentoService = None):
+        self.agendamento_service = agendamento_service or AgendamentoService()
+
+    def execute(self, nome: str, args: Dict[str, str], telefone_whatsapp: str) -> CommandResult:
+        """
+        Executa um comando já interpretado
+
+        Args:
+            nome: Nome do comando (ex: CONSULTAR_AGENDA)
+            args: Argumentos do comando
+            telefone_whatsapp: Telefone do paciente da conversa
+
+        Returns:
+            CommandResult com a resposta ao paciente
+        """
+        print(f"COMANDO DETECTADO: [{nome}]")
+
+        if nome == 'CONSULTAR_AGENDA':
+            return self._consultar_agenda(args)
+        if nome == 'CRIAR_AGENDAMENTO':
+            return self._criar_agendamento(args, telefone_whatsapp)
+
+        return CommandResult(
+            "Vou encaminhar sua dúvida para nossa secretária. Em breve você receberá um contato!",
+            direcionamento='duvida_complexa',
+        )
+
+    def execute_tool(self, nome: str, args: Dict, telefone_whatsapp: str) -> CommandResult:
+        """
+        Executa uma chamada de ferramenta do Gemini como o comando equivalente
+
+        Args:
+            nome: Nome da ferramenta (ex: consultar_agenda)
+            args: Argumentos da chamada
+            telefone_whatsapp: Telefone do paciente da conversa
+
+        Returns:
+            CommandResult com o resultado da ferramenta
+        """
+        if nome not in TOOL_COMMANDS:
+            raise ValueError(f"Ferramenta desconhecida: {nome}")
+
+        # Argumentos chegam tipados (JSON); os comandos trabalham com texto
+        args = {chave.lower(): str(valor).strip() for chave, valor in (args or {}).items() if valor is not None}
+        return self.execute(TOOL_COMMANDS[nome], args, telefone_whatsapp)
+
+    def _consultar_agenda(self, args: Dict[str, str]) -> CommandResult:
+        medico, dia, erro = self._resolve_medico_e_dia(args)
+        if erro:
+            return erro
+
+        horarios = self._horarios_livres(medico, dia)
+        if horarios:
+            lista = format_list(horarios, max_items=get_command_setting('MAX_HORARIOS_LISTADOS'))
+            return CommandResult(
+                f"Consultei a agenda de {medico.nome} para {format_dia(dia)} e estes horários estão "
+                f"disponíveis: {lista}. Qual você prefere?",
+                contexto=f"Horários livres de {medico.nome} em {format_dia(dia)}: {', '.join(horarios)}",
+            )
+
+        return self._sem_horarios(medico, dia)
+
+    def _criar_agendamento(self, args: Dict[str, str], telefone_whatsapp: str) -> CommandResult:
+        medico, dia, erro = self._resolve_medico_e_dia(args)
+        if erro:
+            return erro
+
+        horario = resolve_time(args.get('horario', ''))
+        if horario is None:
+            return CommandResult(f"Qual horário você prefere em {format_dia(dia)}? Por exemplo: 10:00.")
+
+        nome_paciente = ' '.join(args.get('nome_paciente', '').split())
+        if not nome_paciente:
+            return CommandResult("Para finalizar, pode me informar seu nome completo?")
+
+        inicio = timezone.make_aware(datetime.combine(dia, horario))
+        if inicio <= timezone.now():
+            return CommandResult("Esse horário já passou. Pode escolher outro horário?")
+
+        # Só agenda horários da grade do médico (a reserva cobre a concorrência)
+        horarios = self._horarios_livres(medico, dia)
+        if f"{horario:%H:%M}" not in horarios:
+            if not horarios:
+                return self._sem_horarios(medico, dia, prefixo="Esse horário não está disponível. ")
+            lista = format_list(horarios, max_items=get_command_setting('MAX_HORARIOS_LISTADOS'))
+            return CommandResult(
+                f"Esse horário não está disponível. Em {format_dia(dia)} tenho: {lista}. Qual você prefere?",
+                contexto=f"Horário {horario:%H:%M} indisponível; livres em {format_dia(dia)}: {', '.join(horarios)}",
+            )
+
+        try:
+            self.agendamento_service.create_agendamento(
+                paciente_nome=nome_paciente,
+                paciente_telefone=telefone_whatsapp,
+                medico=medico,
+                data_hora_inicio=inicio,
+            )
+        except ValueError:
+            horarios = self._horarios_livres(medico, dia)
+            if not horarios:
+                return self._sem_horarios(medico, dia, prefixo="Esse horário acabou de ser ocupado. ")
+            lista = format_list(horarios, max_items=get_command_setting('MAX_HORARIOS_LISTADOS'))
+            return CommandResult(
+                f"Esse horário acabou de ser ocupado. Ainda tenho em {format_dia(dia)}: {lista}. Qual você prefere?",
+                contexto=f"Horário {horario:%H:%M} ocupado; livres em {format_dia(dia)}: {', '.join(horarios)}",
+            )
+
+        # A secretária confirma o agendamento com o paciente
+        return CommandResult(
+            f"Prontinho, {nome_paciente}! Sua consulta com {medico.nome} ficou reservada para "
+            f"{format_dia(dia)} às {horario:%H:%M}. Nossa secretária entrará em contato para confirmar.",
+            contexto=f"Consulta reservada: {medico.nome}, {format_dia(dia)}, {horario:%H:%M}, paciente {nome_paciente}",
+            direcionamento='agendamento',
+            medico=medico,
+        )
+
+    def _resolve_medico_e_dia(self, args: Dict[str, str]) -> Tuple[Optional[Medico], Optional[date], Optional[CommandResult]]:
+        """Interpreta médico e dia; em caso de falha devolve a resposta ao paciente"""
+        encontrado = resolve_medico(args.get('medico', ''))
+        if encontrado is None:
+            nomes = [medico['nome'] for medico in get_doctor_index()]
+            return None, None, CommandResult(
+                f"Não encontrei o(a) médico(a) \"{args.get('medico', '')}\". "
+                f"Atendem aqui: {format_list(nomes)}. Com qual deseja agendar?"
+            )
+
+        hoje = timezone.localdate()
+        dia = resolve_date(args.get('dia', ''), hoje)
+        if dia is None:
+            return None, None, CommandResult(
+                "Não consegui entender a data. Pode me informar o dia no formato dd/mm? Por exemplo: 25/08."
+            )
+        if dia < hoje:
+            return None, None, CommandResult("Essa data já passou. Para qual dia você gostaria de agendar?")
+
+        medico = Medico.objects.filter(pk=encontrado['id']).first()
+        if medico is None:
+            return None, None, CommandResult("Não encontrei esse médico na agenda. Com qual médico deseja agendar?")
+
+        return medico, dia, None
+
+    def _horarios_livres(self, medico: Medico, dia: date) -> List[str]:
+        """Horários livres do dia (ignorando os que já passaram)"""
+        agora = timezone.now()
+        return [
+            slot['hora']
+            for slot in self.agendamento_service.get_available_slots(medico, dia)
+            if slot['datetime'] > agora
+        ]
+
+    def _sem_horarios(self, medico: Medico, dia: date, prefixo: str = '') -> CommandResult:
+        """Resposta quando o dia não tem horários: sugere os próximos dias com vagas"""
+        proximos = self.agendamento_service.get_available_slots_range(
+            medico,
+            dia + timedelta(days=1),
+            dia + timedelta(days=get_command_setting('DIAS_ALTERNATIVOS')),
+        )
+
+        sugestoes = [
+            f"{format_dia(outro_dia)}: {format_list([slot['hora'] for slot in slots], max_items=3)}"
+            for outro_dia, slots in sorted(proximos.items())
+            if slots
+        ][:3]
+
+        if not sugestoes:
+            return CommandResult(
+                f"{prefixo}Não encontrei horários livres com {medico.nome} nos próximos dias. "
+                "Quer que eu encaminhe seu pedido para nossa secretária?",
+                contexto=f"Sem horários livres de {medico.nome} a partir de {format_dia(dia)}",
+            )
+
+        return CommandResult(
+            f"{prefixo}Não há horários livres com {medico.nome} em {format_dia(dia)}. "
+            f"Os próximos disponíveis são:\n" + "\n".join(f"- {sugestao}" for sugestao in sugestoes)
+            + "\nAlgum desses funciona para você?",
+            contexto=f"Sem horários em {format_dia(dia)}; próximos: {'; '.join(sugestoes)}",
+        )
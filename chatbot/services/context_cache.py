@@ -0,0 +1,166 @@
+"""
+Cache de contexto do Gemini para o prompt do sistema
+
+O prompt do sistema (persona + regras + base de conhecimento) é idêntico em
+todas as mensagens de uma mesma versão da base de conhecimento. Em vez de
+reenviá-lo a cada chamada, ele é enviado uma única vez para
+`client.caches.create` e as chamadas seguintes referenciam o nome do cache
+em `GenerateContentConfig(cached_content=...)`.
+"""
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from google.genai import errors as genai_errors
+from google.genai import types as genai_types
+
+DEFAULT_CONTEXT_CACHE_SETTINGS = {
+    'ENABLED': True,
+    'TTL_SEGUNDOS': 3600,
+    'MARGEM_RENOVACAO_SEGUNDOS': 300,
+    'ESPERA_APOS_FALHA_SEGUNDOS': 300,
+}
+
+SHARED_CACHE_KEY = 'chatbot:gemini_context_cache:{model}:{variant}:{version}'
+
+
+def get_context_cache_setting(name: str):
+    """Lê uma configuração do cache de contexto (settings.GEMINI_CONTEXT_CACHE)"""
+    return getattr(settings, 'GEMINI_CONTEXT_CACHE', {}).get(name, DEFAULT_CONTEXT_CACHE_SETTINGS[name])
+
+
+def is_context_cache_error(error: Exception) -> bool:
+    """
+    Indica se a falha de uma chamada com `cached_content` foi causada pelo
+    próprio cache de contexto (inexistente, expirado ou sem acesso)
+
+    Timeouts, 429 e 5xx não são falhas do cache: seguem para o roteador de
+    modelos (fallback/circuit breaker) e o cache continua válido.
+    """
+    if not isinstance(error, genai_errors.ClientError) or error.code == 429:
+        return False
+    return 'cache' in str(error.message or error).lower()
+
+
+class GeminiContextCache:
+    """
+    Gerencia o cache de contexto do prompt do sistema por versão da base
+
+    - Cria o cache uma vez por (modelo, versão, variante do prompt) e
+      compartilha o nome entre processos pelo cache do Django;
+    - Renova o TTL antes de expirar;
+    - Em caso de falha retorna None (o chamador envia o prompt inline) e só
+      tenta de novo depois de `ESPERA_APOS_FALHA_SEGUNDOS`.
+
+    Recebe o `genai.Client` por parâmetro, então pode ser exercitado com um
+    cliente falso que implemente `caches.create` e `caches.update`.
+    """
+
+    def __init__(self, client, model: str):
+        self.client = client
+        self.model = model
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, int, str], Tuple[str, float]] = {}  # (modelo, versão, variante) -> (nome, expira_em)
+        self._failures: Dict[Tuple[str, int, str], float] = {}  # (modelo, versão, variante) -> instante da última falha
+
+    @property
+    def enabled(self) -> bool:
+        return bool(get_context_cache_setting('ENABLED'))
+
+    def get_cached_content(self, version: int, system_prompt: str, variant: str = 'comandos', tools=None) -> Optional[str]:
+        """
+        Retorna o nome do cache de contexto para a versão informada
+
+        Args:
+            version: Versão da base de conhecimento
+            system_prompt: Prompt do sistema correspondente à versão
+            variant: Variante do prompt (modo da IA), parte da chave do cache
+            tools: Declarações de ferramentas; com cache de contexto elas
+                precisam estar no próprio cache, não na chamada
+
+        Returns:
+            Nome do cache (ex: cachedContents/abc123) ou None para usar o prompt inline
+        """
+        if not self.enabled:
+            return None
+
+        key = (self.model, version, variant)
+        now = time.time()
+        margem = get_context_cache_setting('MARGEM_RENOVACAO_SEGUNDOS')
+
+        entry = self._entries.get(key)
+        if entry and now < entry[1] - margem:
+            return entry[0]
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now < entry[1] - margem:
+                return entry[0]
+
+            ultima_falha = self._failures.get(key)
+            if ultima_falha and now - ultima_falha < get_context_cache_setting('ESPERA_APOS_FALHA_SEGUNDOS'):
+                return None
+
+            try:
+                shared = self._load_shared(key)
+                if shared and now < shared[1] - margem:
+                    # Outro processo já criou/renovou o cache desta versão
+                    entry = shared
+                else:
+                    entry = self._refresh(shared or self._entries.get(key), system_prompt, tools)
+                    self._store_shared(key, entry)
+            except Exception as e:
+                print(f"Erro no cache de contexto do Gemini: {e}. Usando prompt inline.")
+                self._failures[key] = now
+                self._entries.pop(key, None)
+                return None
+
+            self._failures.pop(key, None)
+            self._entries[key] = entry
+            return entry[0]
+
+    def invalidate(self, version: int, variant: str = 'comandos'):
+        """
+        Descarta o cache da versão (ex: o servidor respondeu que ele não existe mais)
+        """
+        key = (self.model, version, variant)
+        with self._lock:
+            self._entries.pop(key, None)
+            cache.delete(SHARED_CACHE_KEY.format(model=self.model, variant=variant, version=version))
+
+    def _refresh(self, entry: Optional[Tuple[str, float]], system_prompt: str, tools=None) -> Tuple[str, float]:
+        """Renova o TTL do cache existente ou cria um novo"""
+        ttl = get_context_cache_setting('TTL_SEGUNDOS')
+
+        if entry is not None:
+            try:
+                cached = self.client.caches.update(
+                    name=entry[0],
+                    config=genai_types.UpdateCachedContentConfig(ttl=f"{ttl}s"),
+                )
+                return cached.name, time.time() + ttl
+            except Exception as e:
+                print(f"Não foi possível renovar o cache de contexto {entry[0]}: {e}")
+
+        cached = self.client.caches.create(
+            model=self.model,
+            config=genai_types.CreateCachedContentConfig(
+                display_name='pneumosono-system-prompt',
+                system_instruction=system_prompt,
+                tools=tools,
+                ttl=f"{ttl}s",
+            ),
+        )
+        print(f"Cache de contexto do Gemini criado: {cached.name}")
+        return cached.name, time.time() + ttl
+
+    def _load_shared(self, key: Tuple[str, int, str]) -> Optional[Tuple[str, float]]:
+        """Busca o cache criado por qualquer processo para a versão"""
+        entry = cache.get(SHARED_CACHE_KEY.format(model=key[0], version=key[1], variant=key[2]))
+        return tuple(entry) if entry else None
+
+    def _store_shared(self, key: Tuple[str, int, str], entry: Tuple[str, float]):
+        timeout = max(1, int(entry[1] - time.time()))
+        cache.set(SHARED_CACHE_KEY.format(model=key[0], version=key[1], variant=key[2]), entry, timeout)
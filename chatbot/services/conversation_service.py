@@ -1,24 +1,81 @@
 """
 Serviço responsável pelo gerenciamento de conversas e estados
 """
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.utils import timezone
-from django.db import transaction
+from django.db import IntegrityError, transaction
 
-from .ai_service import AIService
-from .whatsapp_service import WhatsAppService
+from .ai_service import AI_ERROR_MESSAGE, TOOL_LIMIT_MESSAGE, get_ai_mode
+from .command_service import TOOL_COMMANDS, CommandResult, get_command_setting
+from .intent_router import IntentRouter
+from .message_buffer import MessageBuffer
+from .patient_lock import PatientLock
+from .patient_state import load_patient_state
+from .registry import get_ai_service, get_command_service, get_whatsapp_service
+from .response_cache import FAQResponseCache
 from ..models import Conversa, MensagemConversa, Direcionamento
+from ..utils.command_parser import parse_command
+from ..utils.formatters import truncate_text
+from ..utils.stream_chunker import StreamChunker, StreamRelay
 from usuarios.models import Paciente
 
 
+PENDING_DIRECIONAMENTO_MESSAGE = "Sua solicitação já foi encaminhada para nossa secretária. Aguarde o contato!"
+
+PHRASING_INSTRUCTION = (
+    "[SISTEMA] Reescreva sua última mensagem ao paciente de forma natural e cordial, "
+    "sem alterar nenhum dado (médico, datas, horários, nomes) e sem usar comandos. "
+    "Dados consultados: {contexto}"
+)
+
+DEFAULT_HISTORY_SETTINGS = {
+    'MAX_MENSAGENS': 20,
+    'MAX_TOKENS': 3000,
+    'MAX_CARACTERES_RESUMO': 2000,
+}
+
+DEFAULT_STREAMING_SETTINGS = {
+    'ENABLED': True,
+    'MIN_CARACTERES': 60,
+    'MAX_CARACTERES': 400,
+    'INDICADOR_DIGITANDO': True,
+}
+
+
+def get_history_setting(name: str):
+    """Lê uma configuração do histórico (settings.CHATBOT_HISTORY) com valor padrão"""
+    return getattr(settings, 'CHATBOT_HISTORY', {}).get(name, DEFAULT_HISTORY_SETTINGS[name])
+
+
+def get_streaming_setting(name: str):
+    """Lê uma configuração do streaming (settings.CHATBOT_STREAMING) com valor padrão"""
+    return getattr(settings, 'CHATBOT_STREAMING', {}).get(name, DEFAULT_STREAMING_SETTINGS[name])
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimativa simples de tokens (~4 caracteres por token)"""
+    return len(text) // 4 + 1
+
+
 class ConversationService:
     """Serviço para gerenciar o estado e fluxo das conversas"""
     
-    def __init__(self):
-        self.ai_service = AIService()
-        self.whatsapp_service = WhatsAppService()
+    def __init__(self, ai_service=None, whatsapp_service=None, command_service=None):
+        """
+        Args:
+            ai_service, whatsapp_service, command_service: Dependências
+                (opcionais, ex: falsos em testes); por padrão, as instâncias
+                compartilhadas do registro de serviços
+        """
+        self.ai_service = ai_service or get_ai_service()
+        self.whatsapp_service = whatsapp_service or get_whatsapp_service()
+        self.command_service = command_service or get_command_service()
+        self.response_cache = FAQResponseCache()
+        self.intent_router = IntentRouter()
     
-    def process_user_message(self, telefone_whatsapp: str, message_text: str) -> str:
+    def process_user_message(self, telefone_whatsapp: str, message_text: str) -> Optional[str]:
         """
         Processa mensagem do usuário e retorna resposta
         
@@ -27,37 +84,387 @@ class ConversationService:
             message_text: Texto da mensagem recebida
             
         Returns:
-            Resposta processada para enviar ao usuário
+            Resposta processada para enviar ao usuário, ou None quando a
+            mensagem foi respondida junto com outra do mesmo paciente
+        """
+        return self.process_user_messages(telefone_whatsapp, [message_text])
+    
+    def process_user_messages(self, telefone_whatsapp: str, message_texts: List[str],
+                              on_chunk: Optional[Callable[[str], None]] = None,
+                              on_saved: Optional[Callable[[Optional[str]], None]] = None,
+                              message_ids: Optional[List[Optional[str]]] = None) -> Optional[str]:
+        """
+        Processa uma ou mais mensagens seguidas do mesmo paciente com uma
+        única chamada à IA
+        
+        O fluxo é dividido em fases curtas para não manter transação (e o lock
+        de escrita do SQLite) aberta durante a chamada à IA:
+        1. transação: paciente, conversa ativa e mensagens do usuário
+           (salvas como não processadas);
+        2. lock do paciente: histórico e chamada à IA sobre todas as
+           mensagens ainda não processadas, fora de transação;
+        3. transação: confere se a conversa continua ativa, salva a resposta,
+           marca as mensagens como processadas e aplica os comandos.
+        
+        Mensagens que chegam enquanto outra chamada do mesmo paciente
+        aguarda a IA são respondidas em conjunto pela próxima chamada que
+        obtiver o lock; as demais retornam None (nada a enviar).
+        
+        Com `on_chunk` (e streaming habilitado no modo 'comandos'), a
+        resposta é gerada em streaming e cada trecho completo é entregue a
+        `on_chunk` assim que fica pronto; o retorno é apenas o que ainda
+        falta enviar (ex: o resultado de um comando).
+        
+        Args:
+            telefone_whatsapp: Número do WhatsApp do usuário
+            message_texts: Textos recebidos, em ordem
+            on_chunk: Envia um trecho da resposta ao paciente (opcional)
+            on_saved: Chamada dentro da transação da fase 3 com o que falta
+                enviar ao paciente (ex: a fila registra o turno como
+                respondido, para que uma nova tentativa não repita a IA)
+            message_ids: Ids do WhatsApp de cada texto (opcional); uma
+                mensagem com id já registrado não é gravada de novo
+            
+        Returns:
+            Resposta processada para enviar ao usuário ou None
         """
-        with transaction.atomic():
-            # 1. Busca/cria paciente
-            paciente, created = Paciente.objects.get_or_create(
-                telefone_whatsapp=telefone_whatsapp
+        # Fase 1: registra as mensagens recebidas
+        conversa, early_response = self._begin_turn(telefone_whatsapp, message_texts, message_ids)
+        if early_response is not None:
+            return early_response
+        
+        with PatientLock(telefone_whatsapp):
+            # Fase 2: gera histórico e resposta da IA (fora de transação)
+            chat_history, pendentes, pergunta, cached = self._prepare_turn(conversa)
+            if not pendentes:
+                # Já respondida junto com outra mensagem do paciente
+                return None
+            
+            acoes = []
+            nao_enviado = None
+            if cached is not None:
+                ai_response = cached
+            elif get_ai_mode() == 'ferramentas':
+                ai_response = self.ai_service.generate_response_with_tools(
+                    chat_history, self._build_tool_executor(telefone_whatsapp, acoes)
+                )
+            elif on_chunk is not None and get_streaming_setting('ENABLED'):
+                ai_response, nao_enviado = self._stream_response(chat_history, on_chunk)
+            else:
+                ai_response = self.ai_service.generate_response(chat_history)
+            
+            # Fase 3: salva resposta e processa comandos
+            response, rephrase = self._complete_turn(
+                conversa, ai_response, pendentes, acoes, pergunta, cached, nao_enviado, on_saved
             )
             
-            # 2. Verifica se tem direcionamento pendente
-            if paciente.has_pending_direcionamento():
-                return "Sua solicitação já foi encaminhada para nossa secretária. Aguarde o contato!"
+            # Segunda chamada à IA só quando o resultado do comando deve ser
+            # redigido por ela (CHATBOT_COMMANDS['FRASEAR_COM_IA'])
+            if rephrase:
+                chat_history = self._build_phrasing_history(conversa, rephrase[1])
+                response = self._apply_phrasing(rephrase[0], response, self.ai_service.generate_response(chat_history))
             
-            # 3. Busca/cria conversa ativa
-            conversa = self._get_or_create_active_conversation(paciente)
+            return response
+    
+    async def process_user_message_async(self, telefone_whatsapp: str, message_text: str) -> Optional[str]:
+        """
+        Versão assíncrona de process_user_message
+        
+        Args:
+            telefone_whatsapp: Número do WhatsApp do usuário
+            message_text: Texto da mensagem recebida
             
-            # 4. Salva mensagem do usuário
-            self._save_message(conversa, 'user', message_text)
+        Returns:
+            Resposta processada para enviar ao usuário ou None
+        """
+        return await self.process_user_messages_async(telefone_whatsapp, [message_text])
+    
+    async def process_user_messages_async(self, telefone_whatsapp: str, message_texts: List[str],
+                                          on_chunk: Optional[Callable] = None,
+                                          on_saved: Optional[Callable[[Optional[str]], None]] = None,
+                                          message_ids: Optional[List[Optional[str]]] = None) -> Optional[str]:
+        """
+        Versão assíncrona de process_user_messages
+        
+        As fases de banco rodam via sync_to_async; a chamada à IA usa o
+        cliente assíncrono do Gemini e não ocupa thread enquanto aguarda.
+        
+        Args:
+            telefone_whatsapp: Número do WhatsApp do usuário
+            message_texts: Textos recebidos, em ordem
+            on_chunk: Corrotina que envia um trecho da resposta (opcional)
+            on_saved: Função síncrona chamada dentro da transação da fase 3
+                (ver process_user_messages)
+            message_ids: Ids do WhatsApp de cada texto (opcional)
             
-            # 5. Gera histórico para IA
-            chat_history = self._build_chat_history(conversa)
+        Returns:
+            Resposta processada para enviar ao usuário ou None
+        """
+        conversa, early_response = await sync_to_async(self._begin_turn)(telefone_whatsapp, message_texts, message_ids)
+        if early_response is not None:
+            return early_response
+        
+        async with PatientLock(telefone_whatsapp):
+            chat_history, pendentes, pergunta, cached = await sync_to_async(self._prepare_turn)(conversa)
+            if not pendentes:
+                return None
             
-            # 6. Gera resposta da IA
-            ai_response = self.ai_service.generate_response(chat_history)
+            acoes = []
+            nao_enviado = None
+            if cached is not None:
+                ai_response = cached
+            elif get_ai_mode() == 'ferramentas':
+                ai_response = await self.ai_service.generate_response_with_tools_async(
+                    chat_history, self._build_tool_executor(telefone_whatsapp, acoes)
+                )
+            elif on_chunk is not None and get_streaming_setting('ENABLED'):
+                ai_response, nao_enviado = await self._stream_response_async(chat_history, on_chunk)
+            else:
+                ai_response = await self.ai_service.generate_response_async(chat_history)
             
-            # 7. Salva resposta da IA
-            self._save_message(conversa, 'bot', ai_response)
+            response, rephrase = await sync_to_async(self._complete_turn)(
+                conversa, ai_response, pendentes, acoes, pergunta, cached, nao_enviado, on_saved
+            )
+            
+            if rephrase:
+                chat_history = await sync_to_async(self._build_phrasing_history)(conversa, rephrase[1])
+                phrased = await self.ai_service.generate_response_async(chat_history)
+                response = await sync_to_async(self._apply_phrasing)(rephrase[0], response, phrased)
+            
+            return response
+    
+    def _prepare_turn(self, conversa: Conversa) -> Tuple[List[Dict], List[int], Optional[str], Optional[str]]:
+        """
+        Fase 2 antes da IA: histórico, mensagens pendentes e resposta pronta
+        
+        As pendentes vêm das mesmas linhas do histórico: o que a IA responde
+        é exatamente o que será marcado como processado. Mensagens simples
+        são respondidas por template e perguntas sem contexto (início da
+        conversa) podem vir do cache de respostas.
+        
+        Returns:
+            (histórico, ids pendentes, pergunta sem contexto ou None,
+            resposta pronta ou None para chamar a IA)
+        """
+        chat_history, pendentes = self._build_turn_history(conversa)
+        if not pendentes:
+            return chat_history, pendentes, None, None
+        
+        pergunta = self._context_free_question(conversa, chat_history)
+        cached = self._route_intent(conversa, chat_history, pergunta)
+        if cached is None and pergunta:
+            cached = self.response_cache.lookup(pergunta)
+        return chat_history, pendentes, pergunta, cached
+    
+    def _complete_turn(self, conversa: Conversa, ai_response: str, pendentes: List[int], acoes: List,
+                       pergunta: Optional[str], cached: Optional[str], nao_enviado: Optional[str],
+                       on_saved: Optional[Callable[[Optional[str]], None]]) -> Tuple[Optional[str], Optional[Tuple[MensagemConversa, str]]]:
+        """
+        Fase 3: salva a resposta, aplica comandos e ações e guarda a resposta
+        no cache de respostas, se couber
+        
+        Returns:
+            (resposta ainda a enviar, (mensagem, contexto) se a IA deve reescrevê-la)
+        """
+        saved = None
+        if on_saved is not None:
+            saved = lambda response: on_saved(self._unsent_response(response, ai_response, nao_enviado))
+        response, rephrase = self._finish_turn(conversa, ai_response, pendentes, acoes, on_saved=saved)
+        if pergunta and cached is None:
+            self._remember_answer(conversa, pergunta, ai_response, response, acoes)
+        return self._unsent_response(response, ai_response, nao_enviado), rephrase
+    
+    def _context_free_question(self, conversa: Conversa, chat_history: List[Dict]) -> Optional[str]:
+        """
+        Pergunta do paciente quando o histórico não tem contexto anterior
+        (sem resumo nem respostas da IA), ou None
+        """
+        if conversa.resumo_historico or not chat_history or any(item['role'] != 'user' for item in chat_history):
+            return None
+        return '\n'.join(item['parts'][0] for item in chat_history)
+    
+    def _route_intent(self, conversa: Conversa, chat_history: List[Dict], pergunta: Optional[str]) -> Optional[str]:
+        """Resposta do roteador de intenções para as mensagens pendentes, ou None"""
+        pendentes = []
+        for item in reversed(chat_history):
+            if item['role'] != 'user':
+                break
+            pendentes.insert(0, item['parts'][0])
+        if not pendentes or (conversa.resumo_historico and len(pendentes) == len(chat_history)):
+            return None
+        
+        routed = self.intent_router.route('\n'.join(pendentes), has_context=pergunta is None)
+        return routed[1] if routed else None
+    
+    def _unsent_response(self, response: Optional[str], ai_response: str, nao_enviado: Optional[str]) -> Optional[str]:
+        """Resposta ainda a enviar: em texto comum, só o que não saiu no streaming"""
+        if nao_enviado is not None and response == ai_response:
+            return nao_enviado or None
+        return response
+    
+    def _remember_answer(self, conversa: Conversa, pergunta: str, ai_response: str, response: Optional[str], acoes: List):
+        """
+        Guarda no cache a resposta da IA, se for texto comum (sem comandos,
+        ações ou erro) e não citar o paciente
+        """
+        if acoes or response != ai_response or ai_response in (AI_ERROR_MESSAGE, TOOL_LIMIT_MESSAGE):
+            return
+        self.response_cache.store(pergunta, ai_response, nomes_paciente=[conversa.paciente.nome_completo])
+    
+    def _stream_response(self, chat_history: List[Dict], on_chunk: Callable[[str], None]) -> Tuple[str, str]:
+        """
+        Gera a resposta em streaming, enviando cada trecho completo a `on_chunk`
+        
+        Comandos ([CONSULTAR_AGENDA: ...]) nunca podem chegar ao paciente:
+        ao aparecer um "[" o envio é interrompido e o restante segue o fluxo
+        normal da fase 3 (ver StreamRelay).
+        
+        Returns:
+            (resposta completa da IA, texto ainda não enviado)
+        """
+        relay = self._build_relay()
+        for parte in self.ai_service.generate_response_stream(chat_history):
+            for chunk in relay.feed(parte):
+                relay.sent()
+                on_chunk(chunk)
+        for chunk in relay.finish():
+            relay.sent()
+            on_chunk(chunk)
+        return relay.result()
+    
+    async def _stream_response_async(self, chat_history: List[Dict], on_chunk: Callable) -> Tuple[str, str]:
+        """Versão assíncrona de _stream_response (`on_chunk` é uma corrotina)"""
+        relay = self._build_relay()
+        async for parte in self.ai_service.generate_response_stream_async(chat_history):
+            for chunk in relay.feed(parte):
+                relay.sent()
+                await on_chunk(chunk)
+        for chunk in relay.finish():
+            relay.sent()
+            await on_chunk(chunk)
+        return relay.result()
+    
+    def _build_relay(self) -> StreamRelay:
+        return StreamRelay(StreamChunker(
+            min_chars=get_streaming_setting('MIN_CARACTERES'),
+            max_chars=get_streaming_setting('MAX_CARACTERES'),
+        ))
+    
+    def _begin_turn(self, telefone_whatsapp: str, message_texts: List[str],
+                    message_ids: Optional[List[Optional[str]]] = None) -> Tuple[Optional[Conversa], Optional[str]]:
+        """
+        Fase 1 do processamento: transação curta que registra as mensagens
+        
+        Args:
+            message_ids: Ids do WhatsApp de cada texto (opcional). Numa nova
+                tentativa da fila as mensagens já gravadas são reconhecidas
+                pelo id; textos iguais com ids diferentes (ex: "ok" duas
+                vezes) são mensagens distintas
+        
+        Returns:
+            (conversa ativa, None) ou (None, resposta imediata) quando a
+            mensagem não deve ir para a IA
+        """
+        with transaction.atomic(), MessageBuffer() as mensagens:
+            # 1. Paciente, conversa ativa e pendências em uma única consulta
+            state = load_patient_state(telefone_whatsapp)
+            if state is None:
+                paciente, created = Paciente.objects.get_or_create(
+                    telefone_whatsapp=telefone_whatsapp
+                )
+                conversa = None
+                mensagens_pendentes = False
+            else:
+                # 2. Verifica se tem direcionamento pendente
+                if state.direcionamento_pendente:
+                    return None, PENDING_DIRECIONAMENTO_MESSAGE
+                paciente, conversa = state.paciente, state.conversa
+                mensagens_pendentes = state.mensagens_pendentes
+            
+            # 3. Cria a conversa ativa, se ainda não existe
+            if conversa is None:
+                conversa = self._get_or_create_active_conversation(paciente)
             
-            # 8. Processa comandos especiais
-            final_response = self._process_ai_commands(ai_response, conversa)
+            # 4. Salva mensagens do usuário. Ignora as que já foram gravadas
+            # por uma tentativa anterior da fila (mesmo id do WhatsApp), que
+            # só podem estar entre as ainda não processadas
+            message_ids = message_ids or [None] * len(message_texts)
+            ja_registradas = set()
+            if mensagens_pendentes and any(message_ids):
+                ja_registradas = set(conversa.mensagens.filter(
+                    remetente='user',
+                    processada=False,
+                    whatsapp_message_id__in=[message_id for message_id in message_ids if message_id]
+                ).values_list('whatsapp_message_id', flat=True))
             
-            return final_response
+            # Gravadas antes da chamada à IA: uma nova tentativa da fila
+            # encontra as mensagens já registradas
+            for message_text, message_id in zip(message_texts, message_ids):
+                if message_id is None or message_id not in ja_registradas:
+                    mensagens.add(conversa, 'user', message_text, whatsapp_message_id=message_id)
+        
+        return conversa, None
+    
+    def _finish_turn(self, conversa: Conversa, ai_response: str, pendentes: List[int],
+                     acoes: Optional[List[Tuple[str, Dict, CommandResult]]] = None,
+                     on_saved: Optional[Callable[[str], None]] = None) -> Tuple[str, Optional[Tuple[int, str]]]:
+        """
+        Fase 3 do processamento: transação curta que salva a resposta da IA
+        
+        Verificação otimista: se a conversa deixou de estar ativa enquanto a
+        IA respondia (outra mensagem gerou direcionamento ou a conversa foi
+        resetada), a resposta não é salva e os comandos não são aplicados.
+        
+        Args:
+            acoes: Ferramentas executadas na fase 2 (modo 'ferramentas'),
+                como (nome, argumentos, resultado)
+            on_saved: Recebe a resposta ao paciente ainda dentro da transação
+        
+        As mensagens do turno (comando, resposta) são gravadas juntas no fim
+        da transação, antes do envio ao paciente.
+        
+        Returns:
+            (resposta ao paciente, (mensagem, contexto) quando a resposta de
+            um comando deve ser reescrita pela IA, ou None)
+        """
+        with transaction.atomic(), MessageBuffer() as mensagens:
+            response, rephrase = self._save_turn(conversa, ai_response, pendentes, acoes, mensagens)
+            if on_saved is not None:
+                on_saved(response)
+        return response, rephrase
+    
+    def _save_turn(self, conversa: Conversa, ai_response: str, pendentes: List[int],
+                   acoes: Optional[List[Tuple[str, Dict, CommandResult]]],
+                   mensagens: MessageBuffer) -> Tuple[str, Optional[Tuple[int, str]]]:
+        """Corpo da fase 3 (dentro da transação de _finish_turn)"""
+        MensagemConversa.objects.filter(id__in=pendentes).update(processada=True)
+        
+        conversa_ativa = Conversa.objects.select_for_update().filter(
+            pk=conversa.pk,
+            status='ativa'
+        ).first()
+        
+        if conversa_ativa is None:
+            print(f"Conversa {conversa.pk} deixou de estar ativa durante a geração da resposta")
+            if conversa.paciente.has_pending_direcionamento():
+                return PENDING_DIRECIONAMENTO_MESSAGE, None
+            if self._has_ai_command(ai_response):
+                return "Desculpe, não consegui concluir sua solicitação. Pode repetir sua última mensagem?", None
+            return ai_response, None
+        
+        if acoes:
+            return self._process_tool_actions(acoes, ai_response, conversa_ativa, mensagens), None
+        
+        command = parse_command(ai_response)
+        if command is None:
+            # 7. Salva resposta da IA
+            mensagens.add(conversa_ativa, 'bot', ai_response)
+            return ai_response, None
+        
+        # 8. Processa comandos especiais: o comando fica registrado como
+        # mensagem de sistema e o paciente recebe o resultado
+        mensagens.add(conversa_ativa, 'system', ai_response)
+        return self._process_ai_commands(command, conversa_ativa, mensagens)
     
     def _get_or_create_active_conversation(self, paciente: Paciente) -> Conversa:
         """Busca conversa ativa ou cria nova"""
@@ -66,57 +473,193 @@ class ConversationService:
         if active_conversation:
             return active_conversation
         
-        # Cria nova conversa
-        return Conversa.objects.create(
-            paciente=paciente,
-            status='ativa'
-        )
-    
-    def _save_message(self, conversa: Conversa, remetente: str, conteudo: str):
-        """Salva mensagem no histórico"""
-        MensagemConversa.objects.create(
-            conversa=conversa,
-            remetente=remetente,
-            conteudo=conteudo
-        )
+        # Cria nova conversa. Se outra mensagem do mesmo paciente criou a
+        # conversa ao mesmo tempo, a constraint de conversa ativa única falha
+        # e a conversa criada pela outra mensagem é reutilizada
+        try:
+            with transaction.atomic():
+                return Conversa.objects.create(
+                    paciente=paciente,
+                    status='ativa'
+                )
+        except IntegrityError:
+            return paciente.get_active_conversation()
     
     def _build_chat_history(self, conversa: Conversa) -> List[Dict]:
-        """Constrói histórico para a IA"""
-        mensagens = conversa.mensagens.all()
-        history = []
+        """Constrói histórico para a IA (ver _build_turn_history)"""
+        return self._build_turn_history(conversa)[0]
+    
+    def _build_turn_history(self, conversa: Conversa) -> Tuple[List[Dict], List[int]]:
+        """
+        Constrói histórico para a IA e lista as mensagens pendentes do turno
+
+        Envia apenas as últimas mensagens (limitadas por quantidade e por
+        estimativa de tokens). As mensagens que saem da janela são
+        incorporadas, de forma incremental, ao resumo salvo na conversa,
+        que vai no início do histórico. Assim o tamanho do prompt não cresce
+        com a duração da conversa.
+
+        As pendentes (do usuário, ainda não processadas) saem da mesma
+        consulta do histórico: uma mensagem gravada entre duas consultas
+        não pode ser respondida sem ser marcada, nem marcada sem ser vista.
+
+        Returns:
+            (histórico, IDs das mensagens do usuário a marcar como processadas)
+        """
+        max_mensagens = get_history_setting('MAX_MENSAGENS')
+        max_tokens = get_history_setting('MAX_TOKENS')
         
+        # Últimas N mensagens (consulta limitada, não lê a conversa inteira)
+        mensagens = list(conversa.mensagens.order_by('-id')[:max_mensagens])
+        pendentes = [msg.id for msg in reversed(mensagens) if msg.remetente == 'user' and not msg.processada]
+        
+        # Respeita o orçamento de tokens, mantendo sempre a mensagem mais recente
+        janela = []
+        total_tokens = 0
         for msg in mensagens:
+            tokens = estimate_tokens(msg.conteudo)
+            if janela and total_tokens + tokens > max_tokens:
+                break
+            janela.append(msg)
+            total_tokens += tokens
+        janela.reverse()
+        
+        # Só pode haver mensagens fora da janela se o limite foi atingido
+        if janela and (len(mensagens) == max_mensagens or len(janela) < len(mensagens)):
+            self._update_history_summary(conversa, janela[0].id)
+        
+        history = []
+        
+        if conversa.resumo_historico:
+            history.append({
+                'role': 'user',
+                'parts': [f"Resumo da conversa até aqui (mensagens anteriores):\n{conversa.resumo_historico}"]
+            })
+        
+        for msg in janela:
+            if msg.remetente == 'system':
+                # Comandos enviados ao sistema: o paciente só viu o resultado
+                continue
             role = 'user' if msg.remetente == 'user' else 'model'
             history.append({
                 'role': role,
                 'parts': [msg.conteudo]
             })
         
-        return history
+        return history, pendentes
     
-    def _process_ai_commands(self, ai_response: str, conversa: Conversa) -> str:
+    def _update_history_summary(self, conversa: Conversa, primeira_mensagem_janela_id: int):
         """
-        Processa comandos especiais da IA
+        Acrescenta ao resumo as mensagens que saíram da janela desde a última atualização
         """
-        if '[CONSULTAR_AGENDA:' in ai_response:
-            print("COMANDO DETECTADO: [CONSULTAR_AGENDA]")
-            # Futuramente: integrar com Google Calendar
-            return "Ok, estou verificando a agenda... (simulação). Encontrei horários às 10:00, 11:00 e 15:00. Qual prefere?"
+        novas = list(conversa.mensagens.filter(
+            id__gt=conversa.ultima_mensagem_resumida_id,
+            id__lt=primeira_mensagem_janela_id,
+        ).order_by('id'))
+        
+        if not novas:
+            return
         
-        elif '[CRIAR_AGENDAMENTO:' in ai_response:
-            print("COMANDO DETECTADO: [CRIAR_AGENDAMENTO]")
-            # Cria direcionamento para secretária
-            self._create_direcionamento(conversa, 'agendamento')
-            return "Perfeito! Sua solicitação foi encaminhada para nossa secretária. Você receberá um contato em breve!"
+        linhas = conversa.resumo_historico.splitlines() if conversa.resumo_historico else []
+        for msg in novas:
+            if msg.remetente == 'system':
+                continue
+            autor = 'Paciente' if msg.remetente == 'user' else 'Assistente'
+            linhas.append(f"- {autor}: {truncate_text(' '.join(msg.conteudo.split()), 200)}")
         
-        elif '[DIRECIONAR_SECRETARIA]' in ai_response:
-            # Quando bot não consegue responder
-            self._create_direcionamento(conversa, 'duvida_complexa')
-            return "Vou encaminhar sua dúvida para nossa secretária. Em breve você receberá um contato!"
+        # Mantém o resumo dentro do limite descartando as linhas mais antigas
+        max_caracteres = get_history_setting('MAX_CARACTERES_RESUMO')
+        while len(linhas) > 1 and sum(len(linha) + 1 for linha in linhas) > max_caracteres:
+            linhas.pop(0)
         
-        else:
-            # Resposta normal da IA
-            return ai_response
+        conversa.resumo_historico = "\n".join(linhas)
+        conversa.ultima_mensagem_resumida_id = novas[-1].id
+        Conversa.objects.filter(pk=conversa.pk).update(
+            resumo_historico=conversa.resumo_historico,
+            ultima_mensagem_resumida_id=conversa.ultima_mensagem_resumida_id,
+        )
+    
+    def _has_ai_command(self, ai_response: str) -> bool:
+        """Verifica se a resposta da IA contém algum comando especial"""
+        return parse_command(ai_response) is not None
+    
+    def _process_ai_commands(self, command: Tuple[str, Dict[str, str]], conversa: Conversa,
+                             mensagens: MessageBuffer) -> Tuple[str, Optional[Tuple[MensagemConversa, str]]]:
+        """
+        Executa o comando da IA com dados reais e salva a resposta ao paciente
+        
+        Returns:
+            (resposta, (mensagem, contexto) se a IA deve reescrevê-la)
+        """
+        nome, args = command
+        result = self.command_service.execute(nome, args, conversa.paciente.telefone_whatsapp)
+        
+        mensagem = mensagens.add(conversa, 'bot', result.resposta)
+        
+        if result.direcionamento:
+            self._create_direcionamento(conversa, result.direcionamento, medico=result.medico)
+        
+        if result.contexto and get_command_setting('FRASEAR_COM_IA'):
+            return result.resposta, (mensagem, result.contexto)
+        return result.resposta, None
+    
+    def _build_tool_executor(self, telefone_whatsapp: str, acoes: List[Tuple[str, Dict, CommandResult]]):
+        """
+        Executor das ferramentas chamadas pela IA (modo 'ferramentas')
+        
+        Consultas e agendamentos são feitos na hora, com dados reais; as
+        ações ficam registradas em `acoes` para a fase 3 salvar e aplicar
+        os direcionamentos.
+        """
+        def execute(nome: str, args: Dict) -> Dict:
+            result = self.command_service.execute_tool(nome, args, telefone_whatsapp)
+            acoes.append((nome, args, result))
+            return {'resultado': result.resposta, 'dados': result.contexto}
+        
+        return execute
+    
+    def _process_tool_actions(self, acoes: List[Tuple[str, Dict, CommandResult]], ai_response: str, conversa: Conversa,
+                              mensagens: MessageBuffer) -> str:
+        """
+        Registra as ferramentas executadas como mensagens de sistema, salva a
+        resposta da IA e cria o direcionamento, se alguma ação pediu
+        
+        Returns:
+            Resposta ao paciente
+        """
+        for nome, args, _ in acoes:
+            argumentos = ', '.join(f"{chave}='{valor}'" for chave, valor in args.items())
+            mensagens.add(conversa, 'system', f"[{TOOL_COMMANDS.get(nome, nome)}: {argumentos}]")
+        
+        # Se a IA falhou depois de executar as ações, o paciente recebe o
+        # resultado da última ação (ex: o agendamento já foi feito)
+        if not ai_response or ai_response in (AI_ERROR_MESSAGE, TOOL_LIMIT_MESSAGE):
+            ai_response = acoes[-1][2].resposta
+        
+        mensagens.add(conversa, 'bot', ai_response)
+        
+        direcionamento = next((result for _, _, result in acoes if result.direcionamento), None)
+        if direcionamento:
+            self._create_direcionamento(conversa, direcionamento.direcionamento, medico=direcionamento.medico)
+        
+        return ai_response
+    
+    def _build_phrasing_history(self, conversa: Conversa, contexto: str) -> List[Dict]:
+        """Histórico para a IA reescrever a resposta de um comando"""
+        history = self._build_chat_history(conversa)
+        history.append({
+            'role': 'user',
+            'parts': [PHRASING_INSTRUCTION.format(contexto=contexto)]
+        })
+        return history
+    
+    def _apply_phrasing(self, mensagem: MensagemConversa, template_response: str, phrased: str) -> str:
+        """Usa o texto reescrito pela IA, mantendo o template se ela falhar"""
+        if not phrased or phrased == AI_ERROR_MESSAGE or self._has_ai_command(phrased):
+            return template_response
+        
+        MensagemConversa.objects.filter(pk=mensagem.pk).update(conteudo=phrased)
+        return phrased
     
     def _create_direcionamento(self, conversa: Conversa, tipo_solicitacao: str, medico=None):
         """Cria direcionamento para secretária"""
@@ -148,33 +691,24 @@ class ConversationService:
     
     def reset_conversation(self, telefone_whatsapp: str):
         """Reseta conversa do usuário"""
-        try:
-            paciente = Paciente.objects.get(telefone_whatsapp=telefone_whatsapp)
-            active_conversation = paciente.get_active_conversation()
-            
-            if active_conversation:
-                active_conversation.status = 'finalizada'
-                active_conversation.finalizada_em = timezone.now()
-                active_conversation.save()
-                
-        except Paciente.DoesNotExist:
-            pass
+        Conversa.objects.filter(
+            paciente__telefone_whatsapp=telefone_whatsapp,
+            status='ativa'
+        ).update(status='finalizada', finalizada_em=timezone.now())
     
     def get_conversation_summary(self, telefone_whatsapp: str) -> Dict:
         """Retorna resumo da conversa atual"""
-        try:
-            paciente = Paciente.objects.get(telefone_whatsapp=telefone_whatsapp)
-            active_conversation = paciente.get_active_conversation()
-            
-            if active_conversation:
-                return {
-                    'status': active_conversation.status,
-                    'message_count': active_conversation.mensagens.count(),
-                    'started_at': active_conversation.iniciada_em,
-                    'has_pending_direcionamento': paciente.has_pending_direcionamento()
-                }
-            
-            return {'status': 'no_active_conversation'}
-            
-        except Paciente.DoesNotExist:
-            return {'status': 'user_not_found'}
\ No newline at end of file
+        state = load_patient_state(telefone_whatsapp)
+        if state is None:
+            return {'status': 'user_not_found'}
+        
+        active_conversation = state.conversa
+        if active_conversation:
+            return {
+                'status': active_conversation.status,
+                'message_count': active_conversation.mensagens.count(),
+                'started_at': active_conversation.iniciada_em,
+                'has_pending_direcionamento': state.direcionamento_pendente
+            }
+        
+        return {'status': 'no_active_conversation'}
\ No newline at end of file
@@ -0,0 +1,521 @@
+"""
+Serviço responsável pela fila persistente de mensagens recebidas do WhatsApp
+"""
+import random
+import traceback
+import uuid
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Case, Exists, OuterRef, Value, When
+from django.utils import timezone
+
+from ..models import MensagemEntrada
+from .message_dedup import forget_message_ids, register_message_id
+from .patient_lock import get_lock_setting
+from .registry import get_conversation_service, get_whatsapp_service
+from .whatsapp_service import RETRYABLE_STATUS
+from ..utils.validators import sanitize_message, validate_whatsapp_number
+from ..utils.webhook import iter_webhook_messages
+
+
+DEFAULT_QUEUE_SETTINGS = {
+    'MAX_TENTATIVAS': 5,
+    'BACKOFF_BASE_SEGUNDOS': 5,
+    'BACKOFF_MAX_SEGUNDOS': 600,
+    'TIMEOUT_PROCESSAMENTO_SEGUNDOS': 900,
+    'LOTE_MAXIMO_POR_PACIENTE': 10,
+}
+
+
+def get_queue_setting(name: str):
+    """Lê uma configuração da fila (settings.CHATBOT_QUEUE) com valor padrão"""
+    return getattr(settings, 'CHATBOT_QUEUE', {}).get(name, DEFAULT_QUEUE_SETTINGS[name])
+
+
+def get_stale_timeout_seconds() -> float:
+    """
+    Tempo em 'processando' após o qual um item volta para a fila: nunca
+    menor que o TTL do lock por paciente, para não reabrir um turno que
+    ainda pode estar em andamento
+    """
+    return max(get_queue_setting('TIMEOUT_PROCESSAMENTO_SEGUNDOS'), get_lock_setting('TTL_SEGUNDOS'))
+
+
+class ClaimLost(RuntimeError):
+    """A reserva dos itens foi devolvida à fila (requeue_stale) e pode ser de outro worker"""
+
+
+class InboundQueueService:
+    """
+    Serviço para gerenciar a fila de mensagens recebidas.
+
+    A fila é armazenada no próprio banco (SQLite/Postgres), sem broker externo.
+    Garante ordem por paciente: apenas a mensagem mais antiga ainda não
+    finalizada de cada remetente pode ser reservada por um worker.
+    """
+
+    def __init__(self, conversation_service=None, whatsapp_service=None):
+        self._conversation_service = conversation_service
+        self._whatsapp_service = whatsapp_service
+
+    @property
+    def conversation_service(self):
+        return self._conversation_service or get_conversation_service()
+
+    @property
+    def whatsapp_service(self):
+        return self._whatsapp_service or get_whatsapp_service()
+
+    # ------------------------------------------------------------------
+    # Produtor (webhook)
+    # ------------------------------------------------------------------
+
+    def enqueue_webhook_payload(self, data: Dict) -> List[MensagemEntrada]:
+        """
+        Grava as mensagens do payload do webhook na fila
+
+        Entregas repetidas (mesmo messages[].id) são descartadas pelo cache
+        antes de tocar o banco; a constraint única em whatsapp_message_id
+        cobre repetições que cheguem depois do TTL do cache.
+
+        Args:
+            data: Corpo JSON recebido da Meta
+
+        Returns:
+            Lista de itens enfileirados
+
+        Raises:
+            Exception: Falha ao gravar no banco (os ids são esquecidos para
+                que a reentrega da Meta seja aceita)
+        """
+        itens = []
+
+        # Todas as mensagens de todas as entries/changes, pelo timestamp de
+        # envio (sort estável: empates mantêm a ordem do payload); a fila
+        # garante a ordem por remetente
+        messages = sorted(iter_webhook_messages(data), key=lambda message_data: int(message_data.get('timestamp') or 0))
+        for message_data in messages:
+            if not message_data.get('from'):
+                print(f"Mensagem sem remetente ignorada: {message_data.get('id')}")
+                continue
+            if not register_message_id(message_data.get('id')):
+                continue
+
+            itens.append(MensagemEntrada(
+                telefone_whatsapp=message_data['from'],
+                whatsapp_message_id=message_data.get('id'),
+                payload=message_data,
+            ))
+
+        if itens:
+            try:
+                MensagemEntrada.objects.bulk_create(itens, ignore_conflicts=True)
+            except Exception:
+                forget_message_ids(item.whatsapp_message_id for item in itens)
+                raise
+
+        return itens
+
+    # ------------------------------------------------------------------
+    # Consumidor (workers)
+    # ------------------------------------------------------------------
+
+    def claim_next(self, worker_id: str, telefone_whatsapp: Optional[str] = None) -> List[MensagemEntrada]:
+        """
+        Reserva as próximas mensagens disponíveis de um remetente
+
+        A reserva é feita com um UPDATE condicional (status='pendente'), então
+        dois workers nunca processam o mesmo item, mesmo no SQLite. Cada
+        reserva grava um token próprio em `bloqueada_por`: depois de um
+        requeue_stale, a execução antiga não conclui, salva nem envia nada
+        em nome da nova (ver _owns). Junto com
+        a mensagem mais antiga do remetente são reservadas as demais já
+        enfileiradas por ele, para que a rajada seja respondida com uma única
+        chamada à IA.
+
+        Args:
+            worker_id: Identificador do worker que está reservando
+            telefone_whatsapp: Reserva apenas mensagens deste remetente (opcional)
+
+        Returns:
+            Itens reservados (em ordem) ou lista vazia se a fila estiver vazia
+        """
+        now = timezone.now()
+        claim = f"{worker_id[:67]}:{uuid.uuid4().hex}"
+
+        # Mensagem anterior do mesmo remetente ainda não finalizada
+        anterior_em_aberto = MensagemEntrada.objects.filter(
+            telefone_whatsapp=OuterRef('telefone_whatsapp'),
+            status__in=['pendente', 'processando'],
+            id__lt=OuterRef('id'),
+        )
+
+        candidatos = MensagemEntrada.objects.filter(status='pendente', disponivel_em__lte=now)
+        if telefone_whatsapp is not None:
+            candidatos = candidatos.filter(telefone_whatsapp=telefone_whatsapp)
+        candidatos = (
+            candidatos
+            .exclude(Exists(anterior_em_aberto))
+            .order_by('disponivel_em', 'id')
+            .values_list('id', 'telefone_whatsapp')[:10]
+        )
+
+        for item_id, telefone in candidatos:
+            reservado = MensagemEntrada.objects.filter(
+                id=item_id,
+                status='pendente',
+            ).update(
+                status='processando',
+                bloqueada_em=now,
+                bloqueada_por=claim,
+            )
+
+            if not reservado:
+                continue
+
+            # Com a primeira reservada, as seguintes do remetente não são
+            # elegíveis para outros workers e podem entrar no mesmo lote
+            seguintes = list(
+                MensagemEntrada.objects
+                .filter(telefone_whatsapp=telefone, status='pendente', id__gt=item_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:get_queue_setting('LOTE_MAXIMO_POR_PACIENTE') - 1]
+            )
+            if seguintes:
+                MensagemEntrada.objects.filter(id__in=seguintes, status='pendente').update(
+                    status='processando',
+                    bloqueada_em=now,
+                    bloqueada_por=claim,
+                )
+
+            return list(MensagemEntrada.objects.filter(
+                id__in=[item_id] + seguintes,
+                bloqueada_por=claim,
+            ).order_by('id'))
+
+        return []
+
+    def mark_done(self, item: MensagemEntrada):
+        """Marca item como processado com sucesso (se a reserva ainda for desta execução)"""
+        MensagemEntrada.objects.filter(id=item.id, status='processando', bloqueada_por=item.bloqueada_por).update(
+            status='concluida',
+            processada_em=timezone.now(),
+            bloqueada_em=None,
+            bloqueada_por=None,
+        )
+
+    def mark_failed(self, item: MensagemEntrada, erro: str):
+        """
+        Registra falha no processamento: agenda nova tentativa com backoff
+        exponencial ou move o item para dead-letter ao atingir o limite.
+        Itens já concluídos nesta execução, ou reservados de novo por outra,
+        não são alterados
+        """
+        tentativas = item.tentativas + 1
+
+        if tentativas >= get_queue_setting('MAX_TENTATIVAS'):
+            print(f"Mensagem {item.id} movida para dead-letter após {tentativas} tentativas")
+            MensagemEntrada.objects.filter(id=item.id, status='processando', bloqueada_por=item.bloqueada_por).update(
+                status='dead_letter',
+                tentativas=tentativas,
+                ultimo_erro=erro,
+                processada_em=timezone.now(),
+                bloqueada_em=None,
+                bloqueada_por=None,
+            )
+            return
+
+        MensagemEntrada.objects.filter(id=item.id, status='processando', bloqueada_por=item.bloqueada_por).update(
+            status='pendente',
+            tentativas=tentativas,
+            ultimo_erro=erro,
+            disponivel_em=timezone.now() + self._backoff(tentativas),
+            bloqueada_em=None,
+            bloqueada_por=None,
+        )
+
+    def requeue_stale(self) -> int:
+        """
+        Devolve para a fila itens presos em 'processando' (worker morreu)
+
+        O limite (get_stale_timeout_seconds) cobre o pior turno; se a execução
+        antiga ainda estiver viva, o token da reserva a impede de concluir
+        ou enviar a resposta depois disso.
+
+        Returns:
+            Quantidade de itens devolvidos
+        """
+        limite = timezone.now() - timedelta(seconds=get_stale_timeout_seconds())
+        presos = MensagemEntrada.objects.filter(status='processando', bloqueada_em__lt=limite)
+
+        total = 0
+        for item in presos:
+            self.mark_failed(item, 'Tempo de processamento esgotado')
+            total += 1
+
+        return total
+
+    def process_items(self, itens: List[MensagemEntrada]):
+        """
+        Executa o fluxo de conversa para mensagens de um mesmo remetente
+
+        Idempotente entre tentativas: na mesma transação em que o turno é
+        salvo (fase 3), os itens são marcados como respondidos junto com o
+        texto que falta enviar. Uma nova tentativa (ex: falha no envio) só
+        reenvia esse texto, sem gravar as mensagens nem chamar a IA de novo.
+        """
+        # Turnos já salvos em uma tentativa anterior: só falta o envio
+        for item in self._answered(itens):
+            self._deliver(item)
+            self.mark_done(item)
+
+        itens = [item for item in itens if item.respondida_em is None]
+        textos, message_ids = self._texts(itens)
+        if not textos:
+            return
+        from_number = itens[0].telefone_whatsapp
+
+        # Confirmação de leitura e "digitando..." antes da chamada à IA
+        from .conversation_service import get_streaming_setting
+        if itens[-1].whatsapp_message_id:
+            self.whatsapp_service.mark_as_read(
+                itens[-1].whatsapp_message_id,
+                typing=get_streaming_setting('INDICADOR_DIGITANDO'),
+            )
+
+        # Trechos do streaming que não puderam ser enviados: seguem junto com
+        # a resposta (depois de uma falha, os seguintes também, para manter a ordem)
+        nao_enviados = []
+
+        def send_chunk(chunk):
+            if nao_enviados or not self._send(from_number, chunk):
+                nao_enviados.append(chunk)
+
+        response_text = self.conversation_service.process_user_messages(
+            from_number,
+            textos,
+            on_chunk=send_chunk,
+            on_saved=lambda resposta: self._save_reply(itens, self._join_reply(nao_enviados, resposta)),
+            message_ids=message_ids,
+        )
+        resposta = self._join_reply(nao_enviados, response_text)
+
+        if itens[-1].respondida_em is None:
+            # Turno sem fase 3 (ex: direcionamento pendente): nada salvo, a
+            # nova tentativa refaz o fluxo
+            if resposta and not self._send(from_number, resposta):
+                raise RuntimeError(f"Falha ao enviar a resposta das mensagens {[item.id for item in itens]}")
+            return
+
+        self._update_reply(itens[-1], resposta)
+        self._deliver(itens[-1])
+
+    async def process_items_async(self, itens: List[MensagemEntrada]):
+        """Versão assíncrona de process_items (mesmas garantias entre tentativas)"""
+        for item in self._answered(itens):
+            await self._deliver_async(item)
+            await sync_to_async(self.mark_done)(item)
+
+        itens = [item for item in itens if item.respondida_em is None]
+        textos, message_ids = self._texts(itens)
+        if not textos:
+            return
+        from_number = itens[0].telefone_whatsapp
+
+        from .conversation_service import get_streaming_setting
+        if itens[-1].whatsapp_message_id:
+            await self.whatsapp_service.mark_as_read_async(
+                itens[-1].whatsapp_message_id,
+                typing=get_streaming_setting('INDICADOR_DIGITANDO'),
+            )
+
+        nao_enviados = []
+
+        async def send_chunk(chunk):
+            if nao_enviados or not await self._send_async(from_number, chunk):
+                nao_enviados.append(chunk)
+
+        response_text = await self.conversation_service.process_user_messages_async(
+            from_number,
+            textos,
+            on_chunk=send_chunk,
+            on_saved=lambda resposta: self._save_reply(itens, self._join_reply(nao_enviados, resposta)),
+            message_ids=message_ids,
+        )
+        resposta = self._join_reply(nao_enviados, response_text)
+
+        if itens[-1].respondida_em is None:
+            if resposta and not await self._send_async(from_number, resposta):
+                raise RuntimeError(f"Falha ao enviar a resposta das mensagens {[item.id for item in itens]}")
+            return
+
+        await sync_to_async(self._update_reply)(itens[-1], resposta)
+        await self._deliver_async(itens[-1])
+
+    def _answered(self, itens: List[MensagemEntrada]) -> List[MensagemEntrada]:
+        """Itens cujo turno já foi salvo em uma tentativa anterior"""
+        return [item for item in itens if item.respondida_em is not None]
+
+    def _texts(self, itens: List[MensagemEntrada]) -> Tuple[List[str], List[Optional[str]]]:
+        """
+        Textos a processar e os ids do WhatsApp de cada um (vazios se o
+        número é inválido ou não há mensagens de texto)
+        """
+        if not itens:
+            return [], []
+
+        # Valida número do WhatsApp
+        if not validate_whatsapp_number(itens[0].telefone_whatsapp):
+            print(f"Número inválido: {itens[0].telefone_whatsapp}")
+            return [], []
+
+        # Processa apenas mensagens de texto
+        textos = [item for item in itens if item.payload.get('type') == 'text']
+        return (
+            [sanitize_message(item.payload['text']['body']) for item in textos],
+            [item.whatsapp_message_id for item in textos],
+        )
+
+    def _save_reply(self, itens: List[MensagemEntrada], resposta: Optional[str]):
+        """
+        Marca os itens como respondidos (chamada dentro da transação da fase
+        3). O texto a enviar fica só no último item do lote
+
+        Raises:
+            ClaimLost: A reserva já não é desta execução (desfaz o turno)
+        """
+        agora = timezone.now()
+        ultimo = itens[-1]
+        salvos = MensagemEntrada.objects.filter(
+            id__in=[item.id for item in itens], status='processando', bloqueada_por=ultimo.bloqueada_por,
+        ).update(
+            respondida_em=agora,
+            resposta=Case(When(id=ultimo.id, then=Value(resposta)), default=None),
+        )
+        if salvos != len(itens):
+            raise ClaimLost(f"Reserva das mensagens {[item.id for item in itens]} perdida antes de salvar o turno")
+        for item in itens:
+            item.respondida_em = agora
+            item.resposta = resposta if item is ultimo else None
+
+    def _update_reply(self, item: MensagemEntrada, resposta: Optional[str]):
+        """Atualiza o texto salvo quando muda depois do commit (ex: reescrita pela IA)"""
+        if resposta != item.resposta:
+            MensagemEntrada.objects.filter(id=item.id, bloqueada_por=item.bloqueada_por).update(resposta=resposta)
+            item.resposta = resposta
+
+    def _join_reply(self, nao_enviados: List[str], resposta: Optional[str]) -> Optional[str]:
+        """Trechos não enviados seguidos da resposta, ou None se não há nada a enviar"""
+        partes = nao_enviados + ([resposta] if resposta else [])
+        return '\n\n'.join(partes) or None
+
+    def _deliver(self, item: MensagemEntrada):
+        """
+        Envia a resposta salva no item, se houver
+
+        Raises:
+            ClaimLost: A reserva já não é desta execução (quem reservou envia)
+            RuntimeError: Se o envio falhar (o item volta para a fila)
+        """
+        if not item.resposta:
+            return
+        if not self._owns(item):
+            raise ClaimLost(f"Reserva da mensagem {item.id} perdida antes do envio")
+        if not self._send(item.telefone_whatsapp, item.resposta):
+            raise RuntimeError(f"Falha ao enviar a resposta da mensagem {item.id}")
+
+    async def _deliver_async(self, item: MensagemEntrada):
+        """Versão assíncrona de _deliver"""
+        if not item.resposta:
+            return
+        if not await sync_to_async(self._owns)(item):
+            raise ClaimLost(f"Reserva da mensagem {item.id} perdida antes do envio")
+        if not await self._send_async(item.telefone_whatsapp, item.resposta):
+            raise RuntimeError(f"Falha ao enviar a resposta da mensagem {item.id}")
+
+    def _owns(self, item: MensagemEntrada) -> bool:
+        """A reserva do item ainda é desta execução (não foi devolvida nem reservada por outra)"""
+        return MensagemEntrada.objects.filter(
+            id=item.id, status='processando', bloqueada_por=item.bloqueada_por
+        ).exists()
+
+    def _send(self, telefone: str, texto: str) -> bool:
+        """Envia um texto ao paciente; False se a Meta não recebeu (sem resposta, 429 ou 5xx)"""
+        return self._sent(self.whatsapp_service.send_text_message(telefone, texto))
+
+    async def _send_async(self, telefone: str, texto: str) -> bool:
+        """Versão assíncrona de _send"""
+        return self._sent(await self.whatsapp_service.send_text_message_async(telefone, texto))
+
+    def _sent(self, response) -> bool:
+        return response is not None and response.status_code not in RETRYABLE_STATUS
+
+    def run_once(self, worker_id: str) -> bool:
+        """
+        Reserva e processa o próximo lote da fila
+
+        Returns:
+            True se algum item foi processado, False se a fila estava vazia
+        """
+        itens = self.claim_next(worker_id)
+        if not itens:
+            return False
+
+        try:
+            self.process_items(itens)
+        except Exception as e:
+            self._record_failure(itens, e)
+        else:
+            for item in itens:
+                self.mark_done(item)
+
+        return True
+
+    async def run_sender_async(self, worker_id: str, telefone_whatsapp: str) -> int:
+        """
+        Processa, no event loop, as mensagens já enfileiradas de um remetente
+
+        Usado pelo webhook assíncrono logo após gravar na fila. Se o processo
+        cair no meio, os itens continuam na fila ('processando') e voltam a
+        ficar disponíveis pelo requeue_stale dos workers de `processar_fila`;
+        falhas seguem o backoff normal da fila.
+
+        Returns:
+            Quantidade de lotes processados
+        """
+        lotes = 0
+        while True:
+            itens = await sync_to_async(self.claim_next)(worker_id, telefone_whatsapp)
+            if not itens:
+                return lotes
+            lotes += 1
+
+            try:
+                await self.process_items_async(itens)
+            except Exception as e:
+                await sync_to_async(self._record_failure)(itens, e)
+                return lotes
+
+            for item in itens:
+                await sync_to_async(self.mark_done)(item)
+
+    def _record_failure(self, itens: List[MensagemEntrada], error: Exception):
+        """Registra a falha do lote e agenda nova tentativa dos itens"""
+        if isinstance(error, ClaimLost):
+            # Os itens já voltaram para a fila: a tentativa conta para quem os reservou
+            print(f"Mensagens {[item.id for item in itens]} abandonadas: {error}")
+            return
+        print(f"Erro ao processar mensagens {[item.id for item in itens]} da fila: {error}")
+        erro = ''.join(traceback.format_exception(error))
+        for item in itens:
+            self.mark_failed(item, erro)
+
+    def _backoff(self, tentativas: int) -> timedelta:
+        """Backoff exponencial com jitter para a próxima tentativa"""
+        base = get_queue_setting('BACKOFF_BASE_SEGUNDOS')
+        maximo = get_queue_setting('BACKOFF_MAX_SEGUNDOS')
+        atraso = min(maximo, base * (2 ** (tentativas - 1)))
+        return timedelta(seconds=random.uniform(atraso / 2, atraso))
@@ -0,0 +1,296 @@
+"""
+Roteador de intenções: responde mensagens simples sem chamar a IA
+
+Saudações, agradecimentos, endereço, telefone, lista de médicos, preços e
+convênios são reconhecidos por regras (palavras-chave e expressões
+regulares pré-compiladas) e respondidos com templates a partir do snapshot
+da base de conhecimento. Só há resposta quando a mensagem é inteiramente
+coberta pelas regras; qualquer conteúdo a mais (ex: "oi, quero marcar uma
+consulta amanhã") segue para a IA.
+
+Opcionalmente, um classificador local (vizinho mais próximo entre frases
+de exemplo, por n-gramas de caracteres) reconhece variações que as regras
+não cobrem.
+"""
+import re
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from clinica.knowledge_base import get_knowledge_base_snapshot
+
+from ..utils import metrics
+from ..utils.formatters import format_currency
+from .response_cache import ngram_vector, normalize_question
+
+DEFAULT_INTENT_ROUTER_SETTINGS = {
+    'ENABLED': True,
+    'MAX_PALAVRAS': 12,
+    'MAX_MEDICOS_LISTADOS': 6,
+    'CLASSIFICADOR': False,
+    'CONFIANCA_MINIMA_CLASSIFICADOR': 0.5,
+}
+
+# Intenções que só acompanham a conversa (não trazem pergunta)
+SOCIAL_INTENTS = ('saudacao', 'agradecimento', 'despedida')
+
+INTENT_PATTERNS = {
+    'saudacao': re.compile(r"\b(?:oi+|ola|opa|bom dia|boa tarde|boa noite|tudo bem|tudo bom|e ai)\b"),
+    'agradecimento': re.compile(r"\b(?:muito )?(?:obrigad[oa]s?|brigad[oa]|valeu|agradeco)\b"),
+    'despedida': re.compile(r"\b(?:tchau|ate logo|ate mais|ate breve|ate amanha)\b"),
+    'endereco': re.compile(
+        r"\b(?:endereco|localizacao|onde (?:fica|ficam|esta|estao|e)|como (?:chego|chegar)|qual (?:a )?rua)\b"
+    ),
+    'telefone': re.compile(r"\b(?:telefone|fone|numero (?:de|para) contato|contato|ligar)\b"),
+    'medicos': re.compile(
+        r"\b(?:quais|que|quem sao (?:os)?) ?(?:sao )?(?:os )?(?:medicos|doutores|especialistas|medicas)\b"
+        r"|\b(?:medicos|doutores|especialistas)\b"
+    ),
+    'preco': re.compile(r"\b(?:preco|precos|valor|valores|quanto custa|quanto e|quanto fica|quanto sai|custa)\b"),
+    'convenios': re.compile(r"\b(?:convenios?|planos? de saude|plano)\b"),
+}
+
+# Palavras que não mudam o sentido da mensagem
+FILLER_WORDS = {
+    'a', 'o', 'as', 'os', 'e', 'de', 'da', 'do', 'das', 'dos', 'em', 'na', 'no', 'com', 'para', 'pra',
+    'por', 'favor', 'qual', 'quais', 'que', 'me', 'vc', 'vcs', 'voce', 'voces', 'clinica', 'consulta',
+    'consultas', 'exame', 'exames', 'pode', 'poderia', 'informar', 'informa', 'passar', 'saber',
+    'gostaria', 'queria', 'sobre', 'atende', 'atendem', 'aceita', 'aceitam', 'tem', 'dr', 'dra',
+    'doutor', 'doutora', 'um', 'uma', 'ai', 'aqui', 'ok', 'certo', 'entao', 'la', 'ne', 'isso',
+    'particular', 'seu', 'sua', 'senhor', 'senhora', 'pessoal', 'ta', 'bem',
+}
+
+# Frases de exemplo do classificador opcional
+CLASSIFIER_EXAMPLES = {
+    'saudacao': ['oi', 'ola', 'bom dia', 'boa tarde', 'boa noite', 'oi tudo bem', 'ola bom dia'],
+    'agradecimento': ['obrigado', 'obrigada', 'muito obrigado', 'valeu', 'brigado', 'agradeco'],
+    'despedida': ['tchau', 'ate logo', 'ate mais', 'ate breve'],
+    'endereco': ['qual o endereco', 'onde fica a clinica', 'onde voces ficam', 'como chego ai', 'localizacao'],
+    'telefone': ['qual o telefone', 'numero para contato', 'telefone da clinica', 'como ligo'],
+    'medicos': ['quais medicos atendem', 'quais sao os medicos', 'quem atende ai', 'lista de medicos'],
+}
+
+_classifier_examples: Optional[List[Tuple[str, Dict[str, float]]]] = None
+
+
+def get_intent_router_setting(name: str):
+    """Lê uma configuração do roteador (settings.CHATBOT_INTENT_ROUTER) com valor padrão"""
+    return getattr(settings, 'CHATBOT_INTENT_ROUTER', {}).get(name, DEFAULT_INTENT_ROUTER_SETTINGS[name])
+
+
+def _similar(word: str, other: str) -> bool:
+    return word == other or (len(word) >= 4 and SequenceMatcher(None, word, other).ratio() >= 0.85)
+
+
+def _cosine(a: Dict[str, float], b: Dict[str, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(gram, 0.0) for gram, weight in a.items())
+
+
+def _get_classifier_examples() -> List[Tuple[str, Dict[str, float]]]:
+    """Vetores de n-gramas das frases de exemplo, com a intenção de cada uma"""
+    global _classifier_examples
+
+    if _classifier_examples is None:
+        _classifier_examples = [
+            (intent, ngram_vector(example))
+            for intent, examples in CLASSIFIER_EXAMPLES.items()
+            for example in examples
+        ]
+
+    return _classifier_examples
+
+
+class IntentRouter:
+    """Reconhece intenções simples e responde com templates da base de conhecimento"""
+
+    @property
+    def enabled(self) -> bool:
+        return bool(get_intent_router_setting('ENABLED'))
+
+    def route(self, text: str, has_context: bool = False) -> Optional[Tuple[str, str]]:
+        """
+        Tenta responder a mensagem sem a IA
+
+        Args:
+            text: Mensagem(ns) do paciente
+            has_context: Se a conversa já tem mensagens anteriores (perguntas
+                que dependem do assunto da conversa, como "quanto custa?",
+                seguem para a IA)
+
+        Returns:
+            (intenção, resposta) ou None quando a confiança é baixa
+        """
+        if not self.enabled:
+            return None
+
+        normalized = normalize_question(text)
+        words = normalized.split()
+        if not words or len(words) > get_intent_router_setting('MAX_PALAVRAS'):
+            metrics.increment('intent_router.encaminhadas_ia')
+            return None
+
+        snapshot = get_knowledge_base_snapshot()
+        if not snapshot['clinica']:
+            return None
+
+        result = self._match(normalized, words, snapshot, has_context)
+        if result is None:
+            metrics.increment('intent_router.encaminhadas_ia')
+            return None
+
+        metrics.increment('intent_router.atendidas')
+        metrics.increment(f'intent_router.{result[0]}')
+        return result
+
+    def _match(self, normalized: str, words: List[str], snapshot: Dict, has_context: bool) -> Optional[Tuple[str, str]]:
+        intents = []
+        covered = set()
+        for intent, pattern in INTENT_PATTERNS.items():
+            for match in pattern.finditer(normalized):
+                intents.append(intent)
+                covered.update(self._word_indexes(normalized, match.start(), match.end()))
+
+        medicos = self._find_entities(words, [(medico, medico['nome']) for medico in snapshot['medicos']], covered)
+        exames = self._find_entities(words, [(exame, exame['nome']) for exame in snapshot['exames']], covered)
+
+        leftover = [word for index, word in enumerate(words) if index not in covered and word not in FILLER_WORDS]
+        if leftover:
+            # Conteúdo que as regras não explicam: classificador (se habilitado) ou IA
+            return self._classify(normalized, snapshot, has_context) if not intents and not medicos and not exames else None
+
+        informativas = sorted(set(intent for intent in intents if intent not in SOCIAL_INTENTS))
+        if len(informativas) > 1:
+            return None
+
+        if not informativas:
+            if not intents or medicos or exames:
+                return None
+            # Mensagem apenas social: agradecimento/despedida prevalecem sobre a saudação
+            intent = next((intent for intent in reversed(intents) if intent != 'saudacao'), 'saudacao')
+            if intent == 'saudacao' and has_context:
+                # "tudo bem" no meio da conversa pode ser uma confirmação
+                return None
+            return intent, self._answer(intent, snapshot, medicos, exames)
+
+        intent = informativas[0]
+        if intent == 'preco':
+            if exames and not medicos:
+                intent = 'preco_exame'
+            elif medicos and not exames:
+                intent = 'preco_consulta'
+            elif not medicos and not exames and 'consulta' in words and not has_context:
+                intent = 'preco_consulta'
+            else:
+                return None
+        elif intent == 'convenios' and not medicos and has_context:
+            return None
+        elif intent in ('endereco', 'telefone', 'medicos') and (medicos or exames):
+            return None
+
+        answer = self._answer(intent, snapshot, medicos, exames)
+        return (intent, answer) if answer else None
+
+    def _classify(self, normalized: str, snapshot: Dict, has_context: bool) -> Optional[Tuple[str, str]]:
+        """Classificador local opcional: intenção da frase de exemplo mais parecida"""
+        if not get_intent_router_setting('CLASSIFICADOR'):
+            return None
+
+        vector = ngram_vector(normalized)
+        score, intent = max((_cosine(vector, example), intent) for intent, example in _get_classifier_examples())
+        if score < get_intent_router_setting('CONFIANCA_MINIMA_CLASSIFICADOR'):
+            return None
+        if intent == 'saudacao' and has_context:
+            return None
+        return intent, self._answer(intent, snapshot, [], [])
+
+    def _word_indexes(self, normalized: str, start: int, end: int) -> List[int]:
+        """Índices das palavras contidas no trecho [start, end) do texto"""
+        return [
+            index for index, word in enumerate(re.finditer(r"\S+", normalized))
+            if word.start() >= start and word.end() <= end
+        ]
+
+    def _find_entities(self, words: List[str], entities: List[Tuple[Dict, str]], covered: set) -> List[Dict]:
+        """
+        Médicos ou exames citados na mensagem (por palavra do nome, tolerando
+        erros de digitação); as palavras reconhecidas contam como cobertas
+        """
+        found = []
+        for entity, nome in entities:
+            name_words = [word for word in normalize_question(nome).split() if word not in FILLER_WORDS]
+            indexes = [index for index, word in enumerate(words) if any(_similar(word, name_word) for name_word in name_words)]
+            if indexes:
+                found.append(entity)
+                covered.update(indexes)
+        return found
+
+    def _answer(self, intent: str, snapshot: Dict, medicos: List[Dict], exames: List[Dict]) -> Optional[str]:
+        """Resposta (template) para a intenção"""
+        clinica = snapshot['clinica']
+
+        if intent == 'saudacao':
+            return (
+                f"Olá! Sou o assistente virtual da {clinica['nome']}. Posso ajudar com informações sobre "
+                f"consultas, exames, convênios e agendamentos. Como posso ajudar você?"
+            )
+        if intent == 'agradecimento':
+            return "Por nada! Fico à disposição. Posso ajudar em mais alguma coisa?"
+        if intent == 'despedida':
+            return f"Até logo! Quando precisar, é só chamar o assistente virtual da {clinica['nome']}."
+        if intent == 'endereco':
+            return (
+                f"A {clinica['nome']} fica em {clinica['endereco']} ({clinica['referencia_localizacao']}). "
+                f"Posso ajudar em mais alguma coisa?"
+            )
+        if intent == 'telefone':
+            return (
+                f"Você pode falar com a secretária {clinica['secretaria_nome']} pelo telefone "
+                f"{clinica['telefone_contato']}. Posso ajudar em mais alguma coisa?"
+            )
+
+        limite = get_intent_router_setting('MAX_MEDICOS_LISTADOS')
+        if intent == 'medicos':
+            if not snapshot['medicos'] or len(snapshot['medicos']) > limite:
+                return None
+            linhas = [
+                f"- {medico['nome']}" + (f" ({', '.join(medico['especialidades'])})" if medico['especialidades'] else '')
+                for medico in snapshot['medicos']
+            ]
+            return "Atendem aqui na clínica:\n" + "\n".join(linhas) + "\nCom qual deles você gostaria de agendar?"
+
+        if intent == 'preco_consulta':
+            medicos = medicos or snapshot['medicos']
+            if not medicos or len(medicos) > limite:
+                return None
+            linhas = [
+                f"- {medico['nome']}: {format_currency(medico['preco_particular'])} "
+                f"({medico['formas_pagamento']}). {medico['retorno_info']}"
+                for medico in medicos
+            ]
+            return "Valor da consulta particular:\n" + "\n".join(linhas) + "\nGostaria de agendar uma consulta?"
+
+        if intent == 'preco_exame':
+            linhas = [f"- {exame['nome']}: {format_currency(exame['preco'])}" for exame in exames]
+            return "Valor do exame:\n" + "\n".join(linhas) + "\nPosso ajudar com mais alguma informação sobre o exame?"
+
+        if intent == 'convenios':
+            medicos = medicos or snapshot['medicos']
+            if not medicos or len(medicos) > limite:
+                return None
+            linhas = [f"- {medico['nome']}: {medico['convenios']}" for medico in medicos]
+            return "Convênios atendidos:\n" + "\n".join(linhas) + "\nPosso ajudar em mais alguma coisa?"
+
+        return None
+
+
+def get_intent_router_stats() -> Dict:
+    """Parcela das mensagens respondidas sem a IA"""
+    return {
+        'taxa_sem_ia': round(metrics.hit_rate('intent_router.atendidas', 'intent_router.encaminhadas_ia'), 4),
+    }
+
+
+metrics.register_gauge('intent_router', get_intent_router_stats)
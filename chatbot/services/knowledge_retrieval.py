@@ -0,0 +1,330 @@
+"""
+Recuperação dos trechos relevantes da base de conhecimento (BM25)
+
+Em vez de enviar todos os médicos, horários, exames e especialidades em
+todo prompt, a base é dividida em trechos indexados localmente com BM25
+(Python puro). A cada mensagem são enviados apenas os `TOP_K` trechos mais
+relevantes; as informações gerais da clínica e o catálogo de nomes vão
+sempre no prompt do sistema. Assim o tamanho do prompt não cresce com o
+catálogo da clínica.
+
+O índice acompanha a versão da base de conhecimento (incrementada pelos
+signals de clinica.signals). Na troca de versão ele é atualizado de forma
+incremental: só os trechos que mudaram são reindexados.
+"""
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from clinica.knowledge_base import get_knowledge_base_snapshot, get_knowledge_base_version
+
+from ..utils.command_parser import normalize_text
+
+DEFAULT_RETRIEVAL_SETTINGS = {
+    'ENABLED': True,
+    'TOP_K': 4,
+    'MENSAGENS_CONSULTA': 3,
+    'MAX_NOMES_CATALOGO': 50,
+}
+
+# Parâmetros do BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = {
+    'a', 'o', 'as', 'os', 'de', 'da', 'do', 'das', 'dos', 'e', 'em', 'na', 'no', 'nas', 'nos',
+    'um', 'uma', 'para', 'pra', 'por', 'com', 'que', 'qual', 'quais', 'se', 'me', 'eu', 'voce',
+    'ao', 'aos', 'ou', 'meu', 'minha', 'seu', 'sua', 'tem', 'ter', 'ser', 'esta', 'isso', 'oi',
+    'ola', 'bom', 'boa', 'dia', 'tarde', 'noite', 'gostaria', 'queria', 'quero', 'saber', 'dr', 'dra',
+}
+
+# Palavras que o paciente usa para cada tipo de informação
+KEYWORDS = {
+    'medico': 'medico medica doutor doutora consulta preco valor quanto custa convenio convenios plano '
+              'particular pagamento pix cartao retorno especialista',
+    'horarios': 'horario horarios atendimento atende atendem agenda semana quando disponivel',
+    'exame': 'exame exames preco valor quanto custa preparo preparacao jejum como funciona resultado',
+    'especialidade': 'especialidade especialidades area tratamento doenca sintoma',
+}
+
+Chunk = Tuple[str, str]  # (texto para o prompt, texto indexado)
+
+_local_lock = threading.Lock()
+_local_index = (None, None)  # (versão da base, índice)
+
+
+def get_retrieval_setting(name: str):
+    """Lê uma configuração da recuperação (settings.CHATBOT_RETRIEVAL) com valor padrão"""
+    return getattr(settings, 'CHATBOT_RETRIEVAL', {}).get(name, DEFAULT_RETRIEVAL_SETTINGS[name])
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Termos de busca: sem acentos, sem stopwords e com um radical simples
+    (plural em "s" removido)
+    """
+    tokens = []
+    for word in re.findall(r"\w+", normalize_text(text)):
+        if word in STOPWORDS or len(word) < 2:
+            continue
+        if len(word) > 4 and word.endswith('s'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+# ----------------------------------------------------------------------
+# Formatação dos trechos (mesmo formato da base de conhecimento completa)
+# ----------------------------------------------------------------------
+
+def format_clinica(clinica: Dict) -> str:
+    return (
+        f"<clinica>\n"
+        f"  <nome>{clinica['nome']}</nome>\n"
+        f"  <objetivo>{clinica['objetivo_geral']}</objetivo>\n"
+        f"  <secretaria>O agendamento é feito exclusivamente pela secretária {clinica['secretaria_nome']}.</secretaria>\n"
+        f"  <contato_telefonico>{clinica['telefone_contato']}</contato_telefonico>\n"
+        f"  <endereco>{clinica['endereco']}</endereco>\n"
+        f"  <referencia>{clinica['referencia_localizacao']}</referencia>\n"
+        f"  <politica_atendimento>{clinica['politica_agendamento']}</politica_atendimento>\n"
+        f"</clinica>\n"
+    )
+
+
+def format_medico(medico: Dict) -> str:
+    return (
+        f"<medico>\n"
+        f"  <nome>{medico['nome']}</nome>\n"
+        f"  <especialidades>{', '.join(medico['especialidades'])}</especialidades>\n"
+        f"  <bio>{medico['bio']}</bio>\n"
+        f"  <convenios>{medico['convenios']}</convenios>\n"
+        f"  <preco_particular>R$ {medico['preco_particular']:.2f}</preco_particular>\n"
+        f"  <formas_pagamento>{medico['formas_pagamento']}</formas_pagamento>\n"
+        f"  <retorno>{medico['retorno_info']}</retorno>\n"
+        f"</medico>\n"
+    )
+
+
+def format_horario(horario: Dict) -> str:
+    return (
+        f"<horario>\n"
+        f"  <medico>{horario['medico']}</medico>\n"
+        f"  <dia>{horario['dia']}</dia>\n"
+        f"  <horario_inicio>{horario['hora_inicio']}</horario_inicio>\n"
+        f"  <horario_fim>{horario['hora_fim']}</horario_fim>\n"
+        f"</horario>\n"
+    )
+
+
+def format_exame(exame: Dict) -> str:
+    return (
+        f"<exame>\n"
+        f"  <nome>{exame['nome']}</nome>\n"
+        f"  <preco>R$ {exame['preco']:.2f}</preco>\n"
+        f"  <o_que_e>{exame['o_que_e']}</o_que_e>\n"
+        f"  <como_funciona>{exame['como_funciona']}</como_funciona>\n"
+        f"  <preparacao>{exame['preparacao'] or 'Nenhuma preparação específica necessária.'}</preparacao>\n"
+        f"  <vantagem>{exame['vantagem'] or ''}</vantagem>\n"
+        f"</exame>\n"
+    )
+
+
+def format_especialidade(especialidade: Dict) -> str:
+    return (
+        f"<especialidade>\n"
+        f"  <nome>{especialidade['nome']}</nome>\n"
+        f"  <descricao>{especialidade['descricao'] or ''}</descricao>\n"
+        f"</especialidade>\n"
+    )
+
+
+def format_catalogo(snapshot: Dict) -> str:
+    """Nomes dos médicos (com especialidades) e dos exames, sempre enviados no prompt"""
+    limite = get_retrieval_setting('MAX_NOMES_CATALOGO')
+    medicos = [
+        f"{medico['nome']} ({', '.join(medico['especialidades'])})" if medico['especialidades'] else medico['nome']
+        for medico in snapshot['medicos'][:limite]
+    ]
+    exames = [exame['nome'] for exame in snapshot['exames'][:limite]]
+    return (
+        f"<catalogo>\n"
+        f"  <medicos>{'; '.join(medicos)}</medicos>\n"
+        f"  <exames>{'; '.join(exames)}</exames>\n"
+        f"</catalogo>\n"
+    )
+
+
+def build_chunks(snapshot: Dict) -> Dict[tuple, Chunk]:
+    """
+    Divide a base de conhecimento em trechos indexáveis
+
+    Returns:
+        Dicionário {chave do trecho: (texto para o prompt, texto indexado)}
+    """
+    chunks = {}
+
+    for medico in snapshot['medicos']:
+        chunks[('medico', medico['id'])] = (
+            format_medico(medico),
+            ' '.join([
+                medico['nome'], medico['nome'], ' '.join(medico['especialidades']),
+                medico['bio'], medico['convenios'], medico['formas_pagamento'], KEYWORDS['medico'],
+            ]),
+        )
+
+    horarios_por_medico = {}
+    for horario in snapshot['horarios']:
+        horarios_por_medico.setdefault((horario['medico_id'], horario['medico']), []).append(horario)
+    for (medico_id, medico_nome), horarios in horarios_por_medico.items():
+        chunks[('horarios', medico_id)] = (
+            ''.join(format_horario(horario) for horario in horarios),
+            ' '.join([medico_nome, medico_nome, ' '.join(horario['dia'] for horario in horarios), KEYWORDS['horarios']]),
+        )
+
+    for exame in snapshot['exames']:
+        chunks[('exame', exame['id'])] = (
+            format_exame(exame),
+            ' '.join([
+                exame['nome'], exame['nome'], exame['o_que_e'], exame['como_funciona'],
+                exame['preparacao'] or '', exame['vantagem'] or '', KEYWORDS['exame'],
+            ]),
+        )
+
+    for especialidade in snapshot.get('especialidades', []):
+        chunks[('especialidade', especialidade['nome'])] = (
+            format_especialidade(especialidade),
+            ' '.join([especialidade['nome'], especialidade['nome'], especialidade['descricao'] or '', KEYWORDS['especialidade']]),
+        )
+
+    return chunks
+
+
+class BM25Index:
+    """
+    Índice BM25 dos trechos da base de conhecimento
+
+    Atualizações geram um novo índice (cópia rasa) em vez de alterar o atual,
+    então buscas concorrentes nunca veem um índice pela metade.
+    """
+
+    def __init__(self):
+        self.docs: Dict[tuple, Tuple[Chunk, Counter, int]] = {}  # chave -> (trecho, termos, tamanho)
+        self.postings: Dict[str, frozenset] = {}
+        self.total_length = 0
+
+    def updated(self, chunks: Dict[tuple, Chunk]) -> Tuple['BM25Index', Dict[str, int]]:
+        """
+        Novo índice com os trechos informados, reindexando só os que mudaram
+
+        Returns:
+            (novo índice, contagem de trechos adicionados, removidos e mantidos)
+        """
+        index = BM25Index()
+        index.docs = dict(self.docs)
+        index.postings = dict(self.postings)
+        index.total_length = self.total_length
+        stats = {'adicionados': 0, 'removidos': 0, 'mantidos': 0}
+
+        for key in [key for key in index.docs if key not in chunks]:
+            index._remove(key)
+            stats['removidos'] += 1
+
+        for key, chunk in chunks.items():
+            atual = index.docs.get(key)
+            if atual is not None and atual[0] == chunk:
+                stats['mantidos'] += 1
+                continue
+            if atual is not None:
+                index._remove(key)
+            index._add(key, chunk)
+            stats['adicionados'] += 1
+
+        return index, stats
+
+    def search(self, query: str, k: int) -> List[Tuple[tuple, float]]:
+        """
+        Trechos mais relevantes para a consulta
+
+        Returns:
+            Lista de (chave, score) em ordem decrescente de relevância
+        """
+        if not self.docs:
+            return []
+
+        total_docs = len(self.docs)
+        avg_length = self.total_length / total_docs
+        scores = Counter()
+
+        for term in set(tokenize(query)):
+            keys = self.postings.get(term)
+            if not keys:
+                continue
+            idf = math.log(1 + (total_docs - len(keys) + 0.5) / (len(keys) + 0.5))
+            for key in keys:
+                _, terms, length = self.docs[key]
+                tf = terms[term]
+                scores[key] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+    def text(self, key: tuple) -> str:
+        return self.docs[key][0][0]
+
+    def _add(self, key: tuple, chunk: Chunk):
+        terms = Counter(tokenize(chunk[1]))
+        length = sum(terms.values())
+        self.docs[key] = (chunk, terms, length)
+        self.total_length += length
+        for term in terms:
+            self.postings[term] = self.postings.get(term, frozenset()) | {key}
+
+    def _remove(self, key: tuple):
+        _, terms, length = self.docs.pop(key)
+        self.total_length -= length
+        for term in terms:
+            remaining = self.postings[term] - {key}
+            if remaining:
+                self.postings[term] = remaining
+            else:
+                del self.postings[term]
+
+
+def get_retrieval_index() -> BM25Index:
+    """Índice da versão atual da base, atualizado a partir do índice anterior"""
+    global _local_index
+
+    version = get_knowledge_base_version()
+    local_version, index = _local_index
+    if local_version == version:
+        return index
+
+    with _local_lock:
+        local_version, index = _local_index
+        if local_version != version:
+            index, stats = (index or BM25Index()).updated(build_chunks(get_knowledge_base_snapshot()))
+            print(f"Índice da base de conhecimento atualizado (versão {version}): {stats}")
+            _local_index = (version, index)
+
+    return index
+
+
+def retrieve_context(query: str, k: Optional[int] = None) -> str:
+    """
+    Trechos da base de conhecimento relevantes para a consulta
+
+    Args:
+        query: Mensagens recentes da conversa
+        k: Quantidade máxima de trechos (padrão: TOP_K)
+
+    Returns:
+        Bloco <knowledge_base> com os trechos ou string vazia se nenhum for relevante
+    """
+    index = get_retrieval_index()
+    results = index.search(query, k or get_retrieval_setting('TOP_K'))
+    if not results:
+        return ''
+    return "<knowledge_base>\n" + ''.join(index.text(key) for key, _ in results) + "</knowledge_base>"
@@ -0,0 +1,74 @@
+"""
+Gravação em lote das mensagens da conversa
+
+Cada MensagemConversa.objects.create é uma escrita separada; no SQLite,
+cada uma disputa o lock global de escrita e espera o fsync. O
+MessageBuffer acumula as mensagens de uma fase do turno (usuário, bot e
+sistema) e grava todas com um único bulk_create, dentro da transação da
+própria fase. Assim tudo fica salvo antes do envio ao WhatsApp.
+"""
+import time
+from typing import List, Optional
+
+from django.db import transaction
+
+from ..models import Conversa, MensagemConversa
+from ..utils import metrics
+
+
+class MessageBuffer:
+    """
+    Acumula mensagens e grava todas de uma vez, na ordem em que foram
+    adicionadas (os ids seguem a ordem; o model ordena por timestamp e id)
+
+    Uso:
+        with transaction.atomic(), MessageBuffer() as mensagens:
+            mensagens.add(conversa, 'bot', texto)
+        # gravadas ao sair do bloco, dentro da transação
+
+    Se o bloco terminar com exceção, nada é gravado.
+    """
+
+    def __init__(self):
+        self.pending: List[MensagemConversa] = []
+
+    def add(self, conversa: Conversa, remetente: str, conteudo: str,
+            whatsapp_message_id: Optional[str] = None) -> MensagemConversa:
+        """
+        Adiciona uma mensagem ao lote
+
+        Returns:
+            A mensagem (o id é preenchido ao gravar o lote)
+        """
+        mensagem = MensagemConversa(
+            conversa=conversa, remetente=remetente, conteudo=conteudo,
+            whatsapp_message_id=whatsapp_message_id,
+        )
+        self.pending.append(mensagem)
+        return mensagem
+
+    def flush(self) -> List[MensagemConversa]:
+        """Grava as mensagens acumuladas com um único INSERT"""
+        if not self.pending:
+            return []
+
+        mensagens, self.pending = self.pending, []
+        started = time.monotonic()
+        # Sem savepoint quando já há transação (caso normal): só o INSERT
+        with transaction.atomic(savepoint=False):
+            MensagemConversa.objects.bulk_create(mensagens)
+        # Latência até a gravação ser confirmada (inclui o commit da transação externa)
+        transaction.on_commit(lambda: metrics.observe('mensagens.gravacao_lote', time.monotonic() - started))
+        metrics.increment('mensagens.gravadas', len(mensagens))
+        metrics.increment('mensagens.lotes')
+        return mensagens
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.pending = []
+        return False
@@ -0,0 +1,54 @@
+"""
+Deduplicação de mensagens recebidas pelo webhook
+
+A Meta entrega as notificações "pelo menos uma vez": a mesma mensagem
+(mesmo `messages[].id`) pode chegar várias vezes. O id é registrado no cache
+com TTL e as entregas repetidas são descartadas em O(1), antes de qualquer
+acesso ao banco ou à IA.
+"""
+from typing import Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ..utils import metrics
+
+DEDUP_CACHE_KEY = 'chatbot:wa_msg:{message_id}'
+DEFAULT_DEDUP_TTL = 60 * 60 * 48
+
+
+def register_message_id(message_id: str) -> bool:
+    """
+    Registra o id da mensagem do WhatsApp
+
+    Args:
+        message_id: Valor de messages[].id
+
+    Returns:
+        True se é a primeira entrega, False se é repetida
+    """
+    if not message_id:
+        return True
+
+    ttl = getattr(settings, 'CHATBOT_DEDUP_TTL_SEGUNDOS', DEFAULT_DEDUP_TTL)
+    is_new = cache.add(DEDUP_CACHE_KEY.format(message_id=message_id), 1, ttl)
+
+    if is_new:
+        metrics.increment('webhook.dedup_miss')
+    else:
+        metrics.increment('webhook.dedup_hit')
+        print(f"Mensagem {message_id} repetida, descartada")
+
+    return is_new
+
+
+def forget_message_ids(message_ids: Iterable[str]):
+    """
+    Remove ids registrados (ex: falha ao enfileirar), permitindo que a
+    reentrega da Meta seja processada
+    """
+    cache.delete_many([
+        DEDUP_CACHE_KEY.format(message_id=message_id)
+        for message_id in message_ids
+        if message_id
+    ])
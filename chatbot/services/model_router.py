@@ -0,0 +1,485 @@
+"""
+Roteamento entre modelos do Gemini, com cadeia de fallback
+
+- Turnos simples vão para um modelo rápido e barato; turnos de agendamento,
+  para um modelo mais forte. Cada tipo de turno tem uma cadeia de modelos
+  em ordem de preferência;
+- Cada modelo tem seu próprio timeout;
+- Hedging: se o modelo da vez não responde dentro do p95 da sua latência
+  recente, o próximo da cadeia é disparado em paralelo e vale a primeira
+  resposta que chegar;
+- Circuit breaker: um modelo com falhas seguidas é pulado durante um
+  período de espera e depois recebe uma única chamada de teste.
+
+Assim a latência do pior caso fica limitada mesmo quando um dos modelos
+degrada.
+"""
+import asyncio
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+from django.conf import settings
+
+from ..utils import metrics
+from ..utils.command_parser import (COMMAND_NAMES, DATE_PATTERN,
+                                    DAY_ONLY_PATTERN, TIME_PATTERN, WEEKDAYS,
+                                    normalize_text)
+
+DEFAULT_MODEL_ROUTER_SETTINGS = {
+    'CADEIAS': {
+        'simples': ['gemini-2.0-flash-lite', 'gemini-2.0-flash-exp'],
+        'agendamento': ['gemini-2.0-flash-exp', 'gemini-2.0-flash-lite'],
+    },
+    'TIMEOUTS_SEGUNDOS': {
+        'gemini-2.0-flash-lite': 10,
+        'gemini-2.0-flash-exp': 20,
+    },
+    'TIMEOUT_PADRAO_SEGUNDOS': 20,
+    'HEDGING': True,
+    'PERCENTIL_HEDGE': 0.95,
+    'ATRASO_HEDGE_PADRAO_SEGUNDOS': 4.0,
+    'ATRASO_HEDGE_MINIMO_SEGUNDOS': 1.0,
+    'AMOSTRAS_LATENCIA': 200,
+    'MIN_AMOSTRAS_HEDGE': 20,
+    'MAX_THREADS_HEDGE': 16,
+    'FALHAS_PARA_ABRIR': 3,
+    'ESPERA_CIRCUITO_SEGUNDOS': 60,
+    'MENSAGENS_CLASSIFICACAO': 4,
+}
+
+TASKS = ('simples', 'agendamento')
+
+# Radicais (texto normalizado) que indicam agendamento na mensagem do usuário
+SCHEDULING_STEMS = (
+    'agend', 'marca', 'marcar', 'remarc', 'desmarc', 'cancel', 'horario', 'vaga',
+    'disponiv', 'amanha', 'hoje', 'semana que vem', 'proxima semana',
+)
+
+SCHEDULING_PATTERN = re.compile(
+    r"\b(?:" + "|".join(re.escape(stem) for stem in SCHEDULING_STEMS + tuple(WEEKDAYS)) + r")"
+)
+
+_executor_lock = threading.Lock()
+_executor = None
+
+
+def get_model_router_setting(name: str):
+    """Lê uma configuração do roteamento de modelos (settings.GEMINI_MODEL_ROUTER)"""
+    return getattr(settings, 'GEMINI_MODEL_ROUTER', {}).get(name, DEFAULT_MODEL_ROUTER_SETTINGS[name])
+
+
+def classify_turn(chat_history: List[Dict], mode: str = 'comandos') -> str:
+    """
+    Classifica o turno como 'simples' ou 'agendamento'
+
+    No modo de ferramentas o modelo decide chamadas de agenda, então o turno
+    é sempre de agendamento. No modo de comandos, olha as mensagens recentes
+    do usuário (datas, horários, dias da semana, "marcar", "agendar"...) e
+    os comandos de agenda já emitidos pela IA.
+
+    Args:
+        chat_history: Histórico no formato role/parts
+        mode: Modo da IA ('comandos' ou 'ferramentas')
+
+    Returns:
+        Tipo do turno
+    """
+    if mode == 'ferramentas':
+        return 'agendamento'
+
+    for item in chat_history[-get_model_router_setting('MENSAGENS_CLASSIFICACAO'):]:
+        text = ' '.join(item.get('parts', []))
+        if item.get('role', 'user') == 'user':
+            normalized = normalize_text(text)
+            if any(pattern.search(normalized) for pattern in (SCHEDULING_PATTERN, DATE_PATTERN, DAY_ONLY_PATTERN, TIME_PATTERN)):
+                return 'agendamento'
+        elif any(f"[{name}" in text for name in COMMAND_NAMES):
+            return 'agendamento'
+
+    return 'simples'
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Pool de threads (do processo) para as chamadas com hedging"""
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=get_model_router_setting('MAX_THREADS_HEDGE'),
+                    thread_name_prefix='gemini-hedge',
+                )
+    return _executor
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker por modelo
+
+    - Fechado: chamadas normais;
+    - Aberto: após FALHAS_PARA_ABRIR falhas seguidas, o modelo é pulado por
+      ESPERA_CIRCUITO_SEGUNDOS;
+    - Meio aberto: terminada a espera, uma única chamada de teste decide se
+      o circuito fecha (sucesso) ou abre de novo (falha). A reserva da
+      chamada de teste expira após `probe_timeout`, caso ela nem chegue a
+      ser feita (ex: o modelo anterior da cadeia respondeu antes).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures: Dict[str, int] = {}
+        self._open_until: Dict[str, float] = {}
+        self._probing: Dict[str, float] = {}  # modelo -> instante da reserva da chamada de teste
+
+    def allow(self, model: str, probe_timeout: float) -> bool:
+        """Indica se o modelo pode ser chamado agora (reserva a chamada de teste)"""
+        with self._lock:
+            open_until = self._open_until.get(model)
+            if open_until is None:
+                return True
+            now = time.monotonic()
+            if now < open_until or now - self._probing.get(model, float('-inf')) < probe_timeout:
+                return False
+            self._probing[model] = now
+            return True
+
+    def record_success(self, model: str):
+        with self._lock:
+            self._failures.pop(model, None)
+            self._open_until.pop(model, None)
+            self._probing.pop(model, None)
+
+    def record_failure(self, model: str):
+        with self._lock:
+            failures = self._failures.get(model, 0) + 1
+            self._failures[model] = failures
+            probing = self._probing.pop(model, None) is not None
+            if probing or failures >= get_model_router_setting('FALHAS_PARA_ABRIR'):
+                print(f"Circuito aberto para o modelo {model} após {failures} falha(s) seguida(s)")
+                metrics.increment(f'model_router.circuito_aberto.{model}')
+                self._open_until[model] = time.monotonic() + get_model_router_setting('ESPERA_CIRCUITO_SEGUNDOS')
+
+    def state(self, model: str) -> str:
+        """Estado atual do circuito: fechado, aberto ou meio_aberto"""
+        with self._lock:
+            open_until = self._open_until.get(model)
+            if open_until is None:
+                return 'fechado'
+            return 'aberto' if time.monotonic() < open_until else 'meio_aberto'
+
+
+class LatencyTracker:
+    """Janela das latências recentes de cada modelo, para calcular percentis"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = {}
+
+    def observe(self, model: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=get_model_router_setting('AMOSTRAS_LATENCIA'))
+            samples.append(seconds)
+
+    def percentile(self, model: str, fraction: float) -> Optional[float]:
+        """Percentil das amostras do modelo ou None se ainda houver poucas"""
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < get_model_router_setting('MIN_AMOSTRAS_HEDGE'):
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class ModelRouter:
+    """
+    Escolhe e chama os modelos de cada turno
+
+    As chamadas recebem uma função `request(model, timeout)` que faz a
+    requisição ao Gemini para o modelo indicado, com o timeout em segundos;
+    o roteador decide a ordem, o hedging e o fallback.
+    """
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.latencies = LatencyTracker()
+
+    def chain(self, task: str) -> List[str]:
+        """
+        Modelos do tipo de turno, em ordem (o circuit breaker é consultado
+        só na hora de chamar cada um, em `_next_allowed`)
+        """
+        cadeias = get_model_router_setting('CADEIAS')
+        return list(cadeias.get(task) or cadeias[TASKS[0]])
+
+    def _next_allowed(self, remaining: List[str], attempted: bool) -> Optional[str]:
+        """
+        Retira de `remaining` o próximo modelo que o circuito deixa chamar
+
+        A consulta ao breaker (que reserva a chamada de teste do circuito
+        meio aberto) é feita imediatamente antes da chamada, então modelos
+        que não chegam a ser chamados não gastam essa reserva. Se nenhum
+        modelo foi tentado e todos estão abertos, usa o primeiro mesmo assim.
+
+        Returns:
+            Modelo a chamar ou None se a cadeia acabou
+        """
+        first = remaining[0] if remaining else None
+        while remaining:
+            model = remaining.pop(0)
+            if self.breaker.allow(model, self.timeout(model)):
+                return model
+        return None if attempted else first
+
+    def timeout(self, model: str) -> float:
+        """Timeout da chamada ao modelo, em segundos"""
+        timeouts = get_model_router_setting('TIMEOUTS_SEGUNDOS')
+        return timeouts.get(model, get_model_router_setting('TIMEOUT_PADRAO_SEGUNDOS'))
+
+    def hedge_delay(self, model: str) -> float:
+        """Tempo de espera pelo modelo antes de disparar o próximo da cadeia"""
+        delay = self.latencies.percentile(model, get_model_router_setting('PERCENTIL_HEDGE'))
+        if delay is None:
+            delay = get_model_router_setting('ATRASO_HEDGE_PADRAO_SEGUNDOS')
+        return min(max(delay, get_model_router_setting('ATRASO_HEDGE_MINIMO_SEGUNDOS')), self.timeout(model))
+
+    def call(self, task: str, request: Callable):
+        """
+        Executa a requisição na cadeia do turno, com hedging e fallback
+
+        Args:
+            task: Tipo do turno ('simples' ou 'agendamento')
+            request: Função (modelo, timeout) -> resposta
+
+        Returns:
+            Resposta do primeiro modelo que responder com sucesso
+
+        Raises:
+            Exception: A última falha, se todos os modelos falharem
+        """
+        remaining = self.chain(task)
+        if len(remaining) == 1 or not get_model_router_setting('HEDGING'):
+            return self._call_in_order(remaining, request)
+
+        executor = _get_executor()
+        pending = {}  # future -> (modelo, disparado_em)
+        attempted = []
+        last_error = None
+
+        def launch() -> bool:
+            model = self._next_allowed(remaining, bool(attempted))
+            if model is None:
+                return False
+            attempted.append(model)
+            pending[executor.submit(self._timed_request, model, request)] = (model, time.monotonic())
+            return True
+
+        launch()
+        while pending:
+            newest_model, newest_started = list(pending.values())[-1]
+            # Espera até o prazo de hedge do último disparado ou até o timeout de todos
+            if remaining:
+                wait_for = max(0.0, newest_started + self.hedge_delay(newest_model) - time.monotonic())
+            else:
+                wait_for = max(0.0, max(started + self.timeout(model) for model, started in pending.values()) - time.monotonic())
+
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            if not done:
+                if remaining:
+                    if launch():
+                        print(f"Modelo {newest_model} sem resposta em {wait_for:.2f}s, disparando hedge")
+                        metrics.increment('model_router.hedges')
+                    continue
+                # As chamadas pendentes terminam sozinhas pelo timeout da requisição
+                raise TimeoutError("Nenhum modelo respondeu dentro do timeout")
+
+            for future in done:
+                model, _ = pending.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    last_error = e
+                    if not pending and remaining:
+                        launch()
+                    continue
+                if pending:
+                    metrics.increment('model_router.hedges_descartados')
+                return response
+
+        raise last_error
+
+    async def call_async(self, task: str, request: Callable):
+        """
+        Versão assíncrona de call: `request(model, timeout)` é uma corrotina;
+        as chamadas que perderem a corrida são canceladas
+        """
+        remaining = self.chain(task)
+        hedging = len(remaining) > 1 and get_model_router_setting('HEDGING')
+        pending = {}  # task -> modelo
+        attempted = []
+        last_error = None
+
+        def launch() -> bool:
+            model = self._next_allowed(remaining, bool(attempted))
+            if model is None:
+                return False
+            attempted.append(model)
+            pending[asyncio.ensure_future(self._timed_request_async(model, request))] = model
+            return True
+
+        launch()
+        try:
+            while pending:
+                newest_model = list(pending.values())[-1]
+                wait_for = self.hedge_delay(newest_model) if hedging and remaining else None
+                done, _ = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if launch():
+                        print(f"Modelo {newest_model} sem resposta em {wait_for:.2f}s, disparando hedge")
+                        metrics.increment('model_router.hedges')
+                    continue
+
+                for finished in done:
+                    pending.pop(finished)
+                    try:
+                        return finished.result()
+                    except Exception as e:
+                        last_error = e
+                        if not pending and remaining:
+                            launch()
+        finally:
+            for unfinished in pending:
+                unfinished.cancel()
+            if pending:
+                metrics.increment('model_router.hedges_descartados')
+
+        raise last_error
+
+    def stream(self, task: str, open_stream: Callable):
+        """
+        Streaming com fallback: tenta os modelos em ordem enquanto nenhum
+        pedaço foi recebido; depois do primeiro pedaço, o modelo fica fixo.
+        Não usa hedging (duas respostas em streaming não podem ser misturadas).
+
+        Args:
+            task: Tipo do turno
+            open_stream: Função (modelo, timeout) -> iterador de pedaços
+
+        Yields:
+            Pedaços da resposta
+        """
+        remaining = self.chain(task)
+        last_error = None
+        while (model := self._next_allowed(remaining, last_error is not None)) is not None:
+            try:
+                stream = open_stream(model, self.timeout(model))
+                first = next(stream, None)
+            except Exception as e:
+                print(f"Falha no modelo {model}: {e}")
+                self._record_failure(model)
+                last_error = e
+                continue
+
+            self.breaker.record_success(model)
+            if first is not None:
+                yield first
+            yield from stream
+            return
+
+        raise last_error
+
+    async def stream_async(self, task: str, open_stream: Callable):
+        """Versão assíncrona de stream: `open_stream` retorna um iterador assíncrono"""
+        remaining = self.chain(task)
+        last_error = None
+        while (model := self._next_allowed(remaining, last_error is not None)) is not None:
+            try:
+                stream = open_stream(model, self.timeout(model))
+                first = await asyncio.wait_for(anext(stream, None), self.timeout(model))
+            except Exception as e:
+                print(f"Falha no modelo {model}: {e}")
+                self._record_failure(model)
+                last_error = e
+                continue
+
+            self.breaker.record_success(model)
+            if first is not None:
+                yield first
+            async for chunk in stream:
+                yield chunk
+            return
+
+        raise last_error
+
+    def _call_in_order(self, models: List[str], request: Callable):
+        """Fallback simples, sem hedging: um modelo de cada vez"""
+        last_error = None
+        while (model := self._next_allowed(models, last_error is not None)) is not None:
+            try:
+                return self._timed_request(model, request)
+            except Exception as e:
+                last_error = e
+        raise last_error
+
+    def _timed_request(self, model: str, request: Callable):
+        """Executa a requisição registrando latência e resultado no circuit breaker"""
+        started = time.monotonic()
+        try:
+            response = request(model, self.timeout(model))
+        except Exception as e:
+            print(f"Falha no modelo {model}: {e}")
+            self._record_failure(model)
+            raise
+        self._record_success(model, time.monotonic() - started)
+        return response
+
+    async def _timed_request_async(self, model: str, request: Callable):
+        """Versão assíncrona de _timed_request (cancelamento não conta como falha)"""
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(request(model, self.timeout(model)), self.timeout(model))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Falha no modelo {model}: {e!r}")
+            self._record_failure(model)
+            raise
+        self._record_success(model, time.monotonic() - started)
+        return response
+
+    def _record_success(self, model: str, seconds: float):
+        self.breaker.record_success(model)
+        self.latencies.observe(model, seconds)
+        metrics.observe(f'model_router.latencia.{model}', seconds)
+
+    def _record_failure(self, model: str):
+        self.breaker.record_failure(model)
+        metrics.increment(f'model_router.falhas.{model}')
+
+    def get_stats(self) -> Dict:
+        """Estado do circuito e p95 recente de cada modelo configurado"""
+        models = {model for chain in get_model_router_setting('CADEIAS').values() for model in chain}
+        stats = {}
+        for model in sorted(models):
+            p95 = self.latencies.percentile(model, get_model_router_setting('PERCENTIL_HEDGE'))
+            stats[model] = {
+                'circuito': self.breaker.state(model),
+                'p95_ms': round(p95 * 1000, 2) if p95 is not None else None,
+            }
+        return stats
+
+
+_model_router = ModelRouter()
+
+
+def get_model_router() -> ModelRouter:
+    """Roteador compartilhado pelo processo (circuitos e latências valem para todas as instâncias)"""
+    return _model_router
+
+
+metrics.register_gauge('model_router', _model_router.get_stats)
@@ -0,0 +1,203 @@
+"""
+Lock exclusivo por paciente
+
+Serializa o processamento de mensagens de um mesmo paciente (várias
+entregas simultâneas da Meta para o mesmo número) sem afetar pacientes
+diferentes, que continuam sendo processados em paralelo.
+
+O backend (CHATBOT_PATIENT_LOCK['BACKEND']) vale para todos os caminhos
+(webhook assíncrono, `processar_fila`, chamadas síncronas), que assim se
+excluem entre si:
+
+- 'postgres': advisory lock de sessão (pg_try_advisory_lock);
+- 'banco': uma linha por telefone em TravaPaciente, com validade
+  (TTL_SEGUNDOS); funciona em qualquer banco compartilhado pelos processos;
+- 'cache': cache.add no cache do Django; exige cache compartilhado
+  (Redis/Memcached). Com LocMemCache o system check recusa a configuração;
+- 'auto' (padrão): 'postgres' no Postgres, 'banco' nos demais.
+
+O TTL só importa quando o processo que detém o lock cai sem liberá-lo: deve
+ser bem maior que o pior turno (ver chatbot/checks.py).
+"""
+import asyncio
+import hashlib
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+
+from ..models import TravaPaciente
+
+DEFAULT_LOCK_SETTINGS = {
+    'BACKEND': 'auto',
+    'TTL_SEGUNDOS': 600,
+    'ESPERA_MAXIMA_SEGUNDOS': 120,
+    'INTERVALO_SEGUNDOS': 0.1,
+}
+
+LOCK_BACKENDS = ('postgres', 'banco', 'cache')
+
+LOCK_CACHE_KEY = 'chatbot:patient_lock:{telefone}'
+
+# Advisory locks são reentrantes na mesma sessão: duas tarefas assíncronas do
+# mesmo processo podem usar a mesma conexão, então o processo também registra
+# as chaves que já detém
+_held_advisory_keys = set()
+_held_advisory_keys_lock = threading.Lock()
+
+
+def get_lock_setting(name: str):
+    """Lê uma configuração do lock (settings.CHATBOT_PATIENT_LOCK) com valor padrão"""
+    return getattr(settings, 'CHATBOT_PATIENT_LOCK', {}).get(name, DEFAULT_LOCK_SETTINGS[name])
+
+
+def get_lock_backend() -> str:
+    """Backend do lock: BACKEND explícito ou, em 'auto', conforme o banco"""
+    backend = get_lock_setting('BACKEND')
+    if backend == 'auto':
+        return 'postgres' if connection.vendor == 'postgresql' else 'banco'
+    return backend
+
+
+class PatientLockTimeout(Exception):
+    """Não foi possível obter o lock do paciente dentro do tempo de espera"""
+
+
+class PatientLock:
+    """
+    Lock exclusivo por número de WhatsApp
+
+    Uso:
+        with PatientLock(telefone):
+            ...
+
+    A versão assíncrona (`async with`) usa o mesmo backend: cada tentativa
+    roda via sync_to_async(thread_sensitive=True), na mesma thread (e
+    conexão) que depois libera o lock.
+    """
+
+    def __init__(self, telefone_whatsapp: str, backend: str = None):
+        self.telefone_whatsapp = telefone_whatsapp
+        self.token = uuid.uuid4().hex
+        self.backend = backend or get_lock_backend()
+        self.acquired = False
+
+    @property
+    def advisory_key(self) -> int:
+        """Chave inteira de 64 bits (com sinal) derivada do telefone"""
+        digest = hashlib.blake2b(self.telefone_whatsapp.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big', signed=True)
+
+    def try_acquire(self) -> bool:
+        """Tenta obter o lock sem esperar"""
+        if self.backend == 'postgres':
+            self.acquired = self._try_acquire_advisory()
+        elif self.backend == 'banco':
+            self.acquired = self._try_acquire_row()
+        else:
+            self.acquired = cache.add(
+                LOCK_CACHE_KEY.format(telefone=self.telefone_whatsapp),
+                self.token,
+                get_lock_setting('TTL_SEGUNDOS'),
+            )
+        return self.acquired
+
+    def _try_acquire_advisory(self) -> bool:
+        with _held_advisory_keys_lock:
+            if self.advisory_key in _held_advisory_keys:
+                return False
+            _held_advisory_keys.add(self.advisory_key)
+        acquired = False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", [self.advisory_key])
+                acquired = bool(cursor.fetchone()[0])
+        finally:
+            if not acquired:
+                with _held_advisory_keys_lock:
+                    _held_advisory_keys.discard(self.advisory_key)
+        return acquired
+
+    def _try_acquire_row(self) -> bool:
+        """
+        Grava o token na linha do telefone, se ela não existe ou venceu
+
+        Um único INSERT ... ON CONFLICT (SQLite >= 3.24 e Postgres): a linha
+        só é alterada quando a trava anterior já expirou.
+        """
+        agora = timezone.now()
+        table = connection.ops.quote_name(TravaPaciente._meta.db_table)
+        adapt = connection.ops.adapt_datetimefield_value
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (telefone_whatsapp, token, expira_em) VALUES (%s, %s, %s) "
+                f"ON CONFLICT (telefone_whatsapp) DO UPDATE SET token = excluded.token, expira_em = excluded.expira_em "
+                f"WHERE {table}.expira_em <= %s",
+                [
+                    self.telefone_whatsapp, self.token,
+                    adapt(agora + timedelta(seconds=get_lock_setting('TTL_SEGUNDOS'))), adapt(agora),
+                ]
+            )
+            return cursor.rowcount == 1
+
+    def acquire(self):
+        """
+        Aguarda o lock por até ESPERA_MAXIMA_SEGUNDOS
+
+        Raises:
+            PatientLockTimeout: Se o lock não foi obtido a tempo
+        """
+        deadline = time.monotonic() + get_lock_setting('ESPERA_MAXIMA_SEGUNDOS')
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                raise PatientLockTimeout(f"Lock do paciente {self.telefone_whatsapp} ocupado")
+            time.sleep(get_lock_setting('INTERVALO_SEGUNDOS'))
+
+    def release(self):
+        """Libera o lock, se ainda pertencer a esta instância"""
+        if not self.acquired:
+            return
+
+        if self.backend == 'postgres':
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_unlock(%s)", [self.advisory_key])
+            finally:
+                with _held_advisory_keys_lock:
+                    _held_advisory_keys.discard(self.advisory_key)
+        elif self.backend == 'banco':
+            # Vence a trava (só se ainda for deste token); a linha é reaproveitada
+            TravaPaciente.objects.filter(
+                telefone_whatsapp=self.telefone_whatsapp, token=self.token
+            ).update(expira_em=timezone.now())
+        else:
+            key = LOCK_CACHE_KEY.format(telefone=self.telefone_whatsapp)
+            # Não remove o lock de outro processo caso o TTL tenha expirado
+            if cache.get(key) == self.token:
+                cache.delete(key)
+
+        self.acquired = False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    async def __aenter__(self):
+        deadline = time.monotonic() + get_lock_setting('ESPERA_MAXIMA_SEGUNDOS')
+        while not await sync_to_async(self.try_acquire, thread_sensitive=True)():
+            if time.monotonic() >= deadline:
+                raise PatientLockTimeout(f"Lock do paciente {self.telefone_whatsapp} ocupado")
+            await asyncio.sleep(get_lock_setting('INTERVALO_SEGUNDOS'))
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await sync_to_async(self.release, thread_sensitive=True)()
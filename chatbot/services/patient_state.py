@@ -0,0 +1,90 @@
+"""
+Estado do paciente (paciente, conversa ativa e pendências) em uma consulta
+
+A cada mensagem recebida o fluxo precisa saber quem é o paciente, qual a
+conversa ativa e se há direcionamento pendente. Em vez de uma consulta para
+cada item (get_or_create, exists, first...), uma única consulta ao paciente
+traz tudo: a conversa ativa vem por LEFT JOIN (no máximo uma, pela
+constraint única parcial) e as pendências por Exists.
+"""
+from typing import Optional
+
+from django.db.models import Exists, F, FilteredRelation, OuterRef, Q
+
+from usuarios.models import Paciente
+
+from ..models import Conversa, Direcionamento, MensagemConversa
+
+DIRECIONAMENTO_PENDENTE_STATUS = ('pendente', 'em_andamento')
+
+# Campos da conversa trazidos pelo JOIN (o paciente já vem na linha principal)
+CONVERSA_FIELDS = [field.attname for field in Conversa._meta.concrete_fields]
+
+
+class PatientState:
+    """
+    Estado do paciente carregado por `load_patient_state`
+
+    Atributos:
+        paciente: Paciente
+        conversa: Conversa ativa (com `paciente` já preenchido) ou None
+        direcionamento_pendente: Há direcionamento pendente ou em andamento
+        mensagens_pendentes: A conversa ativa tem mensagens do usuário ainda
+            não respondidas (ex: nova tentativa da fila após falha)
+    """
+
+    def __init__(self, paciente: Paciente, conversa: Optional[Conversa],
+                 direcionamento_pendente: bool, mensagens_pendentes: bool):
+        self.paciente = paciente
+        self.conversa = conversa
+        self.direcionamento_pendente = direcionamento_pendente
+        self.mensagens_pendentes = mensagens_pendentes
+
+
+def _state_queryset():
+    """Pacientes anotados com a conversa ativa e as pendências"""
+    conversa_fields = {
+        f'conversa_{name}': F(f'conversa_ativa__{name}')
+        for name in CONVERSA_FIELDS if name != 'paciente_id'
+    }
+
+    return Paciente.objects.alias(
+        conversa_ativa=FilteredRelation('conversas', condition=Q(conversas__status='ativa')),
+    ).annotate(
+        direcionamento_pendente=Exists(Direcionamento.objects.filter(
+            paciente=OuterRef('pk'),
+            status__in=DIRECIONAMENTO_PENDENTE_STATUS
+        )),
+        mensagens_pendentes=Exists(MensagemConversa.objects.filter(
+            conversa=OuterRef('conversa_ativa__id'),
+            remetente='user',
+            processada=False
+        )),
+        **conversa_fields
+    )
+
+
+def load_patient_state(telefone_whatsapp: str) -> Optional[PatientState]:
+    """
+    Carrega paciente, conversa ativa e pendências em uma única consulta
+
+    Args:
+        telefone_whatsapp: Número do WhatsApp do paciente
+
+    Returns:
+        PatientState ou None se o paciente ainda não existe
+    """
+    paciente = _state_queryset().filter(telefone_whatsapp=telefone_whatsapp).first()
+    if paciente is None:
+        return None
+
+    conversa = None
+    if paciente.conversa_id is not None:
+        values = [
+            paciente.pk if name == 'paciente_id' else getattr(paciente, f'conversa_{name}')
+            for name in CONVERSA_FIELDS
+        ]
+        conversa = Conversa.from_db(paciente._state.db, CONVERSA_FIELDS, values)
+        conversa.paciente = paciente
+
+    return PatientState(paciente, conversa, paciente.direcionamento_pendente, paciente.mensagens_pendentes)
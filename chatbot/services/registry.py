@@ -0,0 +1,159 @@
+"""
+Registro dos serviços compartilhados pelo processo
+
+Os serviços do chatbot não guardam estado por requisição, então uma única
+instância de cada um atende todas as views e workers do processo. Criar
+um AIService a cada requisição significava um novo genai.Client (e novo
+handshake TLS com o Gemini), além de reler as variáveis de ambiente.
+
+As instâncias são criadas sob demanda, uma única vez (com lock), e são
+pré-carregadas pelos pontos de entrada que atendem mensagens (core.wsgi,
+core.asgi e o comando `processar_fila`), nunca no `ready()` do app: assim
+migrate, check e os testes não criam clientes. Em testes, `override_service`
+troca um serviço por um falso.
+"""
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+from django.conf import settings
+
+DEFAULT_SERVICES_SETTINGS = {
+    'AQUECER_NA_INICIALIZACAO': True,
+}
+
+_lock = threading.RLock()
+_factories: Dict[str, Callable] = {}
+_instances: Dict[str, object] = {}
+
+
+def get_services_setting(name: str):
+    """Lê uma configuração do registro de serviços (settings.CHATBOT_SERVICES)"""
+    return getattr(settings, 'CHATBOT_SERVICES', {}).get(name, DEFAULT_SERVICES_SETTINGS[name])
+
+
+def register_service(name: str, factory: Callable):
+    """Registra a função que cria o serviço (chamada só no primeiro uso)"""
+    with _lock:
+        _factories[name] = factory
+
+
+def get_service(name: str):
+    """
+    Retorna a instância compartilhada do serviço, criando-a no primeiro uso
+
+    Args:
+        name: Nome do serviço registrado (ex: 'conversation')
+
+    Returns:
+        Instância do serviço
+    """
+    instance = _instances.get(name)
+    if instance is not None:
+        return instance
+
+    with _lock:
+        instance = _instances.get(name)
+        if instance is None:
+            instance = _factories[name]()
+            _instances[name] = instance
+    return instance
+
+
+def reset_services():
+    """Descarta as instâncias criadas (a próxima chamada recria cada serviço)"""
+    with _lock:
+        _instances.clear()
+
+
+@contextmanager
+def override_service(name: str, instance):
+    """
+    Substitui um serviço durante o bloco (ex: cliente falso em testes)
+
+    As demais instâncias são descartadas na entrada e na saída, para que
+    serviços que dependem do substituído (ex: 'conversation' depende de
+    'ai') sejam recriados com ele.
+    """
+    with _lock:
+        previous = dict(_instances)
+        _instances.clear()
+        _instances[name] = instance
+    try:
+        yield instance
+    finally:
+        with _lock:
+            _instances.clear()
+            _instances.update(previous)
+
+
+def warm_up():
+    """
+    Cria os serviços principais antes da primeira requisição (chamada pelos
+    pontos de entrada do servidor e dos workers)
+
+    Desligado por CHATBOT_SERVICES['AQUECER_NA_INICIALIZACAO'] = False.
+    Falhas (ex: variáveis de ambiente ausentes) não impedem o start: o
+    serviço será criado no primeiro uso, quando o erro reaparece.
+    """
+    if not get_services_setting('AQUECER_NA_INICIALIZACAO'):
+        return
+
+    for name in ('ai', 'whatsapp', 'conversation', 'inbound_queue'):
+        try:
+            get_service(name)
+        except Exception as e:
+            print(f"Serviços do chatbot não pré-carregados ({name}): {e}")
+            return
+
+
+def _create_ai_service():
+    from .ai_service import AIService
+    return AIService()
+
+
+def _create_whatsapp_service():
+    from .whatsapp_service import WhatsAppService
+    return WhatsAppService()
+
+
+def _create_command_service():
+    from .command_service import CommandService
+    return CommandService()
+
+
+def _create_conversation_service():
+    from .conversation_service import ConversationService
+    return ConversationService()
+
+
+def _create_inbound_queue_service():
+    from .inbound_queue_service import InboundQueueService
+    return InboundQueueService()
+
+
+register_service('ai', _create_ai_service)
+register_service('whatsapp', _create_whatsapp_service)
+register_service('command', _create_command_service)
+register_service('conversation', _create_conversation_service)
+register_service('inbound_queue', _create_inbound_queue_service)
+
+
+def get_ai_service():
+    return get_service('ai')
+
+
+def get_whatsapp_service():
+    return get_service('whatsapp')
+
+
+def get_command_service():
+    return get_service('command')
+
+
+def get_conversation_service():
+    return get_service('conversation')
+
+
+def get_inbound_queue_service():
+    return get_service('inbound_queue')
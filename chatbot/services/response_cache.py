@@ -0,0 +1,269 @@
+"""
+Cache de respostas para perguntas frequentes (preços, endereço, convênios,
+preparo de exames)
+
+Perguntas feitas no início da conversa, sem contexto anterior, costumam se
+repetir entre pacientes. A resposta da IA é guardada pela pergunta
+normalizada e reaproveitada para perguntas iguais ou quase iguais (índice
+local de n-gramas de caracteres, sem serviço externo). As entradas são
+separadas pela versão da base de conhecimento: qualquer alteração em
+médicos, exames ou dados da clínica descarta o cache.
+
+O cache é compartilhado entre pacientes, então só guarda respostas
+impessoais: perguntas em que o paciente se identifica ("me chamo...") e
+respostas que citam o nome dele nunca entram.
+"""
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from clinica.knowledge_base import KB_CACHE_TIMEOUT, get_knowledge_base_version
+
+from ..utils import metrics
+from ..utils.command_parser import normalize_text
+
+DEFAULT_FAQ_CACHE_SETTINGS = {
+    'ENABLED': True,
+    'SIMILARIDADE_MINIMA': 0.85,
+    'MAX_ENTRADAS': 500,
+    'MAX_CARACTERES_PERGUNTA': 300,
+    'SINCRONIZAR_SEGUNDOS': 30,
+}
+
+SHARED_CACHE_KEY = 'chatbot:faq_cache:{version}'
+
+NGRAM_SIZE = 3
+
+# Paciente se identificando na pergunta (texto normalizado): a resposta
+# tende a ser pessoal
+SELF_IDENTIFICATION_PATTERN = re.compile(r"\b(?:meu nome|me chamo|aqui e o|aqui e a|sou o|sou a)\b")
+
+_local_lock = threading.Lock()
+_local_index = None
+
+
+def get_faq_cache_setting(name: str):
+    """Lê uma configuração do cache de respostas (settings.CHATBOT_FAQ_CACHE)"""
+    return getattr(settings, 'CHATBOT_FAQ_CACHE', {}).get(name, DEFAULT_FAQ_CACHE_SETTINGS[name])
+
+
+def normalize_question(text: str) -> str:
+    """
+    Normaliza a pergunta para uso como chave: minúsculas, sem acentos,
+    pontuação e espaços extras
+
+    Args:
+        text: Pergunta como o paciente escreveu
+
+    Returns:
+        Pergunta normalizada
+    """
+    return ' '.join(re.sub(r"[^\w\s]", ' ', normalize_text(text)).split())
+
+
+def is_personal_question(normalized: str) -> bool:
+    """Pergunta (normalizada) em que o paciente se identifica"""
+    return bool(SELF_IDENTIFICATION_PATTERN.search(normalized))
+
+
+def mentions_name(text: str, nomes: Iterable[str]) -> bool:
+    """
+    O texto cita alguma palavra (3+ letras) dos nomes informados
+
+    Args:
+        text: Resposta a conferir
+        nomes: Nomes completos (ex: Paciente.nome_completo)
+    """
+    palavras = {word for nome in nomes for word in normalize_question(nome or '').split() if len(word) >= 3}
+    return bool(palavras & set(normalize_question(text).split()))
+
+
+def ngram_vector(text: str) -> Dict[str, float]:
+    """N-gramas de caracteres da pergunta normalizada, com norma 1"""
+    counts = Counter()
+    for word in text.split():
+        padded = f" {word} "
+        for i in range(max(1, len(padded) - NGRAM_SIZE + 1)):
+            counts[padded[i:i + NGRAM_SIZE]] += 1
+
+    norm = math.sqrt(sum(value * value for value in counts.values())) or 1.0
+    return {gram: value / norm for gram, value in counts.items()}
+
+
+def _significant_words(text: str) -> List[str]:
+    """Palavras que mudam o sentido da pergunta (longas ou com números)"""
+    return [word for word in text.split() if len(word) >= 4 or any(char.isdigit() for char in word)]
+
+
+def same_subject(question: str, candidate: str) -> bool:
+    """
+    Confere palavra a palavra se duas perguntas parecidas tratam do mesmo
+    assunto: cada palavra significativa de uma precisa de uma palavra quase
+    igual na outra (tolera erros de digitação, mas não troca de médico,
+    exame ou data)
+    """
+    for origem, destino in ((question, candidate), (candidate, question)):
+        palavras_destino = destino.split()
+        for word in _significant_words(origem):
+            if any(char.isdigit() for char in word):
+                if word not in palavras_destino:
+                    return False
+            elif not any(SequenceMatcher(None, word, other).ratio() >= 0.8 for other in palavras_destino):
+                return False
+    return True
+
+
+class _FAQIndex:
+    """Índice local (do processo) das perguntas de uma versão da base"""
+
+    def __init__(self, version: int, entries: List[Tuple[str, str]]):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.answers: Dict[str, str] = {}
+        self.vectors: Dict[str, Dict[str, float]] = {}
+        self.postings: Dict[str, set] = defaultdict(set)
+        for question, answer in entries:
+            self.add(question, answer)
+
+    def add(self, question: str, answer: str):
+        if question in self.answers:
+            self.answers[question] = answer
+            return
+        vector = ngram_vector(question)
+        self.answers[question] = answer
+        self.vectors[question] = vector
+        for gram in vector:
+            # Cópia em vez de alteração: leituras concorrentes não travam
+            self.postings[gram] = self.postings[gram] | {question}
+
+    def most_similar(self, question: str) -> Tuple[Optional[str], float]:
+        """Pergunta indexada mais parecida (similaridade de cosseno) e o score"""
+        vector = ngram_vector(question)
+        scores = defaultdict(float)
+        for gram, weight in vector.items():
+            for candidate in self.postings.get(gram, ()):
+                scores[candidate] += weight * self.vectors[candidate][gram]
+
+        if not scores:
+            return None, 0.0
+        candidate = max(scores, key=scores.get)
+        return candidate, scores[candidate]
+
+
+class FAQResponseCache:
+    """
+    Cache de respostas de perguntas sem contexto
+
+    - Acerto exato: pergunta normalizada idêntica;
+    - Acerto por similaridade: cosseno dos n-gramas acima de
+      SIMILARIDADE_MINIMA e mesmas palavras significativas.
+
+    As entradas ficam no cache do Django (compartilhadas entre processos) e
+    em um índice local, ressincronizado a cada SINCRONIZAR_SEGUNDOS.
+    """
+
+    @property
+    def enabled(self) -> bool:
+        return bool(get_faq_cache_setting('ENABLED'))
+
+    def lookup(self, question: str) -> Optional[str]:
+        """
+        Busca a resposta de uma pergunta igual ou parecida
+
+        Args:
+            question: Pergunta do paciente
+
+        Returns:
+            Resposta guardada ou None
+        """
+        if not self.enabled:
+            return None
+
+        normalized = normalize_question(question)
+        if (not normalized or len(normalized) > get_faq_cache_setting('MAX_CARACTERES_PERGUNTA')
+                or is_personal_question(normalized)):
+            return None
+
+        index = self._get_index()
+        answer = index.answers.get(normalized)
+        if answer is not None:
+            metrics.increment('faq_cache.hits')
+            metrics.increment('faq_cache.hits_exatos')
+            return answer
+
+        candidate, score = index.most_similar(normalized)
+        if candidate and score >= get_faq_cache_setting('SIMILARIDADE_MINIMA') and same_subject(normalized, candidate):
+            metrics.increment('faq_cache.hits')
+            metrics.increment('faq_cache.hits_similares')
+            return index.answers[candidate]
+
+        metrics.increment('faq_cache.misses')
+        return None
+
+    def store(self, question: str, answer: str, nomes_paciente: Iterable[str] = ()):
+        """
+        Guarda a resposta da IA para a pergunta (na versão atual da base)
+
+        Args:
+            question: Pergunta do paciente
+            answer: Resposta da IA
+            nomes_paciente: Nomes do paciente que perguntou; respostas que
+                citam algum deles não são compartilhadas
+        """
+        if not self.enabled or not answer:
+            return
+
+        normalized = normalize_question(question)
+        if (not normalized or len(normalized) > get_faq_cache_setting('MAX_CARACTERES_PERGUNTA')
+                or is_personal_question(normalized) or mentions_name(answer, nomes_paciente)):
+            return
+
+        index = self._get_index()
+        with _local_lock:
+            index.add(normalized, answer)
+
+        # Leitura-modificação-escrita sem lock: uma entrada perdida numa
+        # corrida é só uma falta de cache a mais
+        key = SHARED_CACHE_KEY.format(version=index.version)
+        entries = [entry for entry in cache.get(key, []) if entry[0] != normalized]
+        entries.append((normalized, answer))
+        cache.set(key, entries[-get_faq_cache_setting('MAX_ENTRADAS'):], KB_CACHE_TIMEOUT)
+
+    def _get_index(self) -> _FAQIndex:
+        """Índice local da versão atual, recarregado do cache compartilhado periodicamente"""
+        global _local_index
+
+        version = get_knowledge_base_version()
+        index = _local_index
+        if (index is not None and index.version == version
+                and time.monotonic() - index.loaded_at < get_faq_cache_setting('SINCRONIZAR_SEGUNDOS')):
+            return index
+
+        with _local_lock:
+            index = _local_index
+            if (index is None or index.version != version
+                    or time.monotonic() - index.loaded_at >= get_faq_cache_setting('SINCRONIZAR_SEGUNDOS')):
+                entries = cache.get(SHARED_CACHE_KEY.format(version=version), [])
+                index = _FAQIndex(version, entries)
+                _local_index = index
+
+        return index
+
+
+def get_faq_cache_stats() -> Dict:
+    """Taxa de acerto e tamanho do índice local do cache de respostas"""
+    index = _local_index
+    return {
+        'entradas': len(index.answers) if index else 0,
+        'hit_rate': round(metrics.hit_rate('faq_cache.hits', 'faq_cache.misses'), 4),
+    }
+
+
+metrics.register_gauge('faq_cache', get_faq_cache_stats)
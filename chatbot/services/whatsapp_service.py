@@ -1,42 +1,226 @@
 """
 Serviço responsável pela comunicação com WhatsApp Business API
 """
+import asyncio
 import json
 import os
-from typing import Optional
+import random
+import threading
+import time
+import weakref
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
 
+import httpx
 import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from ..utils import metrics
+
+DEFAULT_API_BASE_URL = "https://graph.facebook.com/v19.0"
+
+DEFAULT_HTTP_SETTINGS = {
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 10,
+    'MAX_TENTATIVAS': 3,
+    'BACKOFF_BASE_SEGUNDOS': 0.5,
+    'BACKOFF_MAX_SEGUNDOS': 8,
+    'POOL_MAXSIZE': 20,
+}
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+_session_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_adapter: Optional[HTTPAdapter] = None
+
+# Um httpx.AsyncClient por event loop (clientes assíncronos não podem ser
+# compartilhados entre loops)
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def get_http_setting(name: str):
+    """Lê uma configuração do cliente HTTP (settings.WHATSAPP_HTTP) com valor padrão"""
+    return getattr(settings, 'WHATSAPP_HTTP', {}).get(name, DEFAULT_HTTP_SETTINGS[name])
+
+
+def get_http_session() -> requests.Session:
+    """
+    Retorna a sessão HTTP compartilhada do processo
+
+    A sessão mantém um pool de conexões keep-alive, evitando um novo
+    handshake TCP+TLS com graph.facebook.com a cada mensagem.
+    """
+    global _session, _adapter
+
+    if _session is not None:
+        return _session
+
+    with _session_lock:
+        if _session is None:
+            pool_maxsize = get_http_setting('POOL_MAXSIZE')
+            # Retentativas são feitas manualmente em _post (com jitter e Retry-After)
+            _adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=0)
+
+            session = requests.Session()
+            session.mount('https://', _adapter)
+            session.mount('http://', _adapter)
+            _session = session
+
+    return _session
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Retorna o cliente HTTP assíncrono do event loop atual (pool keep-alive)
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+
+    if client is None or client.is_closed:
+        pool_maxsize = get_http_setting('POOL_MAXSIZE')
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(get_http_setting('READ_TIMEOUT'), connect=get_http_setting('CONNECT_TIMEOUT')),
+            limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+        )
+        _async_clients[loop] = client
+
+    return client
+
+
+def get_connection_stats() -> Dict:
+    """
+    Estatísticas de reaproveitamento de conexões do pool
+
+    Returns:
+        Dicionário com requisições feitas, conexões abertas e taxa de reuso
+    """
+    if _adapter is None:
+        return {'requests': 0, 'connections': 0, 'reuse_rate': 0.0}
+
+    pool_container = _adapter.poolmanager.pools
+    pools = [pool_container[key] for key in pool_container.keys()]
+    total_requests = sum(pool.num_requests for pool in pools)
+    total_connections = sum(pool.num_connections for pool in pools)
+    reuse_rate = 1 - (total_connections / total_requests) if total_requests else 0.0
+
+    return {
+        'requests': total_requests,
+        'connections': total_connections,
+        'reuse_rate': round(reuse_rate, 4),
+    }
+
+
+metrics.register_gauge('whatsapp_http_pool', get_connection_stats)
 
 
 class WhatsAppService:
     """Serviço para gerenciar comunicação com WhatsApp"""
-    
+
     def __init__(self):
         self.access_token = os.environ.get("WHATSAPP_ACCESS_TOKEN")
         self.bot_phone_number_id = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
-        
+
         if not self.access_token or not self.bot_phone_number_id:
             raise ValueError("Variáveis de ambiente do WhatsApp não configuradas")
-        
-        self.api_url = f"https://graph.facebook.com/v19.0/{self.bot_phone_number_id}/messages"
-    
+
+        # A URL base pode apontar para um servidor local (stub) em testes de carga
+        api_base_url = os.environ.get("WHATSAPP_API_BASE_URL", DEFAULT_API_BASE_URL).rstrip('/')
+        self.api_url = f"{api_base_url}/{self.bot_phone_number_id}/messages"
+
+        self.headers = {
+            "Authorization": f"Bearer {self.access_token}",
+            "Content-Type": "application/json",
+        }
+        self.session = get_http_session()
+
     def send_text_message(self, user_number: str, message_text: str) -> Optional[requests.Response]:
         """
         Envia uma mensagem de texto para um número do WhatsApp
-        
+
         Args:
             user_number: Número do usuário (formato: 5511999999999)
             message_text: Texto da mensagem
-            
+
         Returns:
             Response da API ou None em caso de erro
         """
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json",
-        }
-        
+        data = self._build_text_payload(user_number, message_text)
+
+        try:
+            print(f"Enviando para {user_number}: {message_text}")
+            response = self._post(data)
+            print(f"Status da Resposta da Meta: {response.status_code}")
+            return response
+
+        except Exception as e:
+            print(f"Erro ao enviar mensagem WhatsApp: {e}")
+            return None
+
+    async def send_text_message_async(self, user_number: str, message_text: str) -> Optional[httpx.Response]:
+        """
+        Versão assíncrona de send_text_message (httpx.AsyncClient)
+
+        Args:
+            user_number: Número do usuário (formato: 5511999999999)
+            message_text: Texto da mensagem
+
+        Returns:
+            Response da API ou None em caso de erro
+        """
+        data = self._build_text_payload(user_number, message_text)
+
+        try:
+            print(f"Enviando para {user_number}: {message_text}")
+            response = await self._post_async(data)
+            print(f"Status da Resposta da Meta: {response.status_code}")
+            return response
+
+        except Exception as e:
+            print(f"Erro ao enviar mensagem WhatsApp: {e}")
+            return None
+
+    def mark_as_read(self, message_id: str, typing: bool = True) -> Optional[requests.Response]:
+        """
+        Marca a mensagem recebida como lida e, opcionalmente, exibe o
+        indicador "digitando..." até a próxima resposta (ou por até 25s)
+
+        Args:
+            message_id: Id da mensagem na Meta (messages[].id)
+            typing: Exibe o indicador de digitação
+
+        Returns:
+            Response da API ou None em caso de erro
+        """
+        try:
+            return self._post(self._build_read_payload(message_id, typing))
+        except Exception as e:
+            print(f"Erro ao marcar mensagem {message_id} como lida: {e}")
+            return None
+
+    async def mark_as_read_async(self, message_id: str, typing: bool = True) -> Optional[httpx.Response]:
+        """Versão assíncrona de mark_as_read"""
+        try:
+            return await self._post_async(self._build_read_payload(message_id, typing))
+        except Exception as e:
+            print(f"Erro ao marcar mensagem {message_id} como lida: {e}")
+            return None
+
+    def _build_read_payload(self, message_id: str, typing: bool) -> Dict:
+        """Monta o payload de confirmação de leitura (com indicador de digitação)"""
         data = {
+            "messaging_product": "whatsapp",
+            "status": "read",
+            "message_id": message_id,
+        }
+        if typing:
+            data["typing_indicator"] = {"type": "text"}
+        return data
+
+    def _build_text_payload(self, user_number: str, message_text: str) -> Dict:
+        """Monta o payload de uma mensagem de texto"""
+        return {
             "messaging_product": "whatsapp",
             "to": user_number,
             "type": "text",
@@ -44,41 +228,19 @@ class WhatsAppService:
                 "body": message_text
             }
         }
-        
-        try:
-            print(f"Enviando para {user_number}: {message_text}")
-            response = requests.post(
-                self.api_url, 
-                headers=headers, 
-                data=json.dumps(data)
-            )
-            
-            print(f"Status da Resposta da Meta: {response.status_code}")
-            print(f"Corpo da Resposta da Meta: {response.json()}")
-            
-            return response
-            
-        except Exception as e:
-            print(f"Erro ao enviar mensagem WhatsApp: {e}")
-            return None
-    
+
     def send_template_message(self, user_number: str, template_name: str, language_code: str = "pt_BR") -> Optional[requests.Response]:
         """
         Envia uma mensagem de template do WhatsApp
-        
+
         Args:
             user_number: Número do usuário
             template_name: Nome do template aprovado
             language_code: Código do idioma (padrão: pt_BR)
-            
+
         Returns:
             Response da API ou None em caso de erro
         """
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json",
-        }
-        
         data = {
             "messaging_product": "whatsapp",
             "to": user_number,
@@ -90,15 +252,120 @@ class WhatsAppService:
                 }
             }
         }
-        
+
         try:
-            response = requests.post(
-                self.api_url, 
-                headers=headers, 
-                data=json.dumps(data)
-            )
-            return response
-            
+            return self._post(data)
+
         except Exception as e:
             print(f"Erro ao enviar template WhatsApp: {e}")
             return None
+
+    def _post(self, data: Dict) -> requests.Response:
+        """
+        Envia o payload para a API da Meta usando a sessão compartilhada
+
+        Faz novas tentativas limitadas, com backoff exponencial e jitter,
+        quando a Meta responde 429/5xx (respeitando Retry-After) ou quando
+        não foi possível conectar. Timeout de leitura não é repetido, pois a
+        mensagem pode ter sido entregue.
+
+        Raises:
+            requests.RequestException: Se todas as tentativas falharem
+        """
+        timeout = (get_http_setting('CONNECT_TIMEOUT'), get_http_setting('READ_TIMEOUT'))
+        max_tentativas = get_http_setting('MAX_TENTATIVAS')
+        body = json.dumps(data)
+
+        for tentativa in range(1, max_tentativas + 1):
+            started = time.monotonic()
+            try:
+                response = self.session.post(
+                    self.api_url,
+                    headers=self.headers,
+                    data=body,
+                    timeout=timeout,
+                )
+            except requests.ConnectionError:
+                metrics.increment('whatsapp.erros_conexao')
+                if tentativa == max_tentativas:
+                    raise
+                metrics.increment('whatsapp.retentativas')
+                time.sleep(self._backoff(tentativa))
+                continue
+            finally:
+                metrics.observe('whatsapp.latencia', time.monotonic() - started)
+
+            metrics.increment('whatsapp.requisicoes')
+            metrics.increment(f'whatsapp.status_{response.status_code}')
+
+            if response.status_code not in RETRYABLE_STATUS or tentativa == max_tentativas:
+                if response.status_code >= 400:
+                    print(f"Erro da Meta ({response.status_code}): {response.text[:500]}")
+                return response
+
+            metrics.increment('whatsapp.retentativas')
+            retry_after = self._retry_after(response)
+            time.sleep(retry_after if retry_after is not None else self._backoff(tentativa))
+
+        return response
+
+    async def _post_async(self, data: Dict) -> httpx.Response:
+        """
+        Versão assíncrona de _post, com a mesma política de retentativas
+
+        Raises:
+            httpx.HTTPError: Se todas as tentativas falharem
+        """
+        client = get_async_http_client()
+        max_tentativas = get_http_setting('MAX_TENTATIVAS')
+        body = json.dumps(data)
+
+        for tentativa in range(1, max_tentativas + 1):
+            started = time.monotonic()
+            try:
+                response = await client.post(self.api_url, headers=self.headers, content=body)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                metrics.increment('whatsapp.erros_conexao')
+                if tentativa == max_tentativas:
+                    raise
+                metrics.increment('whatsapp.retentativas')
+                await asyncio.sleep(self._backoff(tentativa))
+                continue
+            finally:
+                metrics.observe('whatsapp.latencia', time.monotonic() - started)
+
+            metrics.increment('whatsapp.requisicoes')
+            metrics.increment(f'whatsapp.status_{response.status_code}')
+
+            if response.status_code not in RETRYABLE_STATUS or tentativa == max_tentativas:
+                if response.status_code >= 400:
+                    print(f"Erro da Meta ({response.status_code}): {response.text[:500]}")
+                return response
+
+            metrics.increment('whatsapp.retentativas')
+            retry_after = self._retry_after(response)
+            await asyncio.sleep(retry_after if retry_after is not None else self._backoff(tentativa))
+
+        return response
+
+    def _backoff(self, tentativa: int) -> float:
+        """Backoff exponencial com jitter completo"""
+        base = get_http_setting('BACKOFF_BASE_SEGUNDOS')
+        maximo = get_http_setting('BACKOFF_MAX_SEGUNDOS')
+        return random.uniform(0, min(maximo, base * (2 ** (tentativa - 1))))
+
+    def _retry_after(self, response) -> Optional[float]:
+        """Lê o cabeçalho Retry-After (segundos ou data HTTP), limitado ao backoff máximo"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+
+        return max(0.0, min(seconds, get_http_setting('BACKOFF_MAX_SEGUNDOS')))
@@ -1,3 +1,1127 @@
-from django.test import TestCase
+import asyncio
+import threading
+from datetime import date, time, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.checks import run_checks
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from google.genai import errors as genai_errors
+from google.genai import types as genai_types
+
+from clinica import knowledge_base
+from clinica.models import ClinicaInfo, Medico
+from usuarios.models import Paciente
+
+from .models import Conversa, Direcionamento, MensagemConversa, MensagemEntrada
+from .services.ai_service import AI_ERROR_MESSAGE, TOOL_LIMIT_MESSAGE, AIService
+from .services.command_service import CommandService
+from .services.context_cache import GeminiContextCache, is_context_cache_error
+from .services.conversation_service import (PENDING_DIRECIONAMENTO_MESSAGE,
+                                            ConversationService)
+from .services.inbound_queue_service import ClaimLost, InboundQueueService
+from .services import model_router as model_router_module
+from .services.model_router import ModelRouter
+from .services import command_service, response_cache
+from .services.patient_lock import PatientLock, PatientLockTimeout
+from .services.registry import override_service
+from .views import _background_tasks
+from .services.patient_state import load_patient_state
+from .utils.command_parser import parse_command, resolve_date, resolve_time
+from .utils.stream_chunker import StreamChunker, StreamRelay
+
+TELEFONE = '5511999999999'
+
+
+class FakeModels:
+    """Substitui client.models do Gemini: responde sempre o mesmo texto"""
+
+    def __init__(self, text="Posso ajudar em algo mais?"):
+        self.text = text
+        self.calls = 0
+
+    def generate_content(self, model, contents, config):
+        self.calls += 1
+        return SimpleNamespace(text=self.text, function_calls=None)
+
+
+class FakeAsyncModels(FakeModels):
+    """Substitui client.aio.models do Gemini"""
+
+    async def generate_content(self, model, contents, config):
+        return super().generate_content(model, contents, config)
+
+
+class ScriptedModels:
+    """
+    Substitui client.models do Gemini com respostas roteirizadas, em ordem
+
+    Cada item do roteiro é um texto, uma lista de chamadas de ferramenta
+    [(nome, argumentos), ...] ou uma exceção a levantar. As requisições
+    recebidas ficam em `requests`.
+    """
+
+    def __init__(self, script, requests):
+        self.script = script
+        self.requests = requests
+
+    def generate_content(self, model, contents, config):
+        self.requests.append(SimpleNamespace(model=model, contents=list(contents), config=config))
+        item = self.script.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        if isinstance(item, str):
+            parts = [genai_types.Part.from_text(text=item)]
+        else:
+            parts = [genai_types.Part(function_call=genai_types.FunctionCall(name=nome, args=args)) for nome, args in item]
+        return genai_types.GenerateContentResponse(
+            candidates=[genai_types.Candidate(content=genai_types.Content(role='model', parts=parts))]
+        )
+
+
+class ScriptedAsyncModels(ScriptedModels):
+    """Substitui client.aio.models, com o mesmo roteiro"""
+
+    async def generate_content(self, model, contents, config):
+        return super().generate_content(model, contents, config)
+
+
+class FakeCaches:
+    """Substitui client.caches: registra criações e renovações, que podem falhar"""
+
+    def __init__(self):
+        self.created = []
+        self.updated = []
+        self.falhar_criacao = False
+        self.falhar_renovacao = False
+
+    def create(self, model, config):
+        if self.falhar_criacao:
+            raise genai_errors.ServerError(503, {'error': {'code': 503, 'message': 'Unavailable', 'status': 'UNAVAILABLE'}})
+        self.created.append(config)
+        return SimpleNamespace(name=f"cachedContents/{len(self.created)}")
+
+    def update(self, name, config):
+        if self.falhar_renovacao:
+            raise genai_errors.ClientError(404, {'error': {'code': 404, 'message': 'Cached content not found', 'status': 'NOT_FOUND'}})
+        self.updated.append(name)
+        return SimpleNamespace(name=name)
+
+
+class ScriptedClient:
+    """Cliente genai falso: client.models, client.aio.models e client.caches"""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.requests = []
+        self.models = ScriptedModels(self.script, self.requests)
+        self.aio = SimpleNamespace(models=ScriptedAsyncModels(self.script, self.requests))
+        self.caches = FakeCaches()
+
+
+def cache_not_found():
+    return genai_errors.ClientError(404, {'error': {'code': 404, 'message': 'Cached content not found', 'status': 'NOT_FOUND'}})
+
+
+class FakeWhatsApp:
+    """Substitui o WhatsAppService: registra os envios, que podem falhar"""
+
+    def __init__(self):
+        self.enviadas = []
+        self.falhar = False
+
+    def send_text_message(self, user_number, message_text):
+        if self.falhar:
+            return None
+        self.enviadas.append(message_text)
+        return SimpleNamespace(status_code=200)
+
+    def mark_as_read(self, message_id, typing=True):
+        return None
+
+    async def send_text_message_async(self, user_number, message_text):
+        return self.send_text_message(user_number, message_text)
+
+    async def mark_as_read_async(self, message_id, typing=True):
+        return None
+
+
+@override_settings(
+    GEMINI_CONTEXT_CACHE={'ENABLED': False},
+    CHATBOT_INTENT_ROUTER={'ENABLED': False},
+    CHATBOT_FAQ_CACHE={'ENABLED': False},
+)
+class PatientStateQueryTests(TestCase):
+    """Regressão do número de consultas ao banco por mensagem recebida"""
+
+    def setUp(self):
+        ClinicaInfo.objects.create(
+            objetivo_geral='Atendimento', telefone_contato='(71) 3333-3333', endereco='Rua X, 10',
+            referencia_localizacao='Centro', politica_agendamento='Agendamento pelo WhatsApp'
+        )
+        with mock.patch.dict('os.environ', {'WHATSAPP_ACCESS_TOKEN': 'x', 'WHATSAPP_PHONE_NUMBER_ID': '1'}):
+            self.service = ConversationService(
+                ai_service=AIService(client=SimpleNamespace(models=FakeModels()))
+            )
+        self.paciente = Paciente.objects.create(telefone_whatsapp=TELEFONE)
+        self.conversa = Conversa.objects.create(paciente=self.paciente, status='ativa')
+
+    def test_load_patient_state_single_query(self):
+        with self.assertNumQueries(1):
+            state = load_patient_state(TELEFONE)
+            self.assertEqual(state.conversa.pk, self.conversa.pk)
+            self.assertEqual(state.conversa.paciente, self.paciente)
+            self.assertFalse(state.direcionamento_pendente)
+            self.assertFalse(state.mensagens_pendentes)
+
+    def test_load_patient_state_pending_messages_of_active_conversation(self):
+        antiga = Conversa.objects.create(paciente=self.paciente, status='finalizada')
+        MensagemConversa.objects.create(conversa=antiga, remetente='user', conteudo='Oi')
+        self.assertFalse(load_patient_state(TELEFONE).mensagens_pendentes)
+
+        MensagemConversa.objects.create(conversa=self.conversa, remetente='user', conteudo='Oi')
+        with self.assertNumQueries(1):
+            state = load_patient_state(TELEFONE)
+        self.assertTrue(state.mensagens_pendentes)
+        self.assertEqual(state.conversa.pk, self.conversa.pk)
+        self.assertEqual(state.conversa.status, 'ativa')
+
+    def test_load_patient_state_unknown_patient(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(load_patient_state('5511000000000'))
+
+    def test_begin_turn_queries(self):
+        # SAVEPOINT + estado do paciente + INSERT das mensagens + RELEASE
+        with self.assertNumQueries(4):
+            conversa, early_response = self.service._begin_turn(TELEFONE, ['Oi', 'Tudo bem?'])
+        self.assertIsNone(early_response)
+        self.assertEqual(conversa.pk, self.conversa.pk)
+        self.assertEqual(conversa.mensagens.filter(remetente='user', processada=False).count(), 2)
+
+    def test_begin_turn_keeps_repeated_text(self):
+        # "ok" enviado duas vezes são duas mensagens
+        self.service._begin_turn(TELEFONE, ['ok'], ['wamid.1'])
+        self.service._begin_turn(TELEFONE, ['ok'], ['wamid.2'])
+        self.service._begin_turn(TELEFONE, ['ok'])
+        self.assertEqual(MensagemConversa.objects.filter(conversa=self.conversa).count(), 3)
+
+    def test_begin_turn_ignores_retried_message_id(self):
+        # Nova tentativa da fila com a mesma mensagem do WhatsApp
+        self.service._begin_turn(TELEFONE, ['ok'], ['wamid.1'])
+        self.service._begin_turn(TELEFONE, ['ok', 'sim'], ['wamid.1', 'wamid.2'])
+        self.assertEqual(
+            list(MensagemConversa.objects.filter(conversa=self.conversa).values_list('whatsapp_message_id', flat=True)),
+            ['wamid.1', 'wamid.2']
+        )
+
+    def test_begin_turn_pending_direcionamento(self):
+        Direcionamento.objects.create(
+            paciente=self.paciente, conversa=self.conversa, tipo_solicitacao='solicitacao_humana',
+            resumo_conversa='-', status='pendente'
+        )
+        with self.assertNumQueries(3):
+            conversa, early_response = self.service._begin_turn(TELEFONE, ['Oi'])
+        self.assertIsNone(conversa)
+        self.assertEqual(early_response, PENDING_DIRECIONAMENTO_MESSAGE)
+
+    def test_process_user_message_queries(self):
+        self.service.process_user_message(TELEFONE, 'Olá')
+        # 10 do turno + obter e liberar o lock do paciente (TravaPaciente)
+        with self.assertNumQueries(12):
+            response = self.service.process_user_message(TELEFONE, 'Qual o preparo do exame?')
+        self.assertEqual(response, "Posso ajudar em algo mais?")
+
+    def test_message_saved_during_ai_call_stays_pending(self):
+        # Mensagem gravada depois do histórico não foi vista pela IA: não pode
+        # ser marcada como processada junto com o turno atual
+        build_turn_history = self.service._build_turn_history
+
+        def build_then_receive(conversa):
+            result = build_turn_history(conversa)
+            MensagemConversa.objects.create(conversa=self.conversa, remetente='user', conteudo='E o horário?')
+            return result
+
+        with mock.patch.object(self.service, '_build_turn_history', build_then_receive):
+            self.service.process_user_message(TELEFONE, 'Qual o preparo do exame?')
+        self.assertEqual(
+            list(self.conversa.mensagens.filter(remetente='user', processada=False).values_list('conteudo', flat=True)),
+            ['E o horário?']
+        )
+
+
+@override_settings(
+    GEMINI_CONTEXT_CACHE={'ENABLED': False},
+    CHATBOT_INTENT_ROUTER={'ENABLED': False},
+    CHATBOT_FAQ_CACHE={'ENABLED': False},
+    CHATBOT_STREAMING={'ENABLED': False},
+    CHATBOT_QUEUE={'BACKOFF_BASE_SEGUNDOS': 0, 'BACKOFF_MAX_SEGUNDOS': 0},
+)
+class InboundQueueRetryTests(TestCase):
+    """Novas tentativas da fila não repetem o turno da conversa"""
+
+    def setUp(self):
+        # Ids de mensagens registrados pela deduplicação em outros testes
+        cache.clear()
+        ClinicaInfo.objects.create(
+            objetivo_geral='Atendimento', telefone_contato='(71) 3333-3333', endereco='Rua X, 10',
+            referencia_localizacao='Centro', politica_agendamento='Agendamento pelo WhatsApp'
+        )
+        self.models = FakeModels()
+        self.whatsapp = FakeWhatsApp()
+        conversation_service = ConversationService(
+            ai_service=AIService(client=SimpleNamespace(models=self.models)),
+            whatsapp_service=self.whatsapp,
+            command_service=mock.Mock(),
+        )
+        self.queue = InboundQueueService(conversation_service, self.whatsapp)
+
+    def enqueue(self, message_id, texto):
+        return self.queue.enqueue_webhook_payload({
+            'object': 'whatsapp_business_account',
+            'entry': [{'changes': [{'value': {'messages': [{
+                'from': TELEFONE, 'id': message_id, 'type': 'text', 'text': {'body': texto},
+            }]}}]}],
+        })
+
+    def test_send_failure_only_resends_reply(self):
+        self.enqueue('wamid.1', 'Olá')
+
+        self.whatsapp.falhar = True
+        self.assertTrue(self.queue.run_once('worker'))
+        item = MensagemEntrada.objects.get()
+        self.assertEqual(item.status, 'pendente')
+        self.assertIsNotNone(item.respondida_em)
+        self.assertEqual(item.resposta, "Posso ajudar em algo mais?")
+
+        self.whatsapp.falhar = False
+        self.assertTrue(self.queue.run_once('worker'))
+        self.assertEqual(MensagemEntrada.objects.get().status, 'concluida')
+        self.assertEqual(self.whatsapp.enviadas, ["Posso ajudar em algo mais?"])
+        # Uma chamada à IA e as mensagens do turno gravadas uma única vez
+        self.assertEqual(self.models.calls, 1)
+        self.assertEqual(list(MensagemConversa.objects.values_list('remetente', flat=True)), ['user', 'bot'])
+
+    def test_retry_with_new_message_keeps_answered_reply(self):
+        self.enqueue('wamid.1', 'Olá')
+        self.whatsapp.falhar = True
+        self.queue.run_once('worker')
+
+        # A nova mensagem entra no mesmo lote da nova tentativa
+        self.enqueue('wamid.2', 'Qual o endereço?')
+        self.whatsapp.falhar = False
+        self.queue.run_once('worker')
+
+        self.assertEqual(self.whatsapp.enviadas, ["Posso ajudar em algo mais?"] * 2)
+        self.assertEqual(self.models.calls, 2)
+        self.assertFalse(MensagemEntrada.objects.exclude(status='concluida').exists())
+
+    def test_retry_before_saving_keeps_single_user_message(self):
+        self.enqueue('wamid.1', 'ok')
+        with mock.patch.object(ConversationService, '_finish_turn', side_effect=RuntimeError('falha')):
+            self.queue.run_once('worker')
+
+        self.queue.run_once('worker')
+        self.assertEqual(list(MensagemConversa.objects.values_list('remetente', flat=True)), ['user', 'bot'])
+        self.assertEqual(self.whatsapp.enviadas, ["Posso ajudar em algo mais?"])
+
+    def test_requeued_claim_cannot_send_or_finish(self):
+        self.enqueue('wamid.1', 'Olá')
+        antigos = self.queue.claim_next('worker-a')
+        MensagemEntrada.objects.update(bloqueada_em=timezone.now() - timedelta(hours=1))
+        self.assertEqual(self.queue.requeue_stale(), 1)
+        MensagemEntrada.objects.update(disponivel_em=timezone.now())
+        novos = self.queue.claim_next('worker-b')
+
+        # A execução antiga termina a IA depois: o turno é desfeito e nada é enviado
+        with self.assertRaises(ClaimLost):
+            self.queue.process_items(antigos)
+        self.queue.mark_done(antigos[0])
+        self.assertEqual(self.whatsapp.enviadas, [])
+        self.assertFalse(MensagemConversa.objects.filter(remetente='bot').exists())
+        self.assertEqual(MensagemEntrada.objects.get().status, 'processando')
+
+        self.queue.process_items(novos)
+        self.queue.mark_done(novos[0])
+        self.assertEqual(self.whatsapp.enviadas, ["Posso ajudar em algo mais?"])
+        self.assertEqual(MensagemEntrada.objects.get().status, 'concluida')
+
+    @override_settings(CHATBOT_QUEUE={'TIMEOUT_PROCESSAMENTO_SEGUNDOS': 0}, CHATBOT_PATIENT_LOCK={'TTL_SEGUNDOS': 600})
+    def test_stale_timeout_never_below_lock_ttl(self):
+        self.enqueue('wamid.1', 'Olá')
+        self.queue.claim_next('worker')
+        MensagemEntrada.objects.update(bloqueada_em=timezone.now() - timedelta(seconds=300))
+        self.assertEqual(self.queue.requeue_stale(), 0)
+
+    def test_webhook_returns_500_when_enqueue_fails(self):
+        payload = {
+            'object': 'whatsapp_business_account',
+            'entry': [{'changes': [{'value': {'messages': [{
+                'from': TELEFONE, 'id': 'wamid.1', 'type': 'text', 'text': {'body': 'Olá'},
+            }]}}]}],
+        }
+        with mock.patch.object(MensagemEntrada.objects, 'bulk_create', side_effect=Exception('disco cheio')):
+            response = self.client.post('/chatbot/webhook/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, 500)
+
+        # A reentrega da Meta é aceita
+        response = self.client.post('/chatbot/webhook/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(MensagemEntrada.objects.count(), 1)
+
+    def test_webhook_ignores_invalid_payload(self):
+        response = self.client.post('/chatbot/webhook/', 'não é json', content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+
+class MetricsViewTests(TestCase):
+    """Métricas só para staff ou com o token interno"""
+
+    def test_anonymous_forbidden(self):
+        self.assertEqual(self.client.get('/chatbot/metrics/').status_code, 403)
+
+    @override_settings(CHATBOT_METRICS_TOKEN='segredo')
+    def test_internal_token(self):
+        self.assertEqual(self.client.get('/chatbot/metrics/', HTTP_X_METRICS_TOKEN='errado').status_code, 403)
+        self.assertEqual(self.client.get('/chatbot/metrics/', HTTP_X_METRICS_TOKEN='segredo').status_code, 200)
+
+    def test_staff_user(self):
+        self.client.force_login(User.objects.create_user('secretaria', is_staff=True))
+        self.assertEqual(self.client.get('/chatbot/metrics/').status_code, 200)
+
+
+@override_settings(
+    GEMINI_CONTEXT_CACHE={'ENABLED': False},
+    CHATBOT_INTENT_ROUTER={'ENABLED': False},
+    CHATBOT_FAQ_CACHE={'ENABLED': False},
+    CHATBOT_STREAMING={'ENABLED': False},
+)
+class AsyncWebhookTests(TransactionTestCase):
+    """O webhook assíncrono grava na fila antes de processar"""
+
+    def setUp(self):
+        cache.clear()
+        ClinicaInfo.objects.create(
+            objetivo_geral='Atendimento', telefone_contato='(71) 3333-3333', endereco='Rua X, 10',
+            referencia_localizacao='Centro', politica_agendamento='Agendamento pelo WhatsApp'
+        )
+        self.whatsapp = FakeWhatsApp()
+        ai_service = AIService(client=SimpleNamespace(models=FakeModels(), aio=SimpleNamespace(models=FakeAsyncModels())))
+        # Prompt preparado fora do event loop (evita disputa pelo banco em memória)
+        ai_service._prepare_prompt()
+        self.queue = InboundQueueService(
+            ConversationService(ai_service=ai_service, whatsapp_service=self.whatsapp, command_service=mock.Mock()),
+            self.whatsapp,
+        )
+        self.payload = {
+            'object': 'whatsapp_business_account',
+            'entry': [{'changes': [{'value': {'messages': [{
+                'from': TELEFONE, 'id': 'wamid.1', 'type': 'text', 'text': {'body': 'Olá'},
+            }]}}]}],
+        }
+
+    def test_requires_asgi(self):
+        response = self.client.post('/chatbot/webhook/async/', self.payload, content_type='application/json')
+        self.assertEqual(response.status_code, 501)
+        self.assertFalse(MensagemEntrada.objects.exists())
+
+    def test_enqueues_then_processes(self):
+        async def post():
+            response = await self.async_client.post('/chatbot/webhook/async/', self.payload, content_type='application/json')
+            await asyncio.gather(*_background_tasks)
+            return response
+
+        with override_service('inbound_queue', self.queue):
+            response = asyncio.run(post())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(MensagemEntrada.objects.get().status, 'concluida')
+        self.assertEqual(self.whatsapp.enviadas, ["Posso ajudar em algo mais?"])
+
+
+@override_settings(CHATBOT_PATIENT_LOCK={'ESPERA_MAXIMA_SEGUNDOS': 0})
+class PatientLockTests(TestCase):
+    """Lock por paciente no banco (backend padrão fora do Postgres)"""
+
+    def test_second_holder_waits_until_release(self):
+        primeiro = PatientLock(TELEFONE)
+        self.assertEqual(primeiro.backend, 'banco')
+        self.assertTrue(primeiro.try_acquire())
+        self.assertFalse(PatientLock(TELEFONE).try_acquire())
+        self.assertTrue(PatientLock('5511000000000').try_acquire())
+
+        primeiro.release()
+        self.assertTrue(PatientLock(TELEFONE).try_acquire())
+
+    def test_expired_lock_can_be_taken(self):
+        with override_settings(CHATBOT_PATIENT_LOCK={'TTL_SEGUNDOS': 0}):
+            antigo = PatientLock(TELEFONE)
+            self.assertTrue(antigo.try_acquire())
+        novo = PatientLock(TELEFONE)
+        self.assertTrue(novo.try_acquire())
+
+        # O dono antigo não libera a trava do novo
+        antigo.release()
+        self.assertFalse(PatientLock(TELEFONE).try_acquire())
+
+    def test_async_path_uses_same_backend(self):
+        async def hold():
+            async with PatientLock(TELEFONE):
+                pass
+
+        with PatientLock(TELEFONE):
+            with self.assertRaises(PatientLockTimeout):
+                async_to_sync(hold)()
+        async_to_sync(hold)()
+        self.assertTrue(PatientLock(TELEFONE).try_acquire())
+
+    def test_cache_backend_requires_shared_cache(self):
+        with override_settings(CHATBOT_PATIENT_LOCK={'BACKEND': 'cache'}):
+            ids = [message.id for message in run_checks()]
+        self.assertIn('chatbot.E002', ids)
+        self.assertNotIn('chatbot.E002', [message.id for message in run_checks()])
+
+    def test_ttl_shorter_than_worst_turn_warns(self):
+        with override_settings(CHATBOT_PATIENT_LOCK={'TTL_SEGUNDOS': 30}):
+            self.assertIn('chatbot.W001', [message.id for message in run_checks()])
+
+
+@override_settings(
+    GEMINI_CONTEXT_CACHE={'ENABLED': False},
+    CHATBOT_INTENT_ROUTER={'ENABLED': False},
+    CHATBOT_FAQ_CACHE={'ENABLED': True},
+)
+class FAQResponseCacheTests(TestCase):
+    """Cache de respostas compartilhado entre pacientes só com respostas impessoais"""
+
+    def setUp(self):
+        cache.clear()
+        response_cache._local_index = None
+        ClinicaInfo.objects.create(
+            objetivo_geral='Atendimento', telefone_contato='(71) 3333-3333', endereco='Rua X, 10',
+            referencia_localizacao='Centro', politica_agendamento='Agendamento pelo WhatsApp'
+        )
+        self.models = FakeModels("Ficamos na Rua X, 10, no Centro.")
+        self.service = ConversationService(
+            ai_service=AIService(client=SimpleNamespace(models=self.models)),
+            whatsapp_service=FakeWhatsApp(),
+            command_service=mock.Mock(),
+        )
+        Paciente.objects.create(telefone_whatsapp='5511000000001', nome_completo='Maria Souza')
+        Paciente.objects.create(telefone_whatsapp='5511000000002', nome_completo='João Lima')
+
+    def test_impersonal_answer_is_shared(self):
+        self.service.process_user_message('5511000000001', 'Qual o endereço da clínica?')
+        response = self.service.process_user_message('5511000000002', 'qual o endereco da clinica')
+        self.assertEqual(response, "Ficamos na Rua X, 10, no Centro.")
+        self.assertEqual(self.models.calls, 1)
+
+    def test_answer_naming_the_patient_is_not_stored(self):
+        self.models.text = "Olá, Maria! Ficamos na Rua X, 10."
+        self.service.process_user_message('5511000000001', 'Qual o endereço da clínica?')
+        self.service.process_user_message('5511000000002', 'Qual o endereço da clínica?')
+        self.assertEqual(self.models.calls, 2)
+
+    def test_self_identification_is_not_cached(self):
+        self.service.process_user_message('5511000000001', 'Oi, me chamo Ana, qual o endereço?')
+        self.service.process_user_message('5511000000002', 'Oi, me chamo Ana, qual o endereço?')
+        self.assertEqual(self.models.calls, 2)
+
+
+class CommandParserTests(SimpleTestCase):
+    """Interpretação dos comandos da IA e das datas/horários em português"""
+
+    SEXTA = date(2026, 10, 16)
+
+    def test_parse_command(self):
+        casos = [
+            ("Vou verificar. [CONSULTAR_AGENDA: medico='Dr. Gleiton', dia='amanhã']",
+             ('CONSULTAR_AGENDA', {'medico': 'Dr. Gleiton', 'dia': 'amanhã'})),
+            ('[CRIAR_AGENDAMENTO: medico=Dr. Gleiton, dia=25/08, horario=10:00]',
+             ('CRIAR_AGENDAMENTO', {'medico': 'Dr. Gleiton', 'dia': '25/08', 'horario': '10:00'})),
+            ('[CRIAR_AGENDAMENTO: nome_paciente="Maria, da Silva"]',
+             ('CRIAR_AGENDAMENTO', {'nome_paciente': 'Maria, da Silva'})),
+            ("[CONSULTAR_AGENDA: medico='Dr. Gleiton', dia=]", ('CONSULTAR_AGENDA', {'medico': 'Dr. Gleiton'})),
+            ('Texto [DIRECIONAR_SECRETARIA] fim', ('DIRECIONAR_SECRETARIA', {})),
+            ('Sem comando [OUTRO: x=1]', None),
+        ]
+        for texto, esperado in casos:
+            with self.subTest(texto=texto):
+                self.assertEqual(parse_command(texto), esperado)
+
+    def test_resolve_date(self):
+        casos = [
+            ('amanhã', self.SEXTA, date(2026, 10, 17)),
+            ('depois de amanhã', self.SEXTA, date(2026, 10, 18)),
+            # "sexta" dita numa sexta é a da semana seguinte
+            ('sexta', self.SEXTA, date(2026, 10, 23)),
+            ('próxima terça-feira', self.SEXTA, date(2026, 10, 20)),
+            ('25/08', self.SEXTA, date(2027, 8, 25)),
+            ('25/12', self.SEXTA, date(2026, 12, 25)),
+            ('25/08/2026', self.SEXTA, date(2026, 8, 25)),
+            ('dia 20', self.SEXTA, date(2026, 10, 20)),
+            ('dia 10', self.SEXTA, date(2026, 11, 10)),
+            # Setembro não tem dia 31
+            ('dia 31', date(2026, 9, 10), date(2026, 10, 31)),
+            ('31/02', self.SEXTA, None),
+            ('qualquer dia', self.SEXTA, None),
+        ]
+        for texto, hoje, esperado in casos:
+            with self.subTest(texto=texto, hoje=hoje):
+                self.assertEqual(resolve_date(texto, hoje), esperado)
+
+    def test_resolve_time(self):
+        casos = [
+            ('10h30', time(10, 30)),
+            ('14 horas', time(14, 0)),
+            ('às 9', time(9, 0)),
+            ('10:00', time(10, 0)),
+            ('10h', time(10, 0)),
+            ('25h', None),
+            ('de manhã', None),
+        ]
+        for texto, esperado in casos:
+            with self.subTest(texto=texto):
+                self.assertEqual(resolve_time(texto), esperado)
+
+
+class ResolveMedicoTests(TestCase):
+    """Busca do médico pelo nome escrito pela IA ou pelo paciente"""
+
+    def setUp(self):
+        knowledge_base.forget_local_version()
+        knowledge_base._local_snapshot = (None, None)
+        command_service._doctor_index = (None, [])
+        for nome in ('Dr. Gleiton Souza', 'Dra. Ana Beatriz Lima'):
+            Medico.objects.create(
+                nome=nome, bio='-', convenios='Particular', preco_particular=Decimal('300.00'), formas_pagamento='Pix'
+            )
+        knowledge_base.forget_local_version()
+
+    def test_title_and_partial_name(self):
+        self.assertEqual(command_service.resolve_medico('O Doutor Gleiton')['nome'], 'Dr. Gleiton Souza')
+        self.assertEqual(command_service.resolve_medico('dra ana lima')['nome'], 'Dra. Ana Beatriz Lima')
+
+    def test_typo(self):
+        self.assertEqual(command_service.resolve_medico('Dr. Gleyton')['nome'], 'Dr. Gleiton Souza')
+
+    def test_minimum_similarity(self):
+        self.assertIsNone(command_service.resolve_medico('Dr. Roberto'))
+        self.assertIsNone(command_service.resolve_medico('Dr.'))
+        with override_settings(CHATBOT_COMMANDS={'SIMILARIDADE_MINIMA_MEDICO': 1.0}):
+            self.assertIsNone(command_service.resolve_medico('Dr. Gleyton'))
+            self.assertIsNotNone(command_service.resolve_medico('Dr. Gleiton'))
+
+
+@override_settings(GEMINI_CONTEXT_CACHE={'ENABLED': True, 'TTL_SEGUNDOS': 3600, 'MARGEM_RENOVACAO_SEGUNDOS': 300})
+class ContextCacheTests(TestCase):
+    """Cache de contexto do prompt do sistema com um cliente genai falso"""
+
+    def setUp(self):
+        cache.clear()
+        knowledge_base.forget_local_version()
+        ClinicaInfo.objects.create(
+            objetivo_geral='Atendimento', telefone_contato='(71) 3333-3333', endereco='Rua X, 10',
+            referencia_localizacao='Centro', politica_agendamento='Agendamento pelo WhatsApp'
+        )
+        self.client = ScriptedClient()
+
+    def test_created_once_per_version(self):
+        context_cache = GeminiContextCache(self.client, 'modelo')
+
+        self.assertEqual(context_cache.get_cached_content(1, 'prompt'), 'cachedContents/1')
+        self.assertEqual(context_cache.get_cached_content(1, 'prompt'), 'cachedContents/1')
+        self.assertEqual(len(self.client.caches.created), 1)
+        self.assertEqual(self.client.caches.created[0].system_instruction, 'prompt')
+        self.assertEqual(self.client.caches.created[0].ttl, '3600s')
+
+        # Outro processo reaproveita o cache criado por este
+        self.assertEqual(GeminiContextCache(self.client, 'modelo').get_cached_content(1, 'prompt'), 'cachedContents/1')
+        self.assertEqual(len(self.client.caches.created), 1)
+
+        self.assertEqual(context_cache.get_cached_content(2, 'prompt novo'), 'cachedContents/2')
+
+    def test_refreshed_before_expiring(self):
+        context_cache = GeminiContextCache(self.client, 'modelo')
+        with override_settings(GEMINI_CONTEXT_CACHE={'ENABLED': True, 'TTL_SEGUNDOS': 600, 'MARGEM_RENOVACAO_SEGUNDOS': 600}):
+            context_cache.get_cached_content(1, 'prompt')
+            self.assertEqual(context_cache.get_cached_content(1, 'prompt'), 'cachedContents/1')
+            self.assertEqual(self.client.caches.updated, ['cachedContents/1'])
+
+            # Renovação falhou (cache removido no servidor): cria outro
+            self.client.caches.falhar_renovacao = True
+            self.assertEqual(context_cache.get_cached_content(1, 'prompt'), 'cachedContents/2')
+        self.assertEqual(len(self.client.caches.created), 2)
+
+    def test_creation_failure_waits_before_retrying(self):
+        context_cache = GeminiContextCache(self.client, 'modelo')
+        self.client.caches.falhar_criacao = True
+        self.assertIsNone(context_cache.get_cached_content(1, 'prompt'))
+
+        self.client.caches.falhar_criacao = False
+        self.assertIsNone(context_cache.get_cached_content(1, 'prompt'))
+        self.assertEqual(self.client.caches.created, [])
+
+    def test_is_context_cache_error(self):
+        self.assertTrue(is_context_cache_error(cache_not_found()))
+        self.assertFalse(is_context_cache_error(genai_errors.ClientError(
+            429, {'error': {'code': 429, 'message': 'Resource exhausted (cache)', 'status': 'RESOURCE_EXHAUSTED'}}
+        )))
+        self.assertFalse(is_context_cache_error(genai_errors.ServerError(
+            503, {'error': {'code': 503, 'message': 'Unavailable', 'status': 'UNAVAILABLE'}}
+        )))
+        self.assertFalse(is_context_cache_error(TimeoutError('cache')))
+
+    def test_inline_fallback_when_cache_is_gone(self):
+        self.client.script.extend([cache_not_found(), 'Resposta inline', 'Resposta com cache'])
+        ai_service = AIService(client=self.client)
+        ai_service.model_router = ModelRouter()
+
+        self.assertEqual(ai_service.generate_response([{'role': 'user', 'parts': ['Oi']}]), 'Resposta inline')
+        com_cache, inline = self.client.requests
+        self.assertEqual(com_cache.config.cached_content, 'cachedContents/1')
+        self.assertIsNone(com_cache.config.system_instruction)
+        self.assertIsNone(inline.config.cached_content)
+        self.assertIn('PneumoSono', inline.config.system_instruction)
+
+        # O cache descartado é recriado na próxima mensagem
+        self.assertEqual(ai_service.generate_response([{'role': 'user', 'parts': ['Oi']}]), 'Resposta com cache')
+        self.assertEqual(self.client.requests[-1].config.cached_content, 'cachedContents/2')
+
+    def test_inline_fallback_async(self):
+        self.client.script.extend([cache_not_found(), 'Resposta inline'])
+        ai_service = AIService(client=self.client)
+        ai_service.model_router = ModelRouter()
+
+        resposta = async_to_sync(ai_service.generate_response_async)([{'role': 'user', 'parts': ['Oi']}])
+
+        self.assertEqual(resposta, 'Resposta inline')
+        self.assertEqual([request.config.cached_content for request in self.client.requests], ['cachedContents/1', None])
+
+
+UM_MODELO = {'HEDGING': False, 'CADEIAS': {'simples': ['modelo'], 'agendamento': ['modelo']}}
+
+
+@override_settings(
+    GEMINI_CONTEXT_CACHE={'ENABLED': False},
+    GEMINI_MODEL_ROUTER=UM_MODELO,
+    CHATBOT_INTENT_ROUTER={'ENABLED': False},
+    CHATBOT_FAQ_CACHE={'ENABLED': False},
+    CHATBOT_AI_MODE='ferramentas',
+)
+class ToolCallingTests(TestCase):
+    """Modo de ferramentas (function calling) com um cliente genai roteirizado"""
+
+    HISTORICO = [{'role': 'user', 'parts': ['Quero falar com a secretária']}]
+
+    def setUp(self):
+        knowledge_base.forget_local_version()
+        ClinicaInfo.objects.create(
+            objetivo_geral='Atendimento', telefone_contato='(71) 3333-3333', endereco='Rua X, 10',
+            referencia_localizacao='Centro', politica_agendamento='Agendamento pelo WhatsApp'
+        )
+        self.executadas = []
+
+    def ai_service(self, *script) -> AIService:
+        self.client = ScriptedClient(*script)
+        ai_service = AIService(client=self.client)
+        ai_service.model_router = ModelRouter()
+        return ai_service
+
+    def executor(self, nome, args):
+        self.executadas.append((nome, args))
+        return {'resultado': f"{nome} executada"}
+
+    def function_responses(self, request):
+        """Resultados de ferramenta enviados ao modelo na requisição"""
+        return [
+            (part.function_response.name, part.function_response.response)
+            for part in request.contents[-1].parts
+            if part.function_response
+        ]
+
+    def test_tool_turn_then_text(self):
+        ai_service = self.ai_service([('consultar_agenda', {'medico': 'Dr. Gleiton', 'dia': 'amanhã'})], 'Tenho 10:00 e 11:00.')
+
+        resposta = ai_service.generate_response_with_tools(self.HISTORICO, self.executor)
+
+        self.assertEqual(resposta, 'Tenho 10:00 e 11:00.')
+        self.assertEqual(self.executadas, [('consultar_agenda', {'medico': 'Dr. Gleiton', 'dia': 'amanhã'})])
+        primeira, segunda = self.client.requests
+        self.assertTrue(primeira.config.tools)
+        self.assertEqual(len(segunda.contents), 3)
+        self.assertEqual(self.function_responses(segunda), [('consultar_agenda', {'resultado': 'consultar_agenda executada'})])
+
+    def test_parallel_function_calls(self):
+        ai_service = self.ai_service(
+            [('consultar_agenda', {'medico': 'Dr. Gleiton', 'dia': 'amanhã'}),
+             ('consultar_agenda', {'medico': 'Dra. Ana', 'dia': 'amanhã'})],
+            'Os dois têm horários.',
+        )
+
+        resposta = async_to_sync(ai_service.generate_response_with_tools_async)(self.HISTORICO, self.executor)
+
+        self.assertEqual(resposta, 'Os dois têm horários.')
+        self.assertEqual([args['medico'] for _, args in self.executadas], ['Dr. Gleiton', 'Dra. Ana'])
+        self.assertEqual(len(self.function_responses(self.client.requests[-1])), 2)
+
+    def test_tool_turns_are_bounded(self):
+        chamada = [('consultar_agenda', {'medico': 'Dr. Gleiton', 'dia': 'amanhã'})]
+
+        ai_service = self.ai_service(chamada, chamada, 'nunca lida')
+        self.assertEqual(ai_service.generate_response_with_tools(self.HISTORICO, self.executor, max_turns=2), TOOL_LIMIT_MESSAGE)
+        self.assertEqual(len(self.client.requests), 2)
+
+        with override_settings(CHATBOT_MAX_TURNOS_FERRAMENTAS=1):
+            ai_service = self.ai_service(chamada, 'nunca lida')
+            resposta = async_to_sync(ai_service.generate_response_with_tools_async)(self.HISTORICO, self.executor)
+        self.assertEqual(resposta, TOOL_LIMIT_MESSAGE)
+        self.assertEqual(len(self.executadas), 3)
+
+    def test_tool_error_goes_back_to_model(self):
+        def falha(nome, args):
+            raise RuntimeError('banco fora do ar')
+
+        ai_service = self.ai_service([('consultar_agenda', {'medico': 'Dr. Gleiton'})], 'Tive um problema.')
+
+        self.assertEqual(ai_service.generate_response_with_tools(self.HISTORICO, falha), 'Tive um problema.')
+        self.assertIn('erro', self.function_responses(self.client.requests[-1])[0][1])
+
+    def test_unknown_tool(self):
+        with self.assertRaisesMessage(ValueError, 'Ferramenta desconhecida: cancelar_agendamento'):
+            CommandService().execute_tool('cancelar_agendamento', {}, TELEFONE)
+
+    def conversation_service(self, *script) -> ConversationService:
+        with mock.patch.dict('os.environ', {'WHATSAPP_ACCESS_TOKEN': 'x', 'WHATSAPP_PHONE_NUMBER_ID': '1'}):
+            return ConversationService(ai_service=self.ai_service(*script), whatsapp_service=FakeWhatsApp())
+
+    def test_direcionamento_created_from_tool_call(self):
+        service = self.conversation_service(
+            [('direcionar_secretaria', {'motivo': 'Dúvida sobre reembolso'})],
+            'Encaminhei para a secretária.',
+        )
+
+        self.assertEqual(service.process_user_message(TELEFONE, 'Quero falar com a secretária'), 'Encaminhei para a secretária.')
+
+        direcionamento = Direcionamento.objects.get()
+        self.assertEqual(direcionamento.tipo_solicitacao, 'duvida_complexa')
+        self.assertEqual(direcionamento.conversa.status, 'redirecionada')
+        self.assertEqual(
+            list(direcionamento.conversa.mensagens.values_list('remetente', 'conteudo')),
+            [
+                ('user', 'Quero falar com a secretária'),
+                ('system', "[DIRECIONAR_SECRETARIA: motivo='Dúvida sobre reembolso']"),
+                ('bot', 'Encaminhei para a secretária.'),
+            ],
+        )
+
+    def test_action_result_sent_when_model_fails_after_tool(self):
+        service = self.conversation_service(
+            [('direcionar_secretaria', {'motivo': 'Reembolso'})],
+            genai_errors.ServerError(503, {'error': {'code': 503, 'message': 'Unavailable', 'status': 'UNAVAILABLE'}}),
+        )
+
+        resposta = service.process_user_message(TELEFONE, 'Quero falar com a secretária')
+
+        self.assertNotEqual(resposta, AI_ERROR_MESSAGE)
+        self.assertIn('secretária', resposta)
+        self.assertEqual(Direcionamento.objects.count(), 1)
+        self.assertEqual(Direcionamento.objects.get().conversa.mensagens.filter(remetente='bot').get().conteudo, resposta)
+
+
+class StreamChunkerTests(SimpleTestCase):
+    """Corte das respostas em streaming em mensagens do WhatsApp"""
+
+    def feed_all(self, chunker, partes):
+        chunks = []
+        for parte in partes:
+            chunks.extend(chunker.feed(parte))
+        return chunks
+
+    def test_first_chunk_cut_at_sentence(self):
+        chunker = StreamChunker(min_chars=20, max_chars=200)
+        chunks = self.feed_all(chunker, ['Olá! Sou o assistente virtual', ' da clínica. Posso ajudar com ', 'consultas e exames.'])
+
+        self.assertEqual(chunks, ['Olá! Sou o assistente virtual da clínica.'])
+        self.assertEqual(chunker.buffer, 'Posso ajudar com consultas e exames.')
+        self.assertEqual(chunker.flush(), 'Posso ajudar com consultas e exames.')
+        self.assertIsNone(chunker.flush())
+
+    def test_abbreviation_is_not_a_sentence_end(self):
+        chunker = StreamChunker(min_chars=10, max_chars=200)
+        chunks = self.feed_all(chunker, ['A consulta com o Dr. ', 'Gleiton custa R$ 300. ', 'Deseja agendar?'])
+
+        self.assertEqual(chunks, ['A consulta com o Dr. Gleiton custa R$ 300.'])
+
+    def test_later_chunks_wait_for_paragraph(self):
+        chunker = StreamChunker(min_chars=10, max_chars=200)
+        chunks = self.feed_all(chunker, ['Primeira frase completa. Segunda frase. ', 'Terceira frase.\n\nNovo parágrafo'])
+
+        self.assertEqual(chunks, ['Primeira frase completa.', 'Segunda frase. Terceira frase.'])
+        self.assertEqual(chunker.flush(), 'Novo parágrafo')
+
+    def test_max_chars_fallback(self):
+        # Sem fim de frase: corta no último espaço antes de max_chars
+        chunker = StreamChunker(min_chars=5, max_chars=30)
+        chunks = chunker.feed('palavra ' * 6)
+        self.assertEqual(chunks[0], 'palavra palavra palavra')
+        self.assertTrue(all(len(chunk) <= 30 for chunk in chunks))
+
+        # Sem espaço: corta em max_chars
+        chunker = StreamChunker(min_chars=5, max_chars=30)
+        self.assertEqual(chunker.feed('x' * 45), ['x' * 30])
+        self.assertEqual(chunker.flush(), 'x' * 15)
+
+    def test_long_paragraph_cut_at_last_sentence_that_fits(self):
+        chunker = StreamChunker(min_chars=5, max_chars=40)
+        chunker.emitted = 1
+        self.assertEqual(chunker.feed('Uma frase. Outra frase. Mais uma frase longa'), ['Uma frase. Outra frase.'])
+
+
+class StreamRelayTests(SimpleTestCase):
+    """Envio da resposta em streaming, interrompido ao aparecer um comando"""
+
+    PARTES = ['Vou verificar a agenda do Dr. Gleiton. ', 'Um momento! ', "[CONSULTAR_AGENDA: medico='Dr. Gleiton', ", "dia='amanhã']"]
+
+    def setUp(self):
+        ai_service = SimpleNamespace(
+            generate_response_stream=lambda historico: iter(self.PARTES),
+            generate_response_stream_async=self.stream_async,
+        )
+        with mock.patch.dict('os.environ', {'WHATSAPP_ACCESS_TOKEN': 'x', 'WHATSAPP_PHONE_NUMBER_ID': '1'}):
+            self.service = ConversationService(ai_service=ai_service, whatsapp_service=FakeWhatsApp(),
+                                               command_service=SimpleNamespace())
+
+    async def stream_async(self, historico):
+        for parte in self.PARTES:
+            yield parte
+
+    def test_relay_stops_at_command(self):
+        relay = StreamRelay(StreamChunker(min_chars=10, max_chars=200))
+        enviados = [chunk for parte in self.PARTES for chunk in relay.feed(parte)] + relay.finish()
+
+        self.assertEqual(enviados, ['Vou verificar a agenda do Dr. Gleiton.'])
+        resposta, nao_enviado = relay.result()
+        self.assertEqual(resposta, ''.join(self.PARTES))
+        self.assertEqual(nao_enviado, "Um momento! [CONSULTAR_AGENDA: medico='Dr. Gleiton', dia='amanhã']")
+
+    def test_relay_flushes_plain_text(self):
+        relay = StreamRelay(StreamChunker(min_chars=10, max_chars=200))
+        enviados = relay.feed('Olá, tudo bem? Posso ') + relay.feed('ajudar') + relay.finish()
+
+        self.assertEqual(enviados, ['Olá, tudo bem?', 'Posso ajudar'])
+        self.assertEqual(relay.result(), ('Olá, tudo bem? Posso ajudar', ''))
+
+    @override_settings(CHATBOT_STREAMING={'MIN_CARACTERES': 10})
+    def test_sync_and_async_streams_send_the_same(self):
+        enviados_sync = []
+        resultado_sync = self.service._stream_response([], enviados_sync.append)
+
+        enviados_async = []
+
+        async def enviar(chunk):
+            enviados_async.append(chunk)
+
+        resultado_async = async_to_sync(self.service._stream_response_async)([], enviar)
+
+        self.assertEqual(enviados_sync, ['Vou verificar a agenda do Dr. Gleiton.'])
+        self.assertEqual(enviados_async, enviados_sync)
+        self.assertEqual(resultado_async, resultado_sync)
+        self.assertTrue(resultado_sync[1].startswith('Um momento! [CONSULTAR_AGENDA'))
+
+
+class FakeClock:
+    """Relógio monotônico controlado pelo teste"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class ScriptedRequests:
+    """
+    Requisições falsas do roteador: por modelo, uma fila de resultados
+    (texto, exceção ou um Event que bloqueia a chamada até ser liberado)
+    """
+
+    def __init__(self, **roteiro):
+        self.roteiro = {modelo: list(resultados) for modelo, resultados in roteiro.items()}
+        self.chamados = []
+        self.lock = threading.Lock()
+
+    def next(self, model):
+        with self.lock:
+            self.chamados.append(model)
+            return self.roteiro[model].pop(0)
+
+    def __call__(self, model, timeout):
+        resultado = self.next(model)
+        if isinstance(resultado, threading.Event):
+            resultado.wait(5)
+            return f"{model} atrasado"
+        if isinstance(resultado, Exception):
+            raise resultado
+        return resultado
+
+    async def call_async(self, model, timeout):
+        resultado = self.next(model)
+        if isinstance(resultado, threading.Event):
+            await asyncio.sleep(5)
+            return f"{model} atrasado"
+        if isinstance(resultado, Exception):
+            raise resultado
+        return resultado
+
+
+ROTEADOR = {
+    'CADEIAS': {'simples': ['rapido', 'forte'], 'agendamento': ['forte', 'rapido']},
+    'HEDGING': False,
+    'FALHAS_PARA_ABRIR': 2,
+    'ESPERA_CIRCUITO_SEGUNDOS': 60,
+    'TIMEOUTS_SEGUNDOS': {'rapido': 10, 'forte': 20},
+}
+
+
+@override_settings(GEMINI_MODEL_ROUTER=ROTEADOR)
+class ModelRouterTests(SimpleTestCase):
+    """Cadeias de fallback, circuit breaker e hedging com relógio falso"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        # Só o roteador vê o relógio falso (asyncio e threading seguem o real)
+        patcher = mock.patch.object(model_router_module, 'time', SimpleNamespace(monotonic=self.clock))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = ModelRouter()
+
+    def falha(self):
+        return genai_errors.ServerError(503, {'error': {'code': 503, 'message': 'Unavailable', 'status': 'UNAVAILABLE'}})
+
+    def test_chain_per_task(self):
+        self.assertEqual(self.router.chain('simples'), ['rapido', 'forte'])
+        self.assertEqual(self.router.chain('agendamento'), ['forte', 'rapido'])
+        self.assertEqual(self.router.chain('desconhecida'), ['rapido', 'forte'])
+
+    def test_fallback_follows_task_chain(self):
+        requests = ScriptedRequests(rapido=[self.falha()], forte=['resposta do forte'])
+        self.assertEqual(self.router.call('simples', requests), 'resposta do forte')
+        self.assertEqual(requests.chamados, ['rapido', 'forte'])
+
+        requests = ScriptedRequests(forte=[self.falha()], rapido=['resposta do rápido'])
+        self.assertEqual(async_to_sync(self.router.call_async)('agendamento', requests.call_async), 'resposta do rápido')
+        self.assertEqual(requests.chamados, ['forte', 'rapido'])
+
+    def test_all_models_fail(self):
+        erro = TimeoutError('forte')
+        requests = ScriptedRequests(rapido=[self.falha()], forte=[erro])
+        with self.assertRaises(TimeoutError):
+            self.router.call('simples', requests)
+
+    def test_circuit_opens_and_half_opens(self):
+        breaker = self.router.breaker
+        requests = ScriptedRequests(rapido=[self.falha(), self.falha(), 'teste ok'], forte=['f1', 'f2', 'f3'])
+
+        self.router.call('simples', requests)
+        self.assertEqual(breaker.state('rapido'), 'fechado')
+        self.router.call('simples', requests)
+        self.assertEqual(breaker.state('rapido'), 'aberto')
+
+        # Aberto: o modelo é pulado
+        self.assertEqual(self.router.call('simples', requests), 'f3')
+        self.assertEqual(requests.chamados, ['rapido', 'forte', 'rapido', 'forte', 'forte'])
+
+        # Terminada a espera, uma única chamada de teste fecha o circuito
+        self.clock.advance(61)
+        self.assertEqual(breaker.state('rapido'), 'meio_aberto')
+        self.assertEqual(self.router.call('simples', requests), 'teste ok')
+        self.assertEqual(breaker.state('rapido'), 'fechado')
+
+    def test_failed_probe_reopens_circuit(self):
+        breaker = self.router.breaker
+        for _ in range(2):
+            breaker.record_failure('rapido')
+        self.clock.advance(61)
+
+        # Só uma chamada de teste por vez no meio aberto
+        self.assertTrue(breaker.allow('rapido', probe_timeout=10))
+        self.assertFalse(breaker.allow('rapido', probe_timeout=10))
+
+        breaker.record_failure('rapido')
+        self.assertEqual(breaker.state('rapido'), 'aberto')
+        self.clock.advance(59)
+        self.assertFalse(breaker.allow('rapido', probe_timeout=10))
+
+        # Reserva de teste não usada expira após o timeout do modelo
+        self.clock.advance(2)
+        self.assertTrue(breaker.allow('rapido', probe_timeout=10))
+        self.clock.advance(11)
+        self.assertTrue(breaker.allow('rapido', probe_timeout=10))
+
+    def test_all_circuits_open_still_calls_first(self):
+        for modelo in ('rapido', 'forte'):
+            for _ in range(2):
+                self.router.breaker.record_failure(modelo)
+
+        requests = ScriptedRequests(rapido=['mesmo assim'])
+        self.assertEqual(self.router.call('simples', requests), 'mesmo assim')
+        self.assertEqual(requests.chamados, ['rapido'])
+
+    def test_hedge_delay_from_recent_latency(self):
+        with override_settings(GEMINI_MODEL_ROUTER={**ROTEADOR, 'MIN_AMOSTRAS_HEDGE': 5, 'ATRASO_HEDGE_MINIMO_SEGUNDOS': 0.5}):
+            self.assertEqual(self.router.hedge_delay('rapido'), 4.0)
+            for segundos in (1, 1, 1, 2, 3):
+                self.router.latencies.observe('rapido', segundos)
+            self.assertEqual(self.router.hedge_delay('rapido'), 3)
+            # Limitado ao timeout do modelo
+            for _ in range(20):
+                self.router.latencies.observe('rapido', 30)
+            self.assertEqual(self.router.hedge_delay('rapido'), 10)
+
+    def hedging(self):
+        return override_settings(GEMINI_MODEL_ROUTER={
+            **ROTEADOR, 'HEDGING': True, 'ATRASO_HEDGE_PADRAO_SEGUNDOS': 0.01, 'ATRASO_HEDGE_MINIMO_SEGUNDOS': 0,
+        })
+
+    def test_hedging_uses_first_response(self):
+        lento = threading.Event()
+        self.addCleanup(lento.set)
+        requests = ScriptedRequests(rapido=[lento], forte=['resposta do hedge'])
+
+        with self.hedging():
+            self.assertEqual(self.router.call('simples', requests), 'resposta do hedge')
+        self.assertEqual(requests.chamados, ['rapido', 'forte'])
+
+    def test_hedging_async_cancels_slow_call(self):
+        requests = ScriptedRequests(rapido=[threading.Event()], forte=['resposta do hedge'])
+
+        with self.hedging():
+            resposta = async_to_sync(self.router.call_async)('simples', requests.call_async)
+
+        self.assertEqual(resposta, 'resposta do hedge')
+        self.assertEqual(requests.chamados, ['rapido', 'forte'])
+        # Cancelamento não conta como falha
+        self.assertEqual(self.router.breaker.state('rapido'), 'fechado')
+
+    def test_stream_falls_back_only_before_first_chunk(self):
+        def open_stream(model, timeout):
+            if model == 'rapido':
+                raise self.falha()
+            return iter(['Olá', ', tudo bem?'])
+
+        self.assertEqual(list(self.router.stream('simples', open_stream)), ['Olá', ', tudo bem?'])
+
+        def broken_stream(model, timeout):
+            yield 'Começo'
+            raise self.falha()
+
+        with self.assertRaises(genai_errors.ServerError):
+            list(self.router.stream('simples', broken_stream))
@@ -9,7 +9,13 @@ urlpatterns = [
     # Webhook principal do WhatsApp
     path('webhook/', views.WebhookView.as_view(), name='webhook'),
     
+    # Webhook assíncrono (processa no event loop, requer servidor ASGI)
+    path('webhook/async/', views.AsyncWebhookView.as_view(), name='webhook_async'),
+    
     # Endpoint para consultar status das conversas
     path('conversations/', views.ConversationStatusView.as_view(), name='conversations'),
     path('conversations/<str:user_number>/', views.ConversationStatusView.as_view(), name='conversation_detail'),
+    
+    # Métricas do processo (cache, filas, clientes HTTP)
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
@@ -0,0 +1,170 @@
+"""
+Funções utilitárias para interpretar os comandos que a IA envia ao sistema
+
+Gramática dos comandos (ver prompt do sistema):
+    [CONSULTAR_AGENDA: medico='Dr. Fulano', dia='amanhã']
+    [CRIAR_AGENDAMENTO: medico='Dr. Fulano', dia='25/08', horario='10:00', nome_paciente='Maria']
+    [DIRECIONAR_SECRETARIA]
+"""
+import re
+import unicodedata
+from datetime import date, time, timedelta
+from typing import Dict, Optional, Tuple
+
+COMMAND_NAMES = ('CONSULTAR_AGENDA', 'CRIAR_AGENDAMENTO', 'DIRECIONAR_SECRETARIA')
+
+COMMAND_PATTERN = re.compile(
+    r"\[\s*(?P<nome>" + "|".join(COMMAND_NAMES) + r")\s*(?::(?P<args>[^\]]*))?\]"
+)
+
+# chave='valor', chave="valor" ou chave=valor (até a próxima vírgula)
+ARGUMENT_PATTERN = re.compile(
+    r"(?P<chave>\w+)\s*=\s*(?:'(?P<simples>[^']*)'|\"(?P<duplas>[^\"]*)\"|(?P<livre>[^,]+))"
+)
+
+DATE_PATTERN = re.compile(r"\b(?P<dia>\d{1,2})\s*[/\-.]\s*(?P<mes>\d{1,2})(?:\s*[/\-.]\s*(?P<ano>\d{2,4}))?\b")
+DAY_ONLY_PATTERN = re.compile(r"\bdia\s+(?P<dia>\d{1,2})\b")
+TIME_PATTERN = re.compile(r"\b(?P<hora>\d{1,2})\s*(?:(?::|h)\s*(?P<minuto>\d{2})?|(?=\s*horas?\b))")
+
+WEEKDAYS = {
+    'segunda': 1,
+    'terca': 2,
+    'quarta': 3,
+    'quinta': 4,
+    'sexta': 5,
+    'sabado': 6,
+    'domingo': 7,
+}
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normaliza texto para comparação: minúsculas, sem acentos e espaços extras
+
+    Args:
+        text: Texto original
+
+    Returns:
+        Texto normalizado
+    """
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    without_accents = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(without_accents.lower().split())
+
+
+def parse_command(text: str) -> Optional[Tuple[str, Dict[str, str]]]:
+    """
+    Extrai o primeiro comando da resposta da IA
+
+    Args:
+        text: Resposta da IA
+
+    Returns:
+        (nome do comando, argumentos) ou None se não houver comando
+    """
+    match = COMMAND_PATTERN.search(text or '')
+    if not match:
+        return None
+
+    args = {}
+    for arg in ARGUMENT_PATTERN.finditer(match.group('args') or ''):
+        value = next(
+            group for group in (arg.group('simples'), arg.group('duplas'), arg.group('livre'), '')
+            if group is not None
+        )
+        args[arg.group('chave').lower()] = value.strip()
+
+    return match.group('nome'), args
+
+
+def strip_commands(text: str) -> str:
+    """Remove os comandos do texto, mantendo o restante da resposta"""
+    return COMMAND_PATTERN.sub('', text or '').strip()
+
+
+def resolve_date(text: str, today: date) -> Optional[date]:
+    """
+    Converte uma data informada em português para date
+
+    Aceita "hoje", "amanhã", "depois de amanhã", dias da semana
+    ("sexta", "próxima terça-feira"), "25/08", "25/08/2025" e "dia 25".
+    Datas sem ano que já passaram são consideradas do ano seguinte; "dia N"
+    vai para o próximo mês que tenha esse dia.
+
+    Args:
+        text: Data como o paciente escreveu
+        today: Data de referência (hoje, no fuso da clínica)
+
+    Returns:
+        Data resolvida ou None se não foi possível interpretar
+    """
+    normalized = normalize_text(text)
+    if not normalized:
+        return None
+
+    if 'depois de amanha' in normalized:
+        return today + timedelta(days=2)
+    if 'amanha' in normalized:
+        return today + timedelta(days=1)
+    if 'hoje' in normalized:
+        return today
+
+    match = DATE_PATTERN.search(normalized)
+    if match:
+        day, month = int(match.group('dia')), int(match.group('mes'))
+        year = match.group('ano')
+        try:
+            if year:
+                year = int(year)
+                return date(year + 2000 if year < 100 else year, month, day)
+            resolved = date(today.year, month, day)
+            return resolved if resolved >= today else date(today.year + 1, month, day)
+        except ValueError:
+            return None
+
+    for name, weekday in WEEKDAYS.items():
+        if re.search(rf"\b{name}\b", normalized):
+            days_ahead = (weekday - today.isoweekday()) % 7
+            # "sexta" dita na própria sexta refere-se à próxima
+            return today + timedelta(days=days_ahead or 7)
+
+    match = DAY_ONLY_PATTERN.search(normalized)
+    if match:
+        day = int(match.group('dia'))
+        month, year = today.month, today.year
+        if day < today.day:
+            month, year = (1, year + 1) if month == 12 else (month + 1, year)
+        # Mês sem esse dia (ex: "dia 31" em setembro): o próximo mês que o tem
+        for _ in range(12):
+            try:
+                return date(year, month, day)
+            except ValueError:
+                month, year = (1, year + 1) if month == 12 else (month + 1, year)
+        return None
+
+    return None
+
+
+def resolve_time(text: str) -> Optional[time]:
+    """
+    Converte um horário ("10:00", "10h", "10h30", "14 horas") para time
+
+    Args:
+        text: Horário como informado
+
+    Returns:
+        Horário resolvido ou None se não foi possível interpretar
+    """
+    normalized = normalize_text(text)
+    match = TIME_PATTERN.search(normalized)
+    if match:
+        hour, minute = int(match.group('hora')), int(match.group('minuto') or 0)
+    elif re.fullmatch(r"(?:as\s+)?\d{1,2}", normalized):
+        # Apenas a hora: "10", "às 9"
+        hour, minute = int(normalized.split()[-1]), 0
+    else:
+        return None
+
+    if hour > 23 or minute > 59:
+        return None
+    return time(hour, minute)
@@ -0,0 +1,77 @@
+"""
+Métricas simples em memória do processo (contadores, latências e gauges)
+
+Cada processo (web ou worker) mantém suas próprias métricas; elas podem ser
+consultadas pelo endpoint `chatbot/metrics/`.
+"""
+import threading
+from collections import defaultdict
+from typing import Callable, Dict
+
+_lock = threading.Lock()
+_counters: Dict[str, int] = defaultdict(int)
+_timings: Dict[str, Dict[str, float]] = {}
+_gauges: Dict[str, Callable[[], Dict]] = {}
+
+
+def increment(name: str, value: int = 1):
+    """Incrementa um contador"""
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name: str, seconds: float):
+    """Registra uma medição de latência (em segundos)"""
+    with _lock:
+        timing = _timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+
+
+def register_gauge(name: str, callback: Callable[[], Dict]):
+    """Registra uma função que calcula valores instantâneos no momento da leitura"""
+    with _lock:
+        _gauges[name] = callback
+
+
+def get_counter(name: str) -> int:
+    """Retorna o valor atual de um contador"""
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def hit_rate(hits_name: str, misses_name: str) -> float:
+    """Calcula a taxa de acerto a partir de dois contadores"""
+    with _lock:
+        hits = _counters.get(hits_name, 0)
+        total = hits + _counters.get(misses_name, 0)
+    return hits / total if total else 0.0
+
+
+def snapshot() -> Dict:
+    """Retorna uma cópia de todas as métricas do processo"""
+    with _lock:
+        counters = dict(_counters)
+        timings = {
+            name: {
+                'count': timing['count'],
+                'avg_ms': round(timing['total'] / timing['count'] * 1000, 2) if timing['count'] else 0.0,
+                'max_ms': round(timing['max'] * 1000, 2),
+            }
+            for name, timing in _timings.items()
+        }
+        gauges = dict(_gauges)
+
+    return {
+        'counters': counters,
+        'timings': timings,
+        'gauges': {name: callback() for name, callback in gauges.items()},
+    }
+
+
+def reset():
+    """Zera contadores e latências (útil em testes)"""
+    with _lock:
+        _counters.clear()
+        _timings.clear()
@@ -0,0 +1,151 @@
+"""
+Divisão de respostas em streaming em mensagens do WhatsApp
+
+O texto chega do Gemini em pedaços arbitrários; o StreamChunker acumula e
+só libera trechos completos, cortados em fim de parágrafo ou de frase, para
+que cada mensagem enviada ao paciente faça sentido sozinha. O StreamRelay
+decide o que do streaming pode ser enviado (nada a partir de um comando).
+"""
+import re
+import time
+from typing import List, Optional, Tuple
+
+from . import metrics
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+# Fim de frase seguido de espaço (o espaço confirma que a frase terminou)
+SENTENCE_BREAK = re.compile(r"(?<=[.!?…])\s+|\n")
+
+# Abreviações comuns nas respostas que não encerram frase
+ABBREVIATIONS = {'dr', 'dra', 'sr', 'sra', 'prof', 'profa', 'av', 'n', 'nº', 'ex'}
+
+
+class StreamChunker:
+    """
+    Acumula o texto em streaming e devolve mensagens prontas para envio
+
+    - Parágrafos completos são liberados assim que atingem `min_chars`;
+    - A primeira mensagem também pode ser cortada em fim de frase, para
+      reduzir o tempo até o paciente receber algo;
+    - Parágrafos maiores que `max_chars` são cortados na última frase
+      completa (ou no último espaço, se não houver frase).
+    """
+
+    def __init__(self, min_chars: int = 60, max_chars: int = 400):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.buffer = ''
+        self.emitted = 0
+
+    def feed(self, text: str) -> List[str]:
+        """
+        Acrescenta um pedaço do streaming
+
+        Args:
+            text: Texto recebido
+
+        Returns:
+            Mensagens completas para enviar (pode ser vazia)
+        """
+        self.buffer += text or ''
+        chunks = []
+
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                break
+            chunk = self.buffer[:cut].strip()
+            self.buffer = self.buffer[cut:].lstrip()
+            if chunk:
+                chunks.append(chunk)
+                self.emitted += 1
+
+        return chunks
+
+    def flush(self) -> Optional[str]:
+        """Libera o texto restante ao fim do streaming"""
+        chunk = self.buffer.strip()
+        self.buffer = ''
+        if not chunk:
+            return None
+        self.emitted += 1
+        return chunk
+
+    def _find_cut(self) -> Optional[int]:
+        """Posição de corte no buffer ou None para aguardar mais texto"""
+        for match in PARAGRAPH_BREAK.finditer(self.buffer):
+            if match.start() >= self.min_chars:
+                return match.end()
+
+        if self.emitted == 0 or len(self.buffer) >= self.max_chars:
+            sentence_ends = [
+                match for match in SENTENCE_BREAK.finditer(self.buffer, 0, self.max_chars)
+                if match.start() >= self.min_chars and not self._is_abbreviation(match.start())
+            ]
+            if sentence_ends:
+                # Primeira mensagem: a primeira frase; demais: o máximo que couber
+                return sentence_ends[0].end() if self.emitted == 0 else sentence_ends[-1].end()
+
+        if len(self.buffer) >= self.max_chars:
+            space = self.buffer.rfind(' ', self.min_chars, self.max_chars)
+            return space if space > 0 else self.max_chars
+
+        return None
+
+    def _is_abbreviation(self, position: int) -> bool:
+        """Verifica se o ponto antes da posição encerra uma abreviação (ex: Dr.)"""
+        if self.buffer[position - 1:position] != '.':
+            return False
+        word = self.buffer[:position - 1].rsplit(None, 1)[-1:] or ['']
+        return word[0].lower() in ABBREVIATIONS
+
+
+class StreamRelay:
+    """
+    Estado do envio de uma resposta em streaming ao paciente
+
+    Repassa os pedaços ao StreamChunker e interrompe o envio ao aparecer um
+    "[" (comandos como [CONSULTAR_AGENDA: ...] nunca chegam ao paciente); o
+    restante segue o fluxo normal da resposta. Não faz I/O: `feed` e `finish`
+    devolvem as mensagens e quem consome o streaming (síncrono ou
+    assíncrono) apenas as envia, chamando `sent` antes de cada envio.
+    """
+
+    def __init__(self, chunker: StreamChunker):
+        self.chunker = chunker
+        self.parts = []
+        self.sending = True
+        self.sent_count = 0
+        self.started = time.monotonic()
+
+    def feed(self, part: str) -> List[str]:
+        """Acrescenta um pedaço da resposta e devolve as mensagens prontas para envio"""
+        self.parts.append(part)
+        if self.sending and '[' in part:
+            self.sending = False
+        if not self.sending:
+            self.chunker.buffer += part
+            return []
+        return self.chunker.feed(part)
+
+    def finish(self) -> List[str]:
+        """Fim do streaming: devolve o restante, se o envio não foi interrompido"""
+        if not self.sending:
+            return []
+        chunk = self.chunker.flush()
+        return [chunk] if chunk else []
+
+    def sent(self):
+        """Registra um envio (e o tempo até o primeiro trecho)"""
+        if self.sent_count == 0:
+            metrics.observe('chatbot.streaming_primeiro_trecho', time.monotonic() - self.started)
+        self.sent_count += 1
+
+    def result(self) -> Tuple[str, str]:
+        """
+        Returns:
+            (resposta completa da IA, texto ainda não enviado)
+        """
+        metrics.observe('chatbot.streaming_total', time.monotonic() - self.started)
+        return ''.join(self.parts), self.chunker.buffer.strip()
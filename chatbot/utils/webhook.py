@@ -0,0 +1,57 @@
+"""
+Funções utilitárias para leitura dos payloads do webhook do WhatsApp
+"""
+from typing import Dict, Iterator, List
+
+from . import metrics
+
+
+def _iter_values(data: Dict) -> Iterator[Dict]:
+    """Percorre todos os `value` de todas as entries/changes do payload"""
+    if data.get('object') != 'whatsapp_business_account':
+        return
+
+    for entry in data.get('entry', []):
+        for change in entry.get('changes', []):
+            yield change.get('value', {})
+
+
+def iter_webhook_messages(data: Dict) -> Iterator[Dict]:
+    """
+    Percorre todas as mensagens do payload (não apenas messages[0])
+    
+    Args:
+        data: Corpo JSON recebido da Meta
+        
+    Returns:
+        Iterador sobre os itens de messages[] de todas as changes
+    """
+    for value in _iter_values(data):
+        yield from value.get('messages', [])
+
+
+def iter_webhook_statuses(data: Dict) -> Iterator[Dict]:
+    """
+    Percorre todas as notificações de status (sent, delivered, read, failed)
+    
+    Args:
+        data: Corpo JSON recebido da Meta
+        
+    Returns:
+        Iterador sobre os itens de statuses[] de todas as changes
+    """
+    for value in _iter_values(data):
+        yield from value.get('statuses', [])
+
+
+def record_statuses(statuses: List[Dict]):
+    """
+    Caminho leve para os callbacks de status: só contabiliza e registra
+    falhas de entrega, sem tocar o fluxo de conversa
+    """
+    for status_data in statuses:
+        status_name = status_data.get('status', 'desconhecido')
+        metrics.increment(f'webhook.status_{status_name}')
+
+        if status_name == 'failed':
+            print(f"Falha na entrega para {status_data.get('recipient_id')}: {status_data.get('errors')}")
@@ -1,15 +1,27 @@
+import asyncio
+import hmac
 import json
 import os
+import socket
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
+from rest_framework.permissions import BasePermission
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .services.conversation_service import ConversationService
-from .services.whatsapp_service import WhatsAppService
-from .utils.validators import sanitize_message, validate_whatsapp_number
+from .services.registry import (get_conversation_service,
+                                get_inbound_queue_service)
+from .utils import metrics
+from .utils.webhook import iter_webhook_statuses, record_statuses
 
 # Token de verificação do Webhook
 VERIFY_TOKEN = os.environ.get('WHATSAPP_VERIFY_TOKEN')
@@ -20,10 +32,9 @@ class WebhookView(APIView):
     View para manipular webhooks do WhatsApp Business API
     """
     
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.conversation_service = ConversationService()
-        self.whatsapp_service = WhatsAppService()
+    @property
+    def queue_service(self):
+        return get_inbound_queue_service()
     
     def get(self, request):
         """
@@ -44,65 +55,127 @@ class WebhookView(APIView):
     
     def post(self, request):
         """
-        Processa mensagens recebidas do WhatsApp
+        Recebe mensagens do WhatsApp e grava na fila de processamento.
+        O processamento (IA + envio da resposta) é feito pelos workers
+        do comando `processar_fila`, então a Meta recebe o 200 imediatamente.
+        
+        Payloads inválidos são descartados com 200 (a reentrega não
+        adiantaria). Se a gravação na fila falhar, responde 500 para que a
+        Meta entregue a notificação de novo.
         """
         print("\nRecebida requisição POST (nova mensagem)...")
         
         try:
             # Decodifica o corpo da requisição
-            body_unicode = request.body.decode('utf-8')
-            data = json.loads(body_unicode)
-            
-            # Processa apenas mensagens do WhatsApp Business
-            if data['object'] == 'whatsapp_business_account':
-                for entry in data['entry']:
-                    for change in entry['changes']:
-                        value = change['value']
-                        
-                        if 'messages' in value:
-                            message_data = value['messages'][0]
-                            from_number = message_data['from']
-                            
-                            # Valida número do WhatsApp
-                            if not validate_whatsapp_number(from_number):
-                                print(f"Número inválido: {from_number}")
-                                continue
-                            
-                            # Processa apenas mensagens de texto
-                            if message_data['type'] == 'text':
-                                message_text = message_data['text']['body']
-                                
-                                # Sanitiza a mensagem
-                                sanitized_message = sanitize_message(message_text)
-                                
-                                # Processa a mensagem usando o serviço de conversa
-                                response_text = self.conversation_service.process_user_message(
-                                    from_number, 
-                                    sanitized_message
-                                )
-                                
-                                # Envia resposta via WhatsApp
-                                self.whatsapp_service.send_text_message(from_number, response_text)
-                                
-        except KeyError as e:
-            print(f"Erro ao processar a mensagem: Chave não encontrada. Erro: {e}")
-            print(f"Dados recebidos: {json.dumps(data, indent=2)}")
+            data = json.loads(request.body.decode('utf-8'))
+        except ValueError as e:
+            print(f"Payload inválido ignorado: {e}")
+            return Response(status=status.HTTP_200_OK)
+        
+        if not isinstance(data, dict):
+            print(f"Payload inválido ignorado: {data!r}")
+            return Response(status=status.HTTP_200_OK)
+        
+        # Status de entrega/leitura: caminho leve, fora da fila de conversa
+        record_statuses(list(iter_webhook_statuses(data)))
+        
+        try:
+            itens = self.queue_service.enqueue_webhook_payload(data)
         except Exception as e:
-            print(f"Erro inesperado ao processar a mensagem: {e}")
+            print(f"Erro ao gravar mensagens na fila: {e}")
             print(f"Dados recebidos: {json.dumps(data, indent=2)}")
+            return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
-        # Retorna 200 OK para a Meta
+        print(f"{len(itens)} mensagem(ns) enfileirada(s)")
         return Response(status=status.HTTP_200_OK)
 
 
+# Tarefas em andamento da view assíncrona (mantém referência até terminarem)
+_background_tasks = set()
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncWebhookView(View):
+    """
+    Variante assíncrona do webhook do WhatsApp (requer servidor ASGI)
+    
+    Grava as mensagens na mesma fila persistente do webhook síncrono e já
+    processa os itens no próprio event loop: enquanto aguarda o Gemini e a
+    Meta nenhuma thread fica ocupada, então um único worker ASGI atende
+    centenas de conversas simultâneas. Se o processo reiniciar no meio, as
+    mensagens continuam na fila e são retomadas pelos workers de
+    `processar_fila` (que também devem estar rodando).
+    """
+    
+    @property
+    def queue_service(self):
+        return get_inbound_queue_service()
+    
+    async def dispatch(self, request, *args, **kwargs):
+        # Sob WSGI cada requisição ganha um event loop descartável e as
+        # tarefas em segundo plano morreriam com ele
+        if not isinstance(request, ASGIRequest):
+            return HttpResponse("Webhook assíncrono requer servidor ASGI", status=501)
+        return await super().dispatch(request, *args, **kwargs)
+    
+    async def get(self, request):
+        """
+        Verificação inicial do webhook pela Meta
+        """
+        mode = request.GET.get('hub.mode')
+        token = request.GET.get('hub.verify_token')
+        challenge = request.GET.get('hub.challenge')
+        
+        if mode == 'subscribe' and token == VERIFY_TOKEN:
+            return HttpResponse(challenge)
+        return HttpResponse(status=403)
+    
+    async def post(self, request):
+        """
+        Grava as mensagens na fila, agenda o processamento e responde 200
+        
+        Cada remetente é processado em uma tarefa própria (remetentes em
+        paralelo), reservando os itens da fila como um worker; mensagens de
+        um mesmo remetente são respondidas em ordem, juntas. Se a gravação
+        na fila falhar, responde 500 para que a Meta reentregue.
+        """
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+        except ValueError as e:
+            print(f"Payload inválido ignorado: {e}")
+            return JsonResponse({})
+        
+        if not isinstance(data, dict):
+            print(f"Payload inválido ignorado: {data!r}")
+            return JsonResponse({})
+        
+        # Status de entrega/leitura: caminho leve, fora do fluxo de conversa
+        record_statuses(list(iter_webhook_statuses(data)))
+        
+        try:
+            itens = await sync_to_async(self.queue_service.enqueue_webhook_payload)(data)
+        except Exception as e:
+            print(f"Erro ao gravar mensagens na fila: {e}")
+            print(f"Dados recebidos: {json.dumps(data, indent=2)}")
+            return JsonResponse({}, status=500)
+        
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:async"
+        for telefone in dict.fromkeys(item.telefone_whatsapp for item in itens):
+            task = asyncio.create_task(self.queue_service.run_sender_async(worker_id, telefone))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+        
+        return JsonResponse({})
+
+
 class ConversationStatusView(APIView):
     """
     View para consultar status das conversas (útil para debugging)
     """
     
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.conversation_service = ConversationService()
+    @property
+    def conversation_service(self):
+        return get_conversation_service()
     
     def get(self, request, user_number=None):
         """
@@ -127,4 +200,32 @@ class ConversationStatusView(APIView):
         Reseta a conversa de um usuário específico
         """
         self.conversation_service.reset_conversation(user_number)
-        return Response({'message': 'Conversa resetada com sucesso'})
\ No newline at end of file
+        return Response({'message': 'Conversa resetada com sucesso'})
+
+
+class IsStaffOrMetricsToken(BasePermission):
+    """
+    Acesso às métricas: usuário staff (sessão do admin) ou header
+    X-Metrics-Token igual a settings.CHATBOT_METRICS_TOKEN (coletores internos)
+    """
+    
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+        
+        token = getattr(settings, 'CHATBOT_METRICS_TOKEN', None)
+        informado = request.headers.get('X-Metrics-Token')
+        return bool(token and informado) and hmac.compare_digest(token, informado)
+
+
+class MetricsView(APIView):
+    """
+    View para consultar as métricas do processo (contadores e latências)
+    
+    Expõe profundidade da fila, deduplicação e conexões: restrita a staff
+    ou ao token interno.
+    """
+    permission_classes = [IsStaffOrMetricsToken]
+    
+    def get(self, request):
+        return Response(metrics.snapshot())
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ClinicaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'clinica'
+
+    def ready(self):
+        # Registra os signals de invalidação da base de conhecimento
+        from . import signals  # noqa: F401
@@ -0,0 +1,186 @@
+"""
+Versionamento e cache da base de conhecimento da clínica
+
+A versão é um número guardado no banco (VersaoBaseConhecimento) e
+incrementado pelos signals de `clinica.signals`, na mesma transação em que
+algum dado da clínica muda. Como fica no banco, todos os processos (web e
+workers da fila) enxergam a nova versão, qualquer que seja o backend de
+cache. Cada processo guarda a versão lida por alguns segundos
+(CLINICA_KB_VERSAO_TTL_SEGUNDOS) para não consultar o banco a cada mensagem.
+
+Tudo o que é derivado desses dados (snapshot, prompt do sistema etc.) deve
+ser cacheado usando a versão como parte da chave.
+"""
+import threading
+import time
+from typing import Any, Dict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Prefetch
+
+from .models import (ClinicaInfo, Especialidade, Exame, HorarioTrabalho, Medico,
+                     VersaoBaseConhecimento)
+
+KB_SNAPSHOT_CACHE_KEY = 'clinica:kb_snapshot:{version}'
+# Versões antigas expiram sozinhas; a atual é renovada pelo cache local
+KB_CACHE_TIMEOUT = 60 * 60 * 24
+# Atraso máximo (s) para um processo perceber uma nova versão
+DEFAULT_KB_VERSION_TTL = 5
+
+_local_lock = threading.Lock()
+_local_snapshot = (None, None)  # (versão, dados)
+_local_version = (None, 0.0)  # (versão, expira em - time.monotonic)
+
+
+def _load_version_from_db() -> int:
+    """Lê a versão no banco, criando o registro na primeira vez"""
+    version = VersaoBaseConhecimento.objects.filter(pk=1).values_list('versao', flat=True).first()
+    if version is None:
+        # Valor inicial baseado no relógio para não reaproveitar chaves antigas
+        # do cache caso o banco tenha sido recriado
+        registro, _ = VersaoBaseConhecimento.objects.get_or_create(
+            pk=1, defaults={'versao': int(time.time() * 1000)}
+        )
+        version = registro.versao
+    return version
+
+
+def get_knowledge_base_version() -> int:
+    """
+    Retorna a versão atual da base de conhecimento
+
+    Returns:
+        Número da versão (muda sempre que algum dado da clínica é alterado)
+    """
+    global _local_version
+
+    version, expires_at = _local_version
+    if version is not None and time.monotonic() < expires_at:
+        return version
+
+    version = _load_version_from_db()
+    ttl = getattr(settings, 'CLINICA_KB_VERSAO_TTL_SEGUNDOS', DEFAULT_KB_VERSION_TTL)
+    _local_version = (version, time.monotonic() + ttl)
+    return version
+
+
+def forget_local_version():
+    """Descarta a versão guardada no processo (a próxima leitura vai ao banco)"""
+    global _local_version
+    _local_version = (None, 0.0)
+
+
+def bump_knowledge_base_version():
+    """
+    Invalida tudo o que foi derivado da base de conhecimento
+
+    Deve ser chamada dentro da transação que alterou os dados: a nova versão
+    só é vista pelos outros processos junto com o commit, então nenhum deles
+    reconstrói o cache da nova versão com dados ainda não commitados.
+    """
+    if not VersaoBaseConhecimento.objects.filter(pk=1).update(versao=F('versao') + 1):
+        _load_version_from_db()
+        VersaoBaseConhecimento.objects.filter(pk=1).update(versao=F('versao') + 1)
+    # O processo que alterou os dados enxerga a nova versão imediatamente
+    transaction.on_commit(forget_local_version)
+
+
+def _load_snapshot_from_db() -> Dict[str, Any]:
+    """Carrega os dados da clínica em estruturas simples (6 queries)"""
+    clinica = ClinicaInfo.objects.first()
+
+    medicos = Medico.objects.prefetch_related(
+        Prefetch('especialidades', queryset=Especialidade.objects.filter(ativa=True))
+    )
+    horarios = HorarioTrabalho.objects.select_related('medico').order_by('medico__nome', 'dia_da_semana', 'hora_inicio')
+    exames = Exame.objects.all()
+    especialidades = Especialidade.objects.filter(ativa=True)
+
+    return {
+        'clinica': {
+            'nome': clinica.nome,
+            'objetivo_geral': clinica.objetivo_geral,
+            'secretaria_nome': clinica.secretaria_nome,
+            'telefone_contato': clinica.telefone_contato,
+            'numero_whatsapp': clinica.numero_whatsapp,
+            'endereco': clinica.endereco,
+            'referencia_localizacao': clinica.referencia_localizacao,
+            'politica_agendamento': clinica.politica_agendamento,
+        } if clinica else None,
+        'medicos': [
+            {
+                'id': medico.id,
+                'nome': medico.nome,
+                'especialidades': [esp.nome for esp in medico.especialidades.all()],
+                'bio': medico.bio,
+                'convenios': medico.convenios,
+                'preco_particular': medico.preco_particular,
+                'formas_pagamento': medico.formas_pagamento,
+                'retorno_info': medico.retorno_info,
+            }
+            for medico in medicos
+        ],
+        'horarios': [
+            {
+                'medico_id': horario.medico_id,
+                'medico': horario.medico.nome,
+                'dia_da_semana': horario.dia_da_semana,
+                'dia': horario.get_dia_da_semana_display(),
+                'hora_inicio': horario.hora_inicio,
+                'hora_fim': horario.hora_fim,
+            }
+            for horario in horarios
+        ],
+        'exames': [
+            {
+                'id': exame.id,
+                'nome': exame.nome,
+                'preco': exame.preco,
+                'o_que_e': exame.o_que_e,
+                'como_funciona': exame.como_funciona,
+                'preparacao': exame.preparacao,
+                'vantagem': exame.vantagem,
+            }
+            for exame in exames
+        ],
+        'especialidades': [
+            {
+                'nome': especialidade.nome,
+                'descricao': especialidade.descricao,
+            }
+            for especialidade in especialidades
+        ],
+    }
+
+
+def get_knowledge_base_snapshot() -> Dict[str, Any]:
+    """
+    Retorna os dados da clínica para a versão atual da base de conhecimento
+
+    Usa um cache em memória do processo e, em seguida, o cache do Django.
+    O banco só é consultado quando a versão muda.
+    """
+    global _local_snapshot
+
+    version = get_knowledge_base_version()
+
+    local_version, local_data = _local_snapshot
+    if local_version == version:
+        return local_data
+
+    with _local_lock:
+        local_version, local_data = _local_snapshot
+        if local_version == version:
+            return local_data
+
+        cache_key = KB_SNAPSHOT_CACHE_KEY.format(version=version)
+        data = cache.get(cache_key)
+        if data is None:
+            data = _load_snapshot_from_db()
+            cache.set(cache_key, data, KB_CACHE_TIMEOUT)
+
+        _local_snapshot = (version, data)
+
+    return data
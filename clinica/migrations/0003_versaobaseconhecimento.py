@@ -0,0 +1,20 @@
+# Generated by Django 5.2.5 on 2026-10-18 08:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinica', '0002_clinicainfo_numero_whatsapp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersaoBaseConhecimento',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('versao', models.BigIntegerField()),
+            ],
+        ),
+    ]
@@ -93,3 +93,16 @@ class HorarioTrabalho(models.Model):
 
     def __str__(self):
         return f"{self.medico.nome} - {self.get_dia_da_semana_display()}: {self.hora_inicio} às {self.hora_fim}"
+
+
+class VersaoBaseConhecimento(models.Model):
+    """
+    Versão da base de conhecimento (registro único, ver clinica.knowledge_base)
+
+    Incrementada na mesma transação que altera os dados da clínica, fica
+    visível para todos os processos (web e workers da fila) junto com o commit.
+    """
+    versao = models.BigIntegerField()
+
+    def __str__(self):
+        return f"Base de conhecimento v{self.versao}"
@@ -0,0 +1,25 @@
+"""
+Signals que invalidam a base de conhecimento quando os dados da clínica mudam
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .knowledge_base import bump_knowledge_base_version
+from .models import ClinicaInfo, Especialidade, Exame, HorarioTrabalho, Medico
+
+KNOWLEDGE_BASE_MODELS = (ClinicaInfo, Especialidade, Exame, HorarioTrabalho, Medico)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def knowledge_base_model_changed(sender, **kwargs):
+    # Na mesma transação da alteração: a nova versão fica visível para os
+    # demais processos junto com os dados, no commit
+    if sender in KNOWLEDGE_BASE_MODELS:
+        bump_knowledge_base_version()
+
+
+@receiver(m2m_changed, sender=Medico.especialidades.through)
+def medico_especialidades_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_knowledge_base_version()
@@ -1,3 +1,47 @@
-from django.test import TestCase
+from decimal import Decimal
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+
+from . import knowledge_base
+from .knowledge_base import get_knowledge_base_snapshot, get_knowledge_base_version
+from .models import Exame
+
+ADMIN_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'admin'}}
+WORKER_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'worker'}}
+
+
+class KnowledgeBaseVersionTests(TestCase):
+    """A versão da base é compartilhada entre processos com caches diferentes"""
+
+    def setUp(self):
+        knowledge_base.forget_local_version()
+        knowledge_base._local_snapshot = (None, None)
+
+    def create_exame(self):
+        # Alteração feita pelo admin (processo web), executando os on_commit
+        with override_settings(CACHES=ADMIN_CACHE), self.captureOnCommitCallbacks(execute=True):
+            Exame.objects.create(nome='Polissonografia', o_que_e='-', como_funciona='-', preco=Decimal('500.00'))
+
+    def test_bump_visible_from_another_cache(self):
+        with override_settings(CACHES=WORKER_CACHE):
+            antes = get_knowledge_base_version()
+            self.assertEqual(get_knowledge_base_snapshot()['exames'], [])
+
+        self.create_exame()
+
+        # Outro processo: outro cache e a versão lida antes da alteração expirada
+        with override_settings(CACHES=WORKER_CACHE, CLINICA_KB_VERSAO_TTL_SEGUNDOS=0):
+            self.assertGreater(get_knowledge_base_version(), antes)
+            self.assertEqual([exame['nome'] for exame in get_knowledge_base_snapshot()['exames']], ['Polissonografia'])
+
+    def test_local_version_reused_until_ttl(self):
+        with override_settings(CLINICA_KB_VERSAO_TTL_SEGUNDOS=60):
+            versao = get_knowledge_base_version()
+            with self.assertNumQueries(0):
+                self.assertEqual(get_knowledge_base_version(), versao)
+
+    def test_bumping_process_sees_new_version_after_commit(self):
+        with override_settings(CLINICA_KB_VERSAO_TTL_SEGUNDOS=60):
+            antes = get_knowledge_base_version()
+            self.create_exame()
+            self.assertGreater(get_knowledge_base_version(), antes)
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+class CoreConfig(AppConfig):
+    name = 'core'
+
+    def ready(self):
+        # PRAGMAs do SQLite (WAL, busy_timeout...) em cada nova conexão,
+        # para qualquer app ou comando que use o banco
+        from .db import configure_sqlite_connection
+        connection_created.connect(configure_sqlite_connection, dispatch_uid='configure_sqlite_connection')
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_asgi_application()
+
+# Cria os clientes do chatbot (Gemini, WhatsApp) antes da primeira requisição
+from chatbot.services.registry import warm_up  # noqa: E402
+
+warm_up()
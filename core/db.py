@@ -0,0 +1,51 @@
+"""
+Ajustes das conexões SQLite para pequenas implantações
+
+No modo padrão (rollback journal) um escritor bloqueia todos os leitores e
+workers concorrentes do webhook esbarram em "database is locked". A cada
+nova conexão (signal connection_created) são aplicados:
+
+- journal_mode=WAL: leitores não bloqueiam o escritor e vice-versa;
+- busy_timeout: espera o lock em vez de falhar na hora;
+- synchronous=NORMAL: com WAL, fsync só nos checkpoints (uma queda de
+  energia pode perder as últimas transações, mas não corrompe o banco);
+- cache_size e mmap_size: mais páginas em memória por conexão.
+
+Em Postgres (ou com SQLITE_TUNING['ENABLED'] = False) nada é alterado.
+Com SQLITE_TUNING['JOURNAL_MODE'] = None o journal do arquivo é mantido
+(journal_mode é o único ajuste gravado no banco; os demais valem só para a
+conexão).
+
+O receiver é registrado no ready() do app `core`.
+"""
+from django.conf import settings
+
+DEFAULT_SQLITE_TUNING = {
+    'ENABLED': True,
+    'JOURNAL_MODE': 'WAL',
+    'BUSY_TIMEOUT_MS': 5000,
+    'SYNCHRONOUS': 'NORMAL',
+    'CACHE_SIZE_KIB': 64 * 1024,
+    'MMAP_SIZE_BYTES': 256 * 1024 * 1024,
+}
+
+
+def get_sqlite_tuning_setting(name: str):
+    """Lê um ajuste do SQLite (settings.SQLITE_TUNING) com valor padrão"""
+    return getattr(settings, 'SQLITE_TUNING', {}).get(name, DEFAULT_SQLITE_TUNING[name])
+
+
+def configure_sqlite_connection(sender, connection, **kwargs):
+    """Receiver de connection_created: aplica os PRAGMAs na nova conexão SQLite"""
+    if connection.vendor != 'sqlite' or not get_sqlite_tuning_setting('ENABLED'):
+        return
+
+    journal_mode = get_sqlite_tuning_setting('JOURNAL_MODE')
+    with connection.cursor() as cursor:
+        if journal_mode:
+            cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+        cursor.execute(f"PRAGMA busy_timeout={int(get_sqlite_tuning_setting('BUSY_TIMEOUT_MS'))}")
+        cursor.execute(f"PRAGMA synchronous={get_sqlite_tuning_setting('SYNCHRONOUS')}")
+        # Valor negativo: tamanho em KiB em vez de número de páginas
+        cursor.execute(f"PRAGMA cache_size=-{int(get_sqlite_tuning_setting('CACHE_SIZE_KIB'))}")
+        cursor.execute(f"PRAGMA mmap_size={int(get_sqlite_tuning_setting('MMAP_SIZE_BYTES'))}")
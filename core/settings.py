@@ -9,6 +9,8 @@ https://docs.djangoproject.com/en/5.2/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
+import os
+
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -37,6 +39,7 @@ ALLOWED_HOSTS = [
 # Application definition
 
 INSTALLED_APPS = [
+    'core',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -83,12 +86,48 @@ WSGI_APPLICATION = 'core.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Padrão: SQLite ajustado para pequenas implantações (PRAGMAs em
+# SQLITE_TUNING, aplicados por core.db a cada conexão), com conexões
+# persistentes e transações IMMEDIATE (o lock de escrita é pedido no início
+# da transação, então o busy_timeout vale também para ela).
+#
+# Para mais workers/processos, use Postgres com pool de conexões
+# (psycopg 3 com pool: pip install "psycopg[binary,pool]"):
+#   DB_ENGINE=postgres DB_NAME=chatbot DB_USER=... DB_PASSWORD=... DB_HOST=... DB_PORT=5432
+#   DB_POOL_MIN=2 DB_POOL_MAX=10
+# Com pool, CONN_MAX_AGE precisa ser 0 (o pool é que reaproveita as conexões).
+if os.environ.get('DB_ENGINE') == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'chatbot'),
+            'USER': os.environ.get('DB_USER', ''),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', 'localhost'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+            'CONN_MAX_AGE': 0,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('DB_POOL_MIN', 2)),
+                    'max_size': int(os.environ.get('DB_POOL_MAX', 10)),
+                },
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 5,   # Segundos de espera pelo lock (mesmo valor do busy_timeout)
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -137,4 +176,166 @@ CACHES = {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'unique-snowflake',
     }
-}
\ No newline at end of file
+}
+
+# Tempo (s) que cada processo reaproveita a versão da base de conhecimento lida
+# do banco antes de consultá-la de novo (atraso máximo para ver alterações)
+CLINICA_KB_VERSAO_TTL_SEGUNDOS = 5
+
+# Fila de mensagens recebidas pelo webhook (consumida por `manage.py processar_fila`)
+CHATBOT_QUEUE = {
+    'MAX_TENTATIVAS': 5,                      # Após isso a mensagem vai para dead-letter
+    'BACKOFF_BASE_SEGUNDOS': 5,               # Espera da 1ª nova tentativa (dobra a cada falha)
+    'BACKOFF_MAX_SEGUNDOS': 600,
+    'TIMEOUT_PROCESSAMENTO_SEGUNDOS': 900,    # Item "processando" há mais tempo volta para a fila (nunca antes do TTL do lock)
+    'LOTE_MAXIMO_POR_PACIENTE': 10,           # Mensagens seguidas do paciente respondidas juntas
+}
+
+# Cache de contexto do Gemini: o prompt do sistema é enviado uma vez por versão
+# da base de conhecimento e referenciado nas chamadas seguintes
+GEMINI_CONTEXT_CACHE = {
+    'ENABLED': True,
+    'TTL_SEGUNDOS': 3600,
+    'MARGEM_RENOVACAO_SEGUNDOS': 300,      # Renova o TTL quando faltar menos que isso
+    'ESPERA_APOS_FALHA_SEGUNDOS': 300,     # Após falha, usa prompt inline por esse tempo
+}
+
+# Janela de histórico enviada à IA. Mensagens mais antigas viram um resumo
+# incremental salvo em Conversa.resumo_historico
+CHATBOT_HISTORY = {
+    'MAX_MENSAGENS': 20,            # Últimas N mensagens da conversa
+    'MAX_TOKENS': 3000,             # Orçamento estimado de tokens da janela
+    'MAX_CARACTERES_RESUMO': 2000,  # Tamanho máximo do resumo das mensagens antigas
+}
+
+# Cliente HTTP da API do WhatsApp (sessão keep-alive compartilhada por processo).
+# A URL da API pode ser trocada pela variável WHATSAPP_API_BASE_URL (ex: stub local)
+WHATSAPP_HTTP = {
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 10,
+    'MAX_TENTATIVAS': 3,            # Inclui a primeira tentativa
+    'BACKOFF_BASE_SEGUNDOS': 0.5,
+    'BACKOFF_MAX_SEGUNDOS': 8,      # Também limita o Retry-After
+    'POOL_MAXSIZE': 20,
+}
+
+# Lock por paciente: serializa mensagens do mesmo número (webhook, fila e
+# caminho assíncrono) e permite responder uma rajada com uma única chamada à
+# IA. 'auto': advisory locks no Postgres, linha em TravaPaciente nos demais
+# bancos; 'cache' exige cache compartilhado (Redis/Memcached)
+CHATBOT_PATIENT_LOCK = {
+    'BACKEND': 'auto',
+    'TTL_SEGUNDOS': 600,            # Só vale se o processo cair; bem acima do pior turno (~150s)
+    'ESPERA_MAXIMA_SEGUNDOS': 120,
+    'INTERVALO_SEGUNDOS': 0.1,
+}
+
+# Token para coletores internos lerem /chatbot/metrics/ (header X-Metrics-Token).
+# Sem token, só usuários staff autenticados têm acesso
+CHATBOT_METRICS_TOKEN = os.environ.get('CHATBOT_METRICS_TOKEN')
+
+# Tempo (s) que os ids de mensagens recebidas ficam no cache para descartar
+# reentregas da Meta (depois disso a constraint única da fila ainda protege)
+CHATBOT_DEDUP_TTL_SEGUNDOS = 60 * 60 * 48
+
+# Índice materializado de horários (agendamento.SlotAgenda): horizonte móvel
+# gerado a partir de HorarioTrabalho. Reconstrua/estenda diariamente com
+# `python manage.py indexar_agenda` (ex: cron)
+AGENDA_SLOT_INDEX = {
+    'ENABLED': True,
+    'HORIZONTE_DIAS': 60,
+    'RETENCAO_SEGUNDOS': 300,   # Tempo que um horário fica retido enquanto o bot coleta os dados
+}
+
+# Comandos da IA ([CONSULTAR_AGENDA], [CRIAR_AGENDAMENTO]): o resultado é
+# respondido com templates; FRASEAR_COM_IA faz uma segunda chamada à IA para
+# redigir a resposta com os dados consultados
+CHATBOT_COMMANDS = {
+    'FRASEAR_COM_IA': False,
+    'MAX_HORARIOS_LISTADOS': 8,
+    'DIAS_ALTERNATIVOS': 14,            # Dias sugeridos quando a data pedida está cheia
+    'SIMILARIDADE_MINIMA_MEDICO': 0.75, # Tolerância na busca do médico pelo nome
+}
+
+# Modo da IA para a agenda: 'comandos' (comandos em texto na resposta) ou
+# 'ferramentas' (function calling do Gemini, com rodadas limitadas)
+CHATBOT_AI_MODE = 'comandos'
+CHATBOT_MAX_TURNOS_FERRAMENTAS = 4
+
+# Streaming das respostas da IA: trechos completos (parágrafos/frases) são
+# enviados ao WhatsApp conforme ficam prontos
+CHATBOT_STREAMING = {
+    'ENABLED': True,
+    'MIN_CARACTERES': 60,       # Tamanho mínimo de um trecho
+    'MAX_CARACTERES': 400,      # Trechos maiores são cortados na última frase completa
+    'INDICADOR_DIGITANDO': True,
+}
+
+# Cache de respostas para perguntas sem contexto (início da conversa):
+# acerto exato ou por similaridade de n-gramas, separado por versão da base
+CHATBOT_FAQ_CACHE = {
+    'ENABLED': True,
+    'SIMILARIDADE_MINIMA': 0.85,    # Similaridade de cosseno mínima para reaproveitar a resposta
+    'MAX_ENTRADAS': 500,
+    'MAX_CARACTERES_PERGUNTA': 300,
+    'SINCRONIZAR_SEGUNDOS': 30,     # Intervalo para recarregar as entradas de outros processos
+}
+
+# Recuperação (BM25) dos trechos da base de conhecimento: o prompt do sistema
+# leva só os dados gerais da clínica e o catálogo de nomes; médicos,
+# horários, exames e especialidades relevantes vão junto de cada mensagem
+CHATBOT_RETRIEVAL = {
+    'ENABLED': True,
+    'TOP_K': 4,                 # Trechos enviados por mensagem
+    'MENSAGENS_CONSULTA': 3,    # Mensagens recentes usadas como consulta
+    'MAX_NOMES_CATALOGO': 50,
+}
+
+# Roteador de intenções: saudações, endereço, telefone, médicos, preços e
+# convênios respondidos por template, sem chamar a IA
+CHATBOT_INTENT_ROUTER = {
+    'ENABLED': True,
+    'MAX_PALAVRAS': 12,             # Mensagens maiores seguem direto para a IA
+    'MAX_MEDICOS_LISTADOS': 6,      # Acima disso listas de médicos/preços ficam com a IA
+    'CLASSIFICADOR': False,         # Classificador local de n-gramas para variações das regras
+    'CONFIANCA_MINIMA_CLASSIFICADOR': 0.5,
+}
+
+# Roteamento de modelos do Gemini: cadeia por tipo de turno (primeiro modelo
+# preferido, demais como fallback), timeout por modelo, hedging pelo p95 da
+# latência recente e circuit breaker
+GEMINI_MODEL_ROUTER = {
+    'CADEIAS': {
+        'simples': ['gemini-2.0-flash-lite', 'gemini-2.0-flash-exp'],
+        'agendamento': ['gemini-2.0-flash-exp', 'gemini-2.0-flash-lite'],
+    },
+    'TIMEOUTS_SEGUNDOS': {
+        'gemini-2.0-flash-lite': 10,
+        'gemini-2.0-flash-exp': 20,
+    },
+    'HEDGING': True,
+    'ATRASO_HEDGE_PADRAO_SEGUNDOS': 4.0,    # Usado até haver amostras para o p95
+    'FALHAS_PARA_ABRIR': 3,                 # Falhas seguidas que abrem o circuito do modelo
+    'ESPERA_CIRCUITO_SEGUNDOS': 60,
+}
+
+# Serviços do chatbot compartilhados pelo processo (clientes do Gemini e do
+# WhatsApp criados uma única vez)
+CHATBOT_SERVICES = {
+    # Cria os serviços na inicialização do servidor (core.wsgi/core.asgi) e do
+    # `processar_fila`, antes da primeira mensagem; nunca nos demais comandos
+    'AQUECER_NA_INICIALIZACAO': True,
+}
+
+# Ajustes das conexões SQLite (ignorado em Postgres). Ver core/db.py
+SQLITE_TUNING = {
+    'ENABLED': True,
+    # Leitores e escritor não se bloqueiam. O modo WAL fica gravado no
+    # arquivo: no db.sqlite3 versionado de desenvolvimento (DEBUG) o journal
+    # não é alterado, para o arquivo não mudar a cada comando
+    'JOURNAL_MODE': None if DEBUG else 'WAL',
+    'BUSY_TIMEOUT_MS': 5000,        # Espera pelo lock antes de "database is locked"
+    'SYNCHRONOUS': 'NORMAL',        # fsync só nos checkpoints do WAL
+    'CACHE_SIZE_KIB': 64 * 1024,
+    'MMAP_SIZE_BYTES': 256 * 1024 * 1024,
+}
@@ -0,0 +1,250 @@
+"""
+Benchmark dos índices das consultas frequentes (chatbot e usuarios)
+
+Cria um banco SQLite separado (nunca usa o db.sqlite3 do projeto), aplica
+todas as migrações, remove os índices declarados em `Meta.indexes` dos
+models do chatbot e de usuarios, popula pacientes, conversas, mensagens e
+direcionamentos e mede as consultas que o fluxo de mensagens e o admin
+realmente fazem (mesmos filtros e ordenação do código). Em seguida recria
+os índices e mede de novo, mostrando o plano de execução (EXPLAIN) e o
+tempo médio de cada consulta antes e depois. Índices de FK e de
+constraints (únicos parciais) existem nas duas medições.
+
+Mede só o SQLite. No Postgres (DB_ENGINE=postgres) os planos podem ser
+outros: lá o índice da FK não inclui o id, e a janela do histórico
+ordena as mensagens da conversa (poucas linhas) depois da busca.
+
+Uso (na raiz do projeto):
+    python scripts/benchmark_indices.py
+    python scripts/benchmark_indices.py --pacientes 10000 --mensagens 100000 --db /tmp/bench.sqlite3
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+# Apps cujos Meta.indexes são medidos
+APPS = ['chatbot', 'usuarios']
+
+NOMES = ['Ana', 'Bruno', 'Carla', 'Diego', 'Elisa', 'Fábio', 'Gabriela', 'Heitor', 'Isabela', 'João', 'Larissa', 'Marcos']
+SOBRENOMES = ['Silva', 'Souza', 'Oliveira', 'Santos', 'Pereira', 'Lima', 'Costa', 'Ribeiro', 'Almeida', 'Carvalho']
+LOTE = 10000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='/tmp/benchmark_indices.sqlite3', help='Arquivo SQLite (recriado a cada execução)')
+    parser.add_argument('--pacientes', type=int, default=100000)
+    parser.add_argument('--mensagens', type=int, default=1000000)
+    parser.add_argument('--repeticoes', type=int, default=200, help='Execuções de cada consulta por medição')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+
+def setup_django(db_path):
+    """Configura o Django apontando para o banco do benchmark"""
+    import django
+    from django.conf import settings
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    settings.DATABASES['default'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': db_path}
+    django.setup()
+
+
+def seed(pacientes, mensagens):
+    """Popula o banco com SQL em lote (o ORM levaria muito mais tempo para 1M de linhas)"""
+    from django.db import connection, transaction
+    from django.utils import timezone
+
+    # Datas em UTC sem fuso, como o backend SQLite do Django grava
+    agora = timezone.now().replace(tzinfo=None)
+    inicio = time.monotonic()
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        linhas = []
+        for i in range(1, pacientes + 1):
+            nome = f"{random.choice(NOMES)} {random.choice(SOBRENOMES)} {random.choice(SOBRENOMES)}"
+            linhas.append((nome if random.random() < 0.8 else None, f"55719{i:08d}", agora, agora, True))
+            if len(linhas) == LOTE:
+                cursor.executemany(
+                    "INSERT INTO usuarios_paciente (nome_completo, telefone_whatsapp, primeiro_contato, ultimo_contato, ativo) "
+                    "VALUES (%s, %s, %s, %s, %s)", linhas
+                )
+                linhas = []
+        if linhas:
+            cursor.executemany(
+                "INSERT INTO usuarios_paciente (nome_completo, telefone_whatsapp, primeiro_contato, ultimo_contato, ativo) "
+                "VALUES (%s, %s, %s, %s, %s)", linhas
+            )
+
+        # Cada paciente tem uma conversa ativa; 30% também têm uma antiga redirecionada
+        conversas = [(paciente_id, 'ativa') for paciente_id in range(1, pacientes + 1)]
+        conversas += [(paciente_id, 'redirecionada') for paciente_id in range(1, pacientes + 1) if random.random() < 0.3]
+        for start in range(0, len(conversas), LOTE):
+            cursor.executemany(
+                "INSERT INTO chatbot_conversa (paciente_id, iniciada_em, status, resumo_historico, ultima_mensagem_resumida_id) "
+                "VALUES (%s, %s, %s, '', 0)",
+                [(paciente_id, agora, status) for paciente_id, status in conversas[start:start + LOTE]]
+            )
+
+        # Mensagens intercaladas entre conversas, como chegam em produção
+        total_conversas = len(conversas)
+        linhas = []
+        for i in range(mensagens):
+            conversa_id = random.randint(1, total_conversas)
+            remetente = 'user' if i % 2 == 0 else 'bot'
+            processada = remetente != 'user' or random.random() > 0.01
+            linhas.append((conversa_id, remetente, f"Mensagem {i} de teste do benchmark", agora - timedelta(seconds=mensagens - i), processada))
+            if len(linhas) == LOTE:
+                cursor.executemany(
+                    "INSERT INTO chatbot_mensagemconversa (conversa_id, remetente, conteudo, timestamp, processada) "
+                    "VALUES (%s, %s, %s, %s, %s)", linhas
+                )
+                linhas = []
+        if linhas:
+            cursor.executemany(
+                "INSERT INTO chatbot_mensagemconversa (conversa_id, remetente, conteudo, timestamp, processada) "
+                "VALUES (%s, %s, %s, %s, %s)", linhas
+            )
+
+        # Direcionamentos das conversas redirecionadas; 10% ainda pendentes
+        linhas = []
+        for conversa_id, (paciente_id, status) in enumerate(conversas, start=1):
+            if status == 'redirecionada':
+                pendente = random.random() < 0.1
+                linhas.append((
+                    paciente_id, conversa_id, 'agendamento', '-', agora - timedelta(minutes=random.randint(0, 60 * 24 * 90)),
+                    'pendente' if pendente else 'resolvido'
+                ))
+        for start in range(0, len(linhas), LOTE):
+            cursor.executemany(
+                "INSERT INTO chatbot_direcionamento (paciente_id, conversa_id, tipo_solicitacao, resumo_conversa, data_criacao, status) "
+                "VALUES (%s, %s, %s, %s, %s, %s)", linhas[start:start + LOTE]
+            )
+
+    print(f"Banco populado em {time.monotonic() - inicio:.1f}s: {pacientes} pacientes, "
+          f"{total_conversas} conversas, {mensagens} mensagens")
+    return total_conversas
+
+
+def build_queries(pacientes, mensagens):
+    """Consultas do fluxo de mensagens e do admin, com parâmetros sorteados a cada execução"""
+    from chatbot.models import Direcionamento, MensagemConversa
+    from chatbot.services.patient_state import DIRECIONAMENTO_PENDENTE_STATUS, _state_queryset
+    from usuarios.models import Paciente
+
+    def conversa_ativa_id():
+        # As conversas ativas são as primeiras inseridas, uma por paciente
+        return random.randint(1, pacientes)
+
+    def paciente_id():
+        return random.randint(1, pacientes)
+
+    return [
+        ('estado do paciente (load_patient_state)',
+         lambda: _state_queryset().filter(telefone_whatsapp=f"55719{paciente_id():08d}")),
+        ('janela do histórico (_build_turn_history)',
+         lambda: MensagemConversa.objects.filter(conversa_id=conversa_ativa_id()).order_by('-id')[:20]),
+        ('mensagens fora da janela (_update_history_summary)',
+         lambda: MensagemConversa.objects.filter(
+             conversa_id=conversa_ativa_id(), id__gt=0, id__lt=random.randint(1, mensagens)
+         ).order_by('id')),
+        ('ids já registrados no turno (_begin_turn)',
+         lambda: MensagemConversa.objects.filter(
+             conversa_id=conversa_ativa_id(), remetente='user', processada=False, whatsapp_message_id__in=['wamid.1', 'wamid.2']
+         ).values_list('whatsapp_message_id', flat=True)),
+        ('mensagens do usuário (_generate_conversation_summary)',
+         lambda: MensagemConversa.objects.filter(conversa_id=conversa_ativa_id(), remetente='user')),
+        ('direcionamento pendente (has_pending_direcionamento)',
+         lambda: Direcionamento.objects.filter(paciente_id=paciente_id(), status__in=DIRECIONAMENTO_PENDENTE_STATUS)),
+        ('admin: direcionamentos por status',
+         lambda: Direcionamento.objects.filter(status='pendente').order_by('-pk')[:100]),
+        ('admin: busca de pacientes por nome',
+         lambda: Paciente.objects.filter(nome_completo__icontains=random.choice(SOBRENOMES)).order_by('-pk')[:100]),
+    ]
+
+
+def model_indexes():
+    """(model, índice) declarados em Meta.indexes dos apps medidos"""
+    from django.apps import apps
+
+    return [
+        (model, index)
+        for app in APPS
+        for model in apps.get_app_config(app).get_models()
+        for index in model._meta.indexes
+    ]
+
+
+def measure(queries, repeticoes):
+    """
+    Plano e tempo médio (ms) de cada consulta
+
+    O SQL é gerado antes de medir: o tempo é só o do banco, sem o custo de
+    montar a consulta no ORM (igual antes e depois, esconderia a diferença).
+    """
+    from django.db import connection
+
+    resultados = {}
+    with connection.cursor() as cursor:
+        for nome, factory in queries:
+            plano = factory().explain()
+            consultas = [factory().query.sql_with_params() for _ in range(repeticoes)]
+            inicio = time.perf_counter()
+            for sql, params in consultas:
+                cursor.execute(sql, params)
+                cursor.fetchall()
+            resultados[nome] = (plano, (time.perf_counter() - inicio) / repeticoes * 1000)
+    return resultados
+
+
+def report(antes, depois):
+    for nome, (plano_antes, ms_antes) in antes.items():
+        plano_depois, ms_depois = depois[nome]
+        ganho = ms_antes / ms_depois if ms_depois else float('inf')
+        print(f"\n== {nome}: {ms_antes:.3f} ms -> {ms_depois:.3f} ms ({ganho:.1f}x)")
+        print("   antes:  " + plano_antes.replace('\n', '\n           '))
+        print("   depois: " + plano_depois.replace('\n', '\n           '))
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    setup_django(args.db)
+
+    from django.core.management import call_command
+    from django.db import connection
+
+    call_command('migrate', verbosity=0)
+    indices = model_indexes()
+    with connection.schema_editor() as editor:
+        for model, index in indices:
+            editor.remove_index(model, index)
+
+    seed(args.pacientes, args.mensagens)
+    queries = build_queries(args.pacientes, args.mensagens)
+
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    antes = measure(queries, args.repeticoes)
+
+    inicio = time.monotonic()
+    with connection.schema_editor() as editor:
+        for model, index in indices:
+            editor.add_index(model, index)
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    print(f"Índices criados em {time.monotonic() - inicio:.1f}s: {', '.join(index.name for _, index in indices)}")
+
+    depois = measure(queries, args.repeticoes)
+    report(antes, depois)
+
+
+if __name__ == '__main__':
+    main()
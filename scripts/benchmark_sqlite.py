@@ -0,0 +1,170 @@
+"""
+Benchmark de concorrência do SQLite (journal padrão x WAL x WAL + IMMEDIATE)
+
+Para cada modo cria um banco SQLite separado (nunca usa o db.sqlite3 do
+projeto), aplica as migrações, cria pacientes com conversa ativa e dispara
+vários processos que simulam turnos do webhook durante um tempo fixo:
+carregam o estado do paciente, leem o histórico e gravam as mensagens do
+usuário e do bot em lote. Ao final mostra turnos por segundo e quantos
+falharam com "database is locked".
+
+Modos:
+    padrao          rollback journal, transações DEFERRED (sem os ajustes de core.db)
+    wal             SQLITE_TUNING (WAL, busy_timeout, synchronous=NORMAL), DEFERRED
+    wal_immediate   SQLITE_TUNING + transaction_mode IMMEDIATE (configuração do projeto)
+
+Uso (na raiz do projeto):
+    python scripts/benchmark_sqlite.py
+    python scripts/benchmark_sqlite.py --workers 8 --duracao 10 --modos wal wal_immediate
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+MODOS = {
+    'padrao': {'tuning': False, 'options': {}},
+    'wal': {'tuning': True, 'options': {}},
+    'wal_immediate': {'tuning': True, 'options': {'transaction_mode': 'IMMEDIATE'}},
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modos', nargs='+', choices=list(MODOS), default=list(MODOS))
+    parser.add_argument('--workers', type=int, default=8, help='Processos simulando o webhook')
+    parser.add_argument('--duracao', type=float, default=10.0, help='Segundos de carga por modo')
+    parser.add_argument('--pacientes', type=int, default=200)
+    parser.add_argument('--timeout', type=float, default=5.0, help='Espera pelo lock (segundos)')
+    parser.add_argument('--dir', default='/tmp', help='Diretório dos bancos (recriados a cada execução)')
+    # Uso interno: executa um único modo neste processo
+    parser.add_argument('--modo', choices=list(MODOS), help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def setup_django(db_path, modo, timeout):
+    """Configura o Django apontando para o banco do benchmark, no modo pedido"""
+    import django
+    from django.conf import settings
+
+    for sufixo in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + sufixo):
+            os.remove(db_path + sufixo)
+    settings.DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': db_path,
+        'OPTIONS': {'timeout': timeout, **MODOS[modo]['options']},
+    }
+    settings.SQLITE_TUNING = {'ENABLED': MODOS[modo]['tuning'], 'BUSY_TIMEOUT_MS': int(timeout * 1000)}
+    django.setup()
+
+
+def seed(pacientes):
+    from chatbot.models import Conversa
+    from usuarios.models import Paciente
+
+    Paciente.objects.bulk_create([
+        Paciente(telefone_whatsapp=f"55719{i:08d}") for i in range(pacientes)
+    ])
+    Conversa.objects.bulk_create([
+        Conversa(paciente=paciente, status='ativa') for paciente in Paciente.objects.all()
+    ])
+
+
+def worker(numero, pacientes, fim, resultados):
+    """Executa turnos até o fim do tempo e devolve (turnos, locked, outros erros, latências)"""
+    from django.db import OperationalError, connection, transaction
+
+    from chatbot.models import MensagemConversa
+    from chatbot.services.message_buffer import MessageBuffer
+    from chatbot.services.patient_state import load_patient_state
+
+    random.seed(numero)
+    turnos = locked = erros = 0
+    latencias = []
+    while time.monotonic() < fim:
+        telefone = f"55719{random.randrange(pacientes):08d}"
+        inicio = time.perf_counter()
+        try:
+            # Mesmo padrão do turno: leituras e a gravação na mesma transação
+            with transaction.atomic():
+                state = load_patient_state(telefone)
+                list(MensagemConversa.objects.filter(conversa=state.conversa).order_by('-id')[:20])
+                with MessageBuffer() as mensagens:
+                    mensagens.add(state.conversa, 'user', 'Quero agendar uma consulta')
+                    mensagens.add(state.conversa, 'bot', 'Claro! Qual especialidade?')
+            turnos += 1
+            latencias.append(time.perf_counter() - inicio)
+        except OperationalError as e:
+            if 'locked' in str(e):
+                locked += 1
+            else:
+                erros += 1
+    connection.close()
+    resultados.put((turnos, locked, erros, latencias))
+
+
+def run_modo(args):
+    """Executa um modo: migra, popula, dispara os workers e imprime uma linha de resultado"""
+    db_path = os.path.join(args.dir, f'benchmark_sqlite_{args.modo}.sqlite3')
+    setup_django(db_path, args.modo, args.timeout)
+
+    from django.core.management import call_command
+    from django.db import connection, connections
+
+    call_command('migrate', verbosity=0)
+    seed(args.pacientes)
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode")
+        journal_mode = cursor.fetchone()[0]
+    # Cada worker abre a própria conexão
+    connections.close_all()
+
+    ctx = multiprocessing.get_context('fork')
+    resultados = ctx.Queue()
+    fim = time.monotonic() + args.duracao
+    processos = [
+        ctx.Process(target=worker, args=(numero, args.pacientes, fim, resultados))
+        for numero in range(args.workers)
+    ]
+    for processo in processos:
+        processo.start()
+    parciais = [resultados.get() for _ in processos]
+    for processo in processos:
+        processo.join()
+
+    turnos = sum(p[0] for p in parciais)
+    locked = sum(p[1] for p in parciais)
+    erros = sum(p[2] for p in parciais)
+    latencias = sorted(latencia for p in parciais for latencia in p[3])
+    tentativas = turnos + locked + erros
+    p95 = latencias[int(len(latencias) * 0.95) - 1] * 1000 if latencias else 0.0
+    print(f"{args.modo:<14} journal={journal_mode:<8} turnos/s={turnos / args.duracao:8.1f}  "
+          f"locked={locked:5d} ({locked / tentativas if tentativas else 0:6.1%})  "
+          f"outros erros={erros:3d}  p95={p95:7.1f} ms")
+
+
+def main():
+    args = parse_args()
+    if args.modo:
+        run_modo(args)
+        return
+
+    print(f"{args.workers} workers, {args.duracao:.0f}s por modo, {args.pacientes} pacientes")
+    # Um processo por modo: as configurações do banco são lidas uma única vez pelo Django
+    for modo in args.modos:
+        subprocess.run([
+            sys.executable, os.path.abspath(__file__), '--modo', modo,
+            '--workers', str(args.workers), '--duracao', str(args.duracao),
+            '--pacientes', str(args.pacientes), '--timeout', str(args.timeout), '--dir', args.dir,
+        ], check=True)
+
+
+if __name__ == '__main__':
+    main()